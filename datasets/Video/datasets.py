@@ -11,6 +11,13 @@ from torchvision import transforms
 from . import video_transforms, volume_transforms
 from .loader import get_image_loader, get_video_loader
 from .random_erasing import RandomErasing
+from .uint8_transforms import (
+    frames_to_uint8,
+    resize_short_side,
+    center_crop,
+    random_resized_crop,
+    random_horizontal_flip,
+)
 import random
 from datasets.Sample import Sample
 
@@ -57,6 +64,9 @@ class VideoClsDataset(Dataset):
             self.aug = True
             if self.args.video_reprob > 0:
                 self.rand_erase = True
+        # clips leave the workers as uint8 C x T x H x W and are normalised
+        # on the device; random erasing needs normalised float clips
+        self.video_norm = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 
         self.video_loader = get_video_loader()
 
@@ -73,35 +83,27 @@ class VideoClsDataset(Dataset):
             pass
 
         elif (mode == 'validation'):
-            self.data_transform = video_transforms.Compose([
-                video_transforms.Resize(
-                    self.short_side_size, interpolation='bilinear'),
-                video_transforms.CenterCrop(
-                    size=(self.crop_size, self.crop_size)),
-                volume_transforms.ClipToTensor(),
-                video_transforms.Normalize(
-                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-            ])
+            self.data_transform = self._val_transform
         elif mode == 'test':
-            self.data_resize = video_transforms.Compose([
-                video_transforms.Resize(
-                    size=(short_side_size), interpolation='bilinear')
-            ])
-            self.data_transform = video_transforms.Compose([
-                volume_transforms.ClipToTensor(),
-                video_transforms.Normalize(
-                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-            ])
+            self.data_resize = self._test_resize
+            self.data_transform = self._to_ctHW
+            # multi-view: one entry per video, all (segment, crop) views are
+            # cut from a single decode and returned stacked
+            self.multi_view = args.video_test_multi_view
             self.test_seg = []
             self.test_dataset = []
             self.test_label_array = []
-            for ck in range(self.test_num_segment):
-                for cp in range(self.test_num_crop):
-                    for idx in range(len(self.label_array)):
-                        sample_label = self.label_array[idx]
-                        self.test_label_array.append(sample_label)
-                        self.test_dataset.append(self.dataset_samples[idx])
-                        self.test_seg.append((ck, cp))
+            if self.multi_view:
+                self.test_dataset = self.dataset_samples
+                self.test_label_array = self.label_array
+            else:
+                for ck in range(self.test_num_segment):
+                    for cp in range(self.test_num_crop):
+                        for idx in range(len(self.label_array)):
+                            sample_label = self.label_array[idx]
+                            self.test_label_array.append(sample_label)
+                            self.test_dataset.append(self.dataset_samples[idx])
+                            self.test_seg.append((ck, cp))
 
     def __getitem__(self, index):
         if self.mode == 'train':
@@ -156,6 +158,27 @@ class VideoClsDataset(Dataset):
             return buffer, self.label_array[index], sample.split(
                 "/")[-1].split(".")[0]
 
+        elif self.mode == 'test' and self.multi_view:
+            sample = self.test_dataset[index]
+            buffer = self.load_video(sample)
+
+            while len(buffer) == 0:
+                warnings.warn(
+                    "video {} not found during testing".format(sample))
+                index = np.random.randint(self.__len__())
+                sample = self.test_dataset[index]
+                buffer = self.load_video(sample)
+
+            buffer = self.data_resize(buffer)  # T C H W
+            # V x C x T x H x W, V = test_num_segment * test_num_crop
+            views = torch.stack([
+                self.data_transform(self._test_view(buffer, ck, cp))
+                for ck in range(self.test_num_segment)
+                for cp in range(self.test_num_crop)
+            ])
+            return views, self.test_label_array[index], sample.split(
+                "/")[-1].split(".")[0]
+
         elif self.mode == 'test':
             sample = self.test_dataset[index]
             chunk_nb, split_nb = self.test_seg[index]
@@ -170,57 +193,52 @@ class VideoClsDataset(Dataset):
                 chunk_nb, split_nb = self.test_seg[index]
                 buffer = self.load_video(sample)
 
-            buffer = self.data_resize(buffer)
-            if isinstance(buffer, list):
-                buffer = np.stack(buffer, 0)
-
-            if self.sparse_sample:
-                spatial_step = 1.0 * (max(buffer.shape[1], buffer.shape[2]) -
-                                      self.short_side_size) / (
-                                          self.test_num_crop - 1)
-                temporal_start = chunk_nb
-                spatial_start = int(split_nb * spatial_step)
-                if buffer.shape[1] >= buffer.shape[2]:
-                    buffer = buffer[temporal_start::self.test_num_segment,
-                                    spatial_start:spatial_start +
-                                    self.short_side_size, :, :]
-                else:
-                    buffer = buffer[temporal_start::self.test_num_segment, :,
-                                    spatial_start:spatial_start +
-                                    self.short_side_size, :]
-            else:
-                spatial_step = 1.0 * (max(buffer.shape[1], buffer.shape[2]) -
-                                      self.short_side_size) / (
-                                          self.test_num_crop - 1)
-                temporal_step = max(
-                    1.0 * (buffer.shape[0] - self.clip_len) /
-                    (self.test_num_segment - 1), 0)
-                temporal_start = int(chunk_nb * temporal_step)
-                spatial_start = int(split_nb * spatial_step)
-                if buffer.shape[1] >= buffer.shape[2]:
-                    buffer = buffer[temporal_start:temporal_start +
-                                    self.clip_len,
-                                    spatial_start:spatial_start +
-                                    self.short_side_size, :, :]
-                else:
-                    buffer = buffer[temporal_start:temporal_start +
-                                    self.clip_len, :,
-                                    spatial_start:spatial_start +
-                                    self.short_side_size, :]
-
+            buffer = self.data_resize(buffer)  # T C H W
+            buffer = self._test_view(buffer, chunk_nb, split_nb)
             buffer = self.data_transform(buffer)
-            
-            rtn={
-                'video': buffer,
-                'caption': self.test_label_array[index]
-            }
-            
-            
-            # return buffer, self.test_label_array[index], sample.split(
-            #     "/")[-1].split(".")[0], chunk_nb, split_nb
+            return buffer, self.test_label_array[index], sample.split(
+                "/")[-1].split(".")[0]
         else:
             raise NameError('mode {} unkown'.format(self.mode))
 
+    def _test_view(self, buffer, chunk_nb, split_nb):
+        """Temporal segment ``chunk_nb`` / spatial crop ``split_nb`` of a
+        resized T x C x H x W clip."""
+        if self.sparse_sample:
+            spatial_step = 1.0 * (max(buffer.shape[2], buffer.shape[3]) -
+                                  self.short_side_size) / (
+                                      self.test_num_crop - 1)
+            temporal_start = chunk_nb
+            spatial_start = int(split_nb * spatial_step)
+            if buffer.shape[2] >= buffer.shape[3]:
+                buffer = buffer[temporal_start::self.test_num_segment, :,
+                                spatial_start:spatial_start +
+                                self.short_side_size, :]
+            else:
+                buffer = buffer[temporal_start::self.test_num_segment, :, :,
+                                spatial_start:spatial_start +
+                                self.short_side_size]
+        else:
+            spatial_step = 1.0 * (max(buffer.shape[2], buffer.shape[3]) -
+                                  self.short_side_size) / (
+                                      self.test_num_crop - 1)
+            temporal_step = max(
+                1.0 * (buffer.shape[0] - self.clip_len) /
+                (self.test_num_segment - 1), 0)
+            temporal_start = int(chunk_nb * temporal_step)
+            spatial_start = int(split_nb * spatial_step)
+            if buffer.shape[2] >= buffer.shape[3]:
+                buffer = buffer[temporal_start:temporal_start +
+                                self.clip_len, :,
+                                spatial_start:spatial_start +
+                                self.short_side_size, :]
+            else:
+                buffer = buffer[temporal_start:temporal_start +
+                                self.clip_len, :, :,
+                                spatial_start:spatial_start +
+                                self.short_side_size]
+        return buffer
+
     def _aug_frame(self, buffer, args):
         aug_transform = video_transforms.create_random_augment(
             input_size=(self.crop_size, self.crop_size),
@@ -232,6 +250,9 @@ class VideoClsDataset(Dataset):
 
         buffer = aug_transform(buffer)
 
+        if not self.rand_erase:
+            return self._crop_flip_uint8(buffer, args)
+
         buffer = [transforms.ToTensor()(img) for img in buffer]
         buffer = torch.stack(buffer)  # T C H W
         buffer = buffer.permute(0, 2, 3, 1)  # T H W C
@@ -274,6 +295,28 @@ class VideoClsDataset(Dataset):
 
         return buffer
 
+    def _val_transform(self, buffer):
+        buffer = resize_short_side(frames_to_uint8(buffer), self.short_side_size)
+        return self._to_ctHW(center_crop(buffer, self.crop_size))
+
+    def _test_resize(self, buffer):
+        return resize_short_side(frames_to_uint8(buffer), self.short_side_size)
+
+    @staticmethod
+    def _to_ctHW(buffer):
+        # T C H W -> C T H W
+        return buffer.permute(1, 0, 2, 3)
+
+    def _crop_flip_uint8(self, buffer, args):
+        # RandAugment output -> uint8 T C H W, random resized crop and flip
+        # for all frames at once, returned as C T H W
+        buffer = frames_to_uint8(buffer)
+        buffer = random_resized_crop(
+            buffer, self.crop_size, scale=[0.08, 1.0], ratio=[0.75, 1.3333])
+        if args.video_dataset != 'SSV2':
+            buffer = random_horizontal_flip(buffer, 0.5)
+        return buffer.permute(1, 0, 2, 3)
+
     def load_video(self, sample, sample_rate_scale=1):
         fname = sample
 
@@ -388,6 +431,9 @@ class RawFrameClsDataset(Dataset):
             self.aug = True
             if self.args.video_reprob > 0:
                 self.rand_erase = True
+        # clips leave the workers as uint8 C x T x H x W and are normalised
+        # on the device; random erasing needs normalised float clips
+        self.video_norm = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 
         self.image_loader = get_image_loader()
 
@@ -401,25 +447,10 @@ class RawFrameClsDataset(Dataset):
             pass
 
         elif (mode == 'validation'):
-            self.data_transform = video_transforms.Compose([
-                video_transforms.Resize(
-                    self.short_side_size, interpolation='bilinear'),
-                video_transforms.CenterCrop(
-                    size=(self.crop_size, self.crop_size)),
-                volume_transforms.ClipToTensor(),
-                video_transforms.Normalize(
-                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-            ])
+            self.data_transform = self._val_transform
         elif mode == 'test':
-            self.data_resize = video_transforms.Compose([
-                video_transforms.Resize(
-                    size=(short_side_size), interpolation='bilinear')
-            ])
-            self.data_transform = video_transforms.Compose([
-                volume_transforms.ClipToTensor(),
-                video_transforms.Normalize(
-                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-            ])
+            self.data_resize = self._test_resize
+            self.data_transform = self._to_ctHW
             self.test_seg = []
             self.test_dataset = []
             self.test_total_frames = []
@@ -500,23 +531,21 @@ class RawFrameClsDataset(Dataset):
                 chunk_nb, split_nb = self.test_seg[index]
                 buffer = self.load_frame(sample, total_frame)
 
-            buffer = self.data_resize(buffer)
-            if isinstance(buffer, list):
-                buffer = np.stack(buffer, 0)
+            buffer = self.data_resize(buffer)  # T C H W
 
-            spatial_step = 1.0 * (max(buffer.shape[1], buffer.shape[2]) -
+            spatial_step = 1.0 * (max(buffer.shape[2], buffer.shape[3]) -
                                   self.short_side_size) / (
                                       self.test_num_crop - 1)
             temporal_start = chunk_nb
             spatial_start = int(split_nb * spatial_step)
-            if buffer.shape[1] >= buffer.shape[2]:
-                buffer = buffer[temporal_start::self.test_num_segment,
-                                spatial_start:spatial_start +
-                                self.short_side_size, :, :]
-            else:
+            if buffer.shape[2] >= buffer.shape[3]:
                 buffer = buffer[temporal_start::self.test_num_segment, :,
                                 spatial_start:spatial_start +
                                 self.short_side_size, :]
+            else:
+                buffer = buffer[temporal_start::self.test_num_segment, :, :,
+                                spatial_start:spatial_start +
+                                self.short_side_size]
 
             buffer = self.data_transform(buffer)
             return buffer, self.test_label_array[index], sample.split(
@@ -535,6 +564,9 @@ class RawFrameClsDataset(Dataset):
 
         buffer = aug_transform(buffer)
 
+        if not self.rand_erase:
+            return self._crop_flip_uint8(buffer, args)
+
         buffer = [transforms.ToTensor()(img) for img in buffer]
         buffer = torch.stack(buffer)  # T C H W
         buffer = buffer.permute(0, 2, 3, 1)  # T H W C
@@ -576,6 +608,28 @@ class RawFrameClsDataset(Dataset):
 
         return buffer
 
+    def _val_transform(self, buffer):
+        buffer = resize_short_side(frames_to_uint8(buffer), self.short_side_size)
+        return self._to_ctHW(center_crop(buffer, self.crop_size))
+
+    def _test_resize(self, buffer):
+        return resize_short_side(frames_to_uint8(buffer), self.short_side_size)
+
+    @staticmethod
+    def _to_ctHW(buffer):
+        # T C H W -> C T H W
+        return buffer.permute(1, 0, 2, 3)
+
+    def _crop_flip_uint8(self, buffer, args):
+        # RandAugment output -> uint8 T C H W, random resized crop and flip
+        # for all frames at once, returned as C T H W
+        buffer = frames_to_uint8(buffer)
+        buffer = random_resized_crop(
+            buffer, self.crop_size, scale=[0.08, 1.0], ratio=[0.75, 1.3333])
+        if args.video_dataset != 'SSV2':
+            buffer = random_horizontal_flip(buffer, 0.5)
+        return buffer.permute(1, 0, 2, 3)
+
     def load_frame(self, sample, num_frames, sample_rate_scale=1):
         """Load video content using Decord"""
         fname = sample
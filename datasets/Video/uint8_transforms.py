@@ -0,0 +1,178 @@
+"""Batched transforms for uint8 video clips.
+
+Clips stay uint8 ``T x C x H x W`` tensors in the DataLoader workers: all
+frames are resized / cropped / flipped with one tensor op, and the float
+conversion + normalisation is left to the device (``normalize_video``), so
+workers ship 1/4 of the float32 bytes through shared memory.
+"""
+import time
+
+import numpy as np
+import torch
+import torchvision.transforms.functional as TF
+from torchvision.transforms import InterpolationMode
+
+from util.logger import print_log
+from .video_transforms import _get_param_spatial_crop
+
+_INTERP = {
+    "bilinear": InterpolationMode.BILINEAR,
+    "bicubic": InterpolationMode.BICUBIC,
+    "nearest": InterpolationMode.NEAREST,
+}
+
+
+def frames_to_uint8(frames):
+    """Decoded ``T x H x W x C`` frames (ndarray or list of PIL images) to a
+    uint8 ``T x C x H x W`` tensor."""
+    if isinstance(frames, (list, tuple)):
+        frames = np.stack([np.asarray(f) for f in frames])
+    return torch.from_numpy(np.ascontiguousarray(frames)).permute(0, 3, 1, 2)
+
+
+def resize_short_side(video, size, interpolation="bilinear", antialias=True):
+    return TF.resize(
+        video, size, interpolation=_INTERP[interpolation], antialias=antialias
+    )
+
+
+def center_crop(video, size):
+    return TF.center_crop(video, [size, size])
+
+
+def random_resized_crop(video, size, scale, ratio):
+    """Same box distribution as ``video_transforms.random_resized_crop``, one
+    box for all frames."""
+    height, width = video.shape[-2:]
+    i, j, h, w = _get_param_spatial_crop(scale, ratio, height, width)
+    return TF.resized_crop(
+        video,
+        i,
+        j,
+        h,
+        w,
+        [size, size],
+        interpolation=InterpolationMode.BILINEAR,
+        antialias=False,
+    )
+
+
+def random_horizontal_flip(video, prob=0.5):
+    if np.random.uniform() < prob:
+        video = video.flip(-1)
+    return video
+
+
+def normalize_video(video, mean, std):
+    """uint8 clip(s) with channels at dim -4 (``C x T x H x W`` or
+    ``B x C x T x H x W``) to normalised float; float input is returned as is."""
+    if video.dtype != torch.uint8:
+        return video
+    mean = torch.as_tensor(mean, device=video.device).view(-1, 1, 1, 1) * 255.0
+    std = torch.as_tensor(std, device=video.device).view(-1, 1, 1, 1) * 255.0
+    return (video.float() - mean) / std
+
+
+def _normalize_clips(clips, mean, std):
+    # video_num_sample > 1: one collated tensor per repeated augmentation
+    if isinstance(clips, (list, tuple)):
+        return [_normalize_clips(c, mean, std) for c in clips]
+    if torch.is_tensor(clips):
+        return normalize_video(clips, mean, std)
+    return clips
+
+
+def normalize_video_batch(batch, mean, std, key="video"):
+    """``normalize_video`` on the clips of a collated batch: ``batch[key]`` of
+    a dict, or the first field of the (clips, targets, ...) batches of the
+    classification datasets."""
+    if isinstance(batch, dict):
+        if key in batch:
+            batch[key] = _normalize_clips(batch[key], mean, std)
+    elif isinstance(batch, (list, tuple)) and len(batch) > 0:
+        batch = [_normalize_clips(batch[0], mean, std)] + list(batch[1:])
+    return batch
+
+
+def get_video_norm(dataset):
+    """(mean, std) of a dataset that emits uint8 clips, looking through wrappers."""
+    while dataset is not None:
+        if getattr(dataset, "video_norm", None) is not None:
+            return dataset.video_norm
+        dataset = getattr(dataset, "dataset", None)
+    return None
+
+
+class IPCStatsCollate:
+    """Log bytes per batch sent from a worker to the main process, and the
+    worker's samples/s."""
+
+    def __init__(self, collate_fn, log_freq, name=""):
+        self.collate_fn = collate_fn
+        self.log_freq = log_freq
+        self.name = name
+        self.n_batches = 0
+        self.n_samples = 0
+        self.n_bytes = 0
+        self._start = None
+
+    @staticmethod
+    def _nbytes(obj):
+        if isinstance(obj, torch.Tensor):
+            return obj.numel() * obj.element_size()
+        if isinstance(obj, dict):
+            return sum(IPCStatsCollate._nbytes(v) for v in obj.values())
+        if isinstance(obj, (list, tuple)):
+            return sum(IPCStatsCollate._nbytes(v) for v in obj)
+        return 0
+
+    def __call__(self, batch):
+        if self._start is None:
+            self._start = time.time()
+        out = self.collate_fn(batch)
+        self.n_batches += 1
+        self.n_samples += len(batch)
+        self.n_bytes += self._nbytes(out)
+        if self.n_batches % self.log_freq == 0:
+            info = torch.utils.data.get_worker_info()
+            worker_id = info.id if info is not None else -1
+            elapsed = max(time.time() - self._start, 1e-6)
+            print_log(
+                f"[{self.name} worker {worker_id}] "
+                f"{self.n_bytes / self.n_batches / 2**20:.1f} MB/batch, "
+                f"{self.n_samples / elapsed:.1f} samples/s",
+                "IPCStats",
+            )
+        return out
+
+
+def _check():
+    """``python -m datasets.Video.uint8_transforms``: uint8 clips come out
+    normalised, single tensors and the per-augmentation lists alike."""
+    mean, std = (0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)
+    clips = [torch.randint(0, 256, (2, 3, 4, 8, 8), dtype=torch.uint8) for _ in range(3)]
+    ref = [
+        (c.float() / 255 - torch.tensor(mean).view(-1, 1, 1, 1))
+        / torch.tensor(std).view(-1, 1, 1, 1)
+        for c in clips
+    ]
+    labels = torch.arange(2)
+
+    single = normalize_video_batch((clips[0], labels), mean, std)
+    assert torch.allclose(single[0], ref[0], atol=1e-5)
+    assert single[1] is labels
+    # video_num_sample > 1: (clip list, label list, index list, meta)
+    repeated = normalize_video_batch((clips, [labels] * 3, [labels] * 3, {}), mean, std)
+    assert len(repeated[0]) == len(clips)
+    for out, r in zip(repeated[0], ref):
+        assert out.dtype == torch.float32 and torch.allclose(out, r, atol=1e-5)
+    assert repeated[1][0] is labels
+    batch = normalize_video_batch({"video": list(clips), "label": labels}, mean, std)
+    assert all(torch.allclose(o, r, atol=1e-5) for o, r in zip(batch["video"], ref))
+    # already float: untouched
+    assert normalize_video_batch((ref[0], labels), mean, std)[0] is ref[0]
+    print("[normalize_video_batch] ok")
+
+
+if __name__ == "__main__":
+    _check()
@@ -0,0 +1,290 @@
+"""
+Columnar annotation storage shared by the modality datasets.
+
+Annotations used to be kept as python lists of dicts. Every access from a
+forked DataLoader worker touches the refcount of those objects, which copies
+the underlying pages into the worker and makes RSS grow over the epoch. The
+containers here keep the same information in a handful of NumPy buffers
+(packed utf-8 bytes + offsets, CSR ragged arrays) so that reading a row never
+writes to shared memory.
+"""
+import json
+import os
+import numbers
+import time
+
+import numpy as np
+import torch
+
+from util.logger import print_log
+
+
+class StringArray:
+    """Immutable array of strings packed in a single utf-8 byte buffer.
+
+    Args:
+        strings (Iterable[str]): strings to pack.
+    """
+
+    def __init__(self, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        lengths = np.fromiter((len(b) for b in encoded), dtype=np.int64, count=len(encoded))
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.buffer[start:end].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def nbytes(self):
+        return self.buffer.nbytes + self.offsets.nbytes
+
+
+class RaggedArray:
+    """CSR-style ragged array: row ``i`` is ``values[offsets[i]:offsets[i + 1]]``.
+
+    ``values`` is either a NumPy array (numeric rows, returned as read-only
+    views) or a :class:`StringArray` (string rows, returned as lists).
+    """
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, rows, dtype=None):
+        lengths = np.fromiter((len(r) for r in rows), dtype=np.int64, count=len(rows))
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = [v for r in rows for v in r]
+        if dtype is str:
+            values = StringArray(flat)
+        else:
+            values = np.asarray(flat, dtype=dtype)
+            values.setflags(write=False)
+        return cls(values, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        if isinstance(self.values, StringArray):
+            return [self.values[j] for j in range(start, end)]
+        return self.values[start:end]
+
+    def row_lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.offsets.nbytes
+
+
+class JsonArray(StringArray):
+    """Fallback column for values without a fixed type (dicts, None, mixed)."""
+
+    def __init__(self, values):
+        super().__init__(json.dumps(v) for v in values)
+
+    def __getitem__(self, index):
+        return json.loads(super().__getitem__(index))
+
+
+def _is_int(v):
+    return isinstance(v, numbers.Integral) and not isinstance(v, (bool, np.bool_))
+
+
+def _is_float(v):
+    return isinstance(v, numbers.Real) and not isinstance(v, (bool, np.bool_))
+
+
+def _scalar_dtype(values):
+    if all(isinstance(v, (bool, np.bool_)) for v in values):
+        return np.bool_
+    if all(_is_int(v) for v in values):
+        return np.int64
+    if all(_is_float(v) for v in values):
+        return np.float64
+    if all(isinstance(v, str) for v in values):
+        return str
+    return None
+
+
+def build_column(values):
+    """Pick the most compact fork-safe container for a list of python values."""
+    values = list(values)
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    dtype = _scalar_dtype(values)
+    if dtype is str:
+        return StringArray(values)
+    if dtype is not None:
+        column = np.asarray(values, dtype=dtype)
+        column.setflags(write=False)
+        return column
+
+    if all(isinstance(v, (list, tuple)) for v in values):
+        flat = [x for v in values for x in v]
+        item_dtype = _scalar_dtype(flat) if len(flat) > 0 else np.int64
+        if item_dtype is not None:
+            return RaggedArray.from_lists(values, dtype=item_dtype)
+
+    return JsonArray(values)
+
+
+def _to_python(v):
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+class ColumnarAnnotation:
+    """Column store for a list of annotation records.
+
+    ``annotation[i]`` returns a fresh dict for record ``i`` so existing
+    ``ann["key"]`` code keeps working, while ``annotation.column("key")``
+    gives direct access to the underlying array for vectorised use.
+    Records missing a key get ``None`` for that key.
+
+    Args:
+        records (list[dict] | pandas.DataFrame): annotation records.
+        columns (list[str], optional): keep only these keys.
+    """
+
+    def __init__(self, records, columns=None):
+        if hasattr(records, "to_dict") and hasattr(records, "columns"):
+            records = records.to_dict("records")
+        records = list(records)
+
+        if columns is None:
+            columns = []
+            for record in records:
+                for key in record:
+                    if key not in columns:
+                        columns.append(key)
+
+        self._len = len(records)
+        self._columns = {}
+        for key in columns:
+            self._columns[key] = build_column(
+                _to_python(record.get(key)) for record in records
+            )
+        del records
+
+    @classmethod
+    def from_columns(cls, length, **columns):
+        obj = cls.__new__(cls)
+        obj._len = length
+        obj._columns = dict(columns)
+        return obj
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def keys(self):
+        return list(self._columns.keys())
+
+    def column(self, key):
+        return self._columns[key]
+
+    def add_column(self, key, column):
+        assert len(column) == self._len, f"column {key} has wrong length"
+        self._columns[key] = column
+
+    def get(self, index, key, default=None):
+        if key not in self._columns:
+            return default
+        return _to_python(self._columns[key][index])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._len
+        if index < 0 or index >= self._len:
+            raise IndexError(f"annotation index {index} out of range")
+        return {key: _to_python(col[index]) for key, col in self._columns.items()}
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self[i]
+
+    @property
+    def nbytes(self):
+        return sum(
+            c.nbytes for c in self._columns.values() if hasattr(c, "nbytes")
+        )
+
+
+def encode_label_strings(label_strings, index_dict, sep=","):
+    """Turn ``"/m/a,/m/b"`` style label strings into a CSR array of class ids.
+
+    Splitting and dict lookups happen once at dataset construction instead of
+    on every ``__getitem__``.
+    """
+    rows = [
+        [int(index_dict[s]) for s in labels.split(sep)] for labels in label_strings
+    ]
+    return RaggedArray.from_lists(rows, dtype=np.int64)
+
+
+def get_rss_mb():
+    """Resident set size of the current process in MB."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class WorkerMemoryCollate:
+    """Wrap a collate_fn and log per-worker RSS every ``log_freq`` batches.
+
+    Runs inside the DataLoader workers, so the reported numbers (and the
+    growth since the worker's first batch) show whether annotation pages are
+    being copied on access.
+    """
+
+    def __init__(self, collate_fn, log_freq, name=""):
+        self.collate_fn = collate_fn
+        self.log_freq = log_freq
+        self.name = name
+        self._calls = 0
+        self._base_rss = None
+        self._start = None
+
+    def __call__(self, batch):
+        out = self.collate_fn(batch)
+        if self.log_freq > 0:
+            if self._base_rss is None:
+                self._base_rss = get_rss_mb()
+                self._start = time.time()
+            self._calls += 1
+            if self._calls % self.log_freq == 0:
+                info = torch.utils.data.get_worker_info()
+                worker_id = info.id if info is not None else -1
+                rss = get_rss_mb()
+                print_log(
+                    f"[{self.name}] worker {worker_id} batches {self._calls} "
+                    f"rss {rss:.1f}MB (+{rss - self._base_rss:.1f}MB in "
+                    f"{time.time() - self._start:.0f}s)",
+                    "WorkerMemory",
+                )
+        return out
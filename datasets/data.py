@@ -6,8 +6,13 @@ import os
 import random
 # from re import template
 import sys
+import time
+import queue
+import threading
 import braceexpand
+from collections import deque
 from dataclasses import dataclass
+from functools import partial
 from multiprocessing import Value
 
 import numpy as np
@@ -39,6 +44,12 @@ except ImportError:
     hvd = None
 from easydict import EasyDict as edict
 from datasets.Sample import BatchCollator, Sample, SampleList, SampleCollator
+from datasets.annotation import WorkerMemoryCollate
+from datasets.fast_collate import ColumnarCollate, benchmark_collate
+from datasets.image_manifest import load_manifest, save_manifest, draft_pil_loader, benchmark_decode
+from datasets.modal_audio.spec_augment import BatchAugmentCollate
+from datasets.modal_audio.length_bucket import AudioLengthCollate, LengthBucketSampler
+from datasets.Video.uint8_transforms import normalize_video_batch, get_video_norm, IPCStatsCollate
 from datasets.modal_audio.datasets import create_audio_datasets
 from datasets.modal_3d.datasets import Dataset_3D
 from datasets.modal_depth.datasets import create_rgbd_dataset
@@ -52,7 +63,37 @@ from datasets.zero_shot_metadata import OPENAI_IMAGENET_TEMPLATES, IMAGENET_CLAS
 
 
 class ImageFolder_Sampler(datasets.ImageFolder):
-    
+    """ImageFolder with an optional cached file manifest (``manifest_dir``)
+    instead of the directory walk, and JPEG draft decode (``draft_size``)."""
+
+    def __init__(self, root, transform=None, manifest_dir=None, draft_size=None):
+        start = time.time()
+        loader = (
+            partial(draft_pil_loader, draft_size=draft_size)
+            if draft_size
+            else datasets.folder.default_loader
+        )
+        manifest = load_manifest(root, manifest_dir) if manifest_dir else None
+        if manifest is None:
+            super().__init__(root, transform=transform, loader=loader)
+            source = "walk"
+            if manifest_dir and get_rank() == 0:
+                save_manifest(root, self.classes, self.samples, manifest_dir)
+        else:
+            datasets.VisionDataset.__init__(self, root, transform=transform)
+            self.loader = loader
+            self.extensions = datasets.folder.IMG_EXTENSIONS
+            self.classes, self.samples = manifest
+            self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+            self.targets = self.samples.labels
+            self.imgs = self.samples
+            source = "manifest"
+        print_log(
+            f"[ImageFolder] {root}: {len(self.samples)} images, {len(self.classes)} classes "
+            f"from {source} in {time.time() - start:.1f}s",
+            "ImageFolder",
+        )
+
     # 重载 __getitem__ 函数来包含文件路径
     def __getitem__(self, index):
         image, target = super().__getitem__(index)
@@ -72,23 +113,116 @@ class ImageFolder_Sampler(datasets.ImageFolder):
 
 
 
+def _tensor_paths(batch, prefix=()):
+    """Paths (tuples of keys / list indices) to every tensor in ``batch``,
+    walking dicts (``Sample``/``SampleList`` included) and lists like
+    ``apply_to_sample`` does. Lists without tensors (captions) are skipped
+    after their first element."""
+    paths = []
+    if torch.is_tensor(batch):
+        paths.append(prefix)
+    elif isinstance(batch, dict):
+        for key, value in batch.items():
+            paths.extend(_tensor_paths(value, prefix + (key,)))
+    elif isinstance(batch, list):
+        if len(batch) > 0 and isinstance(batch[0], str):
+            return paths
+        for i, value in enumerate(batch):
+            paths.extend(_tensor_paths(value, prefix + (i,)))
+    return paths
+
+
+def _get_path(batch, path):
+    for key in path:
+        batch = batch[key]
+    return batch
+
+
+def _set_path(batch, path, value):
+    for key in path[:-1]:
+        batch = batch[key]
+    batch[path[-1]] = value
+
+
+def _structure_key(batch):
+    if isinstance(batch, dict):
+        return (type(batch), tuple(batch.keys()))
+    if isinstance(batch, list):
+        return (list, len(batch))
+    return (type(batch),)
+
+
+class PinnedRing:
+    """``depth + 1`` slots of reusable pinned host buffers, one per tensor
+    path; a slot is reused once the copy that read it has finished."""
+
+    def __init__(self, depth):
+        self.slots = [dict() for _ in range(depth + 1)]
+        self.events = [None for _ in range(depth + 1)]
+        self.index = 0
+
+    def stage(self, paths, leaves):
+        slot = self.slots[self.index]
+        if self.events[self.index] is not None:
+            self.events[self.index].synchronize()
+        staged = []
+        for path, t in zip(paths, leaves):
+            if t.device.type != "cpu" or t.is_pinned():
+                staged.append(t)
+                continue
+            buf = slot.get(path)
+            if buf is None or buf.shape != t.shape or buf.dtype != t.dtype:
+                buf = torch.empty(t.shape, dtype=t.dtype, pin_memory=True)
+                slot[path] = buf
+            buf.copy_(t)
+            staged.append(buf)
+        return staged
+
+    def release(self, event):
+        self.events[self.index] = event
+        self.index = (self.index + 1) % len(self.slots)
+
+
+def make_collate(args, dataset_type):
+    if getattr(args, "columnar_collate", False):
+        return ColumnarCollate(dataset_type)
+    return BatchCollator(dataset_type=dataset_type)
+
+
 class PrefetchLoader(object):
     """
     Modified from https://github.com/ChenRocks/UNITER.
 
     overlap compute and cuda data transfer
     (copied and then modified from nvidia apex)
+
+    Keeps ``depth`` batches in flight. On CUDA, the tensors of a batch are
+    staged in a pinned host ring (skipped for tensors the DataLoader already
+    pinned) and copied non-blocking on a side stream. On CPU, batches are
+    read ahead by a thread, or passed through when ``depth == 0``. The tensor
+    positions of a batch are computed once per batch structure.
     """
 
-    def __init__(self, loader):
+    def __init__(self, loader, video_norm=None, depth=1, device=None):
         self.loader = loader
-        self.stream = torch.cuda.Stream()
+        self.depth = depth
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == "cuda"
+        self.stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        # (mean, std) of uint8 video clips, normalised here after the copy
+        self.video_norm = video_norm
+        self._paths = {}
 
     def __iter__(self):
-        loader_it = iter(self.loader)
-        self.preload(loader_it)
-        batch = self.next(loader_it)
-        while batch is not None:
+        if self.use_cuda:
+            batches = self._iter_cuda()
+        elif self.depth > 0:
+            batches = self._iter_threaded()
+        else:
+            batches = (self._finish(b) for b in self.loader)
+        for batch in batches:
             is_tuple = isinstance(batch, tuple)
             if is_tuple:
                 task, batch = batch
@@ -97,44 +231,100 @@ class PrefetchLoader(object):
                 yield task, batch
             else:
                 yield batch
-            batch = self.next(loader_it)
 
     def __len__(self):
         return len(self.loader)
 
-    def preload(self, it):
-        try:
-            self.batch = next(it)
-        except StopIteration:
-            self.batch = None
-            return
-        # if record_stream() doesn't work, another option is to make sure
-        # device inputs are created on the main stream.
-        # self.next_input_gpu = torch.empty_like(self.next_input,
-        #                                        device='cuda')
-        # self.next_target_gpu = torch.empty_like(self.next_target,
-        #                                         device='cuda')
-        # Need to make sure the memory allocated for next_* is not still in use
-        # by the main stream at the time we start copying to next_*:
-        # self.stream.wait_stream(torch.cuda.current_stream())
-        with torch.cuda.stream(self.stream):
-            self.batch = move_to_cuda(self.batch)
-            # more code for the alternative if record_stream() doesn't work:
-            # copy_ will record the use of the pinned source tensor in this
-            # side stream.
-            # self.next_input_gpu.copy_(self.next_input, non_blocking=True)
-            # self.next_target_gpu.copy_(self.next_target, non_blocking=True)
-            # self.next_input = self.next_input_gpu
-            # self.next_target = self.next_target_gpu
-
-    def next(self, it):
-        torch.cuda.current_stream().wait_stream(self.stream)
-        batch = self.batch
-        if batch is not None:
-            record_cuda_stream(batch)
-        self.preload(it)
+    def leaves(self, batch):
+        key = _structure_key(batch)
+        paths = self._paths.get(key)
+        if paths is not None:
+            try:
+                leaves = [_get_path(batch, p) for p in paths]
+                if all(torch.is_tensor(t) for t in leaves):
+                    return paths, leaves
+            except (KeyError, IndexError, TypeError):
+                pass
+        paths = _tensor_paths(batch)
+        self._paths[key] = paths
+        return paths, [_get_path(batch, p) for p in paths]
+
+    def _finish(self, batch):
+        if self.video_norm is not None:
+            batch = normalize_video_batch(batch, *self.video_norm)
         return batch
 
+    def _copy(self, batch, ring):
+        paths, leaves = self.leaves(batch)
+        staged = ring.stage(paths, leaves)
+        with torch.cuda.stream(self.stream):
+            moved = [t.to(self.device, non_blocking=True) for t in staged]
+            for path, t in zip(paths, moved):
+                _set_path(batch, path, t)
+            batch = self._finish(batch)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        ring.release(event)
+        return batch, event
+
+    def _iter_cuda(self):
+        depth = max(self.depth, 1)
+        ring = PinnedRing(depth)
+        in_flight = deque()
+        loader_it = iter(self.loader)
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < depth:
+                try:
+                    in_flight.append(self._copy(next(loader_it), ring))
+                except StopIteration:
+                    exhausted = True
+            if not in_flight:
+                return
+            batch, event = in_flight.popleft()
+            torch.cuda.current_stream(self.device).wait_event(event)
+            # the copies were allocated on the side stream
+            for t in self.leaves(batch)[1]:
+                t.record_stream(torch.cuda.current_stream(self.device))
+            yield batch
+
+    def _iter_threaded(self):
+        done = object()
+        q = queue.Queue(maxsize=self.depth)
+        # set when the consumer stops early, the producer then drops the
+        # loader iterator (and its workers) instead of blocking in put
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if not put(self._finish(batch)):
+                        return
+            except Exception as e:
+                put(e)
+            put(done)
+
+        threading.Thread(target=produce, daemon=True).start()
+        try:
+            while True:
+                batch = q.get()
+                if batch is done:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+
     def __getattr__(self, name):
         method = self.loader.__getattribute__(name)
         return method
@@ -223,7 +413,9 @@ class DataInfo:
     def set_epoch(self, epoch):
         if self.shared_epoch is not None:
             self.shared_epoch.set_value(epoch)
-        if self.sampler is not None and isinstance(self.sampler, DistributedSampler):
+        if self.sampler is not None and isinstance(
+            self.sampler, (DistributedSampler, LengthBucketSampler, SubDatasetSampler)
+        ):
             self.sampler.set_epoch(epoch)
     
 
@@ -779,13 +971,20 @@ def get_joint_data(args, epoch=0, tokenizer=None, image_transform=None, logger=N
     if "image" in args.train_modal_list:
         image_data_path = os.path.join(args.img_data_path, "train")
         image_train_dataset = ImageFolder_Sampler(
-            image_data_path, transform=transform_train
+            image_data_path,
+            transform=transform_train,
+            manifest_dir=args.img_manifest_dir,
+            draft_size=args.img_draft_size,
         )
+        if args.img_decode_benchmark > 0 and rank == 0:
+            benchmark_decode(
+                image_train_dataset, args.img_decode_benchmark, args.img_draft_size
+            )
 
     if "image" in args.eval_modal_list:
         image_data_path = os.path.join(args.img_data_path, "val")
         image_val_dataset = ImageFolder_Sampler(
-            image_data_path, transform=transform_val
+            image_data_path, transform=transform_val, manifest_dir=args.img_manifest_dir
         )
         
         image_val_sampler = DistributedSampler(image_val_dataset) if args.distributed else None
@@ -800,7 +999,7 @@ def get_joint_data(args, epoch=0, tokenizer=None, image_transform=None, logger=N
             drop_last=False,
             collate_fn=image_val_dataset.collater
                     if hasattr(image_val_dataset, "collator")
-                    else BatchCollator(dataset_type="val"),
+                    else make_collate(args, "val"),
         )
         image_val_dataloader.num_samples = len(image_val_dataset)
         image_val_dataloader.num_batches = len(image_val_dataloader)
@@ -855,7 +1054,7 @@ def get_joint_data(args, epoch=0, tokenizer=None, image_transform=None, logger=N
                     drop_last=False,
                     collate_fn=dset.collater
                     if hasattr(dset, "collator")
-                    else BatchCollator(dataset_type="val"),
+                    else make_collate(args, "val"),
                 )
                 dloader.num_samples = num_samples
                 dloader.num_batches = len(dloader)
@@ -878,7 +1077,7 @@ def get_joint_data(args, epoch=0, tokenizer=None, image_transform=None, logger=N
                 drop_last=False,
                 collate_fn=audio_val_dataset.collater
                 if hasattr(audio_val_dataset, "collator")
-                else BatchCollator(dataset_type="val"),
+                else make_collate(args, "val"),
             )
             dataloader.num_samples = num_samples
             dataloader.num_batches = len(dataloader)
@@ -928,7 +1127,7 @@ def get_joint_data(args, epoch=0, tokenizer=None, image_transform=None, logger=N
                 drop_last=False,
                 collate_fn=point_val_dataset.collater
                 if hasattr(point_val_dataset, "collator")
-                else BatchCollator(dataset_type="val"),
+                else make_collate(args, "val"),
             )
             dataloader.num_samples = num_samples
             dataloader.num_batches = len(dataloader)
@@ -979,7 +1178,7 @@ def get_joint_data(args, epoch=0, tokenizer=None, image_transform=None, logger=N
                     drop_last=False,
                     collate_fn=dset.collater
                     if hasattr(dset, "collator")
-                    else BatchCollator(dataset_type="val"),
+                    else make_collate(args, "val"),
                 )
                 dloader.num_samples = num_samples
                 dloader.num_batches = len(dloader)
@@ -1001,7 +1200,7 @@ def get_joint_data(args, epoch=0, tokenizer=None, image_transform=None, logger=N
                 drop_last=False,
                 collate_fn=rgbd_val_dataset.collater
                 if hasattr(rgbd_val_dataset, "collator")
-                else BatchCollator(dataset_type="val"),
+                else make_collate(args, "val"),
             )
             dataloader.num_samples = num_samples
             dataloader.num_batches = len(dataloader)
@@ -1032,8 +1231,10 @@ def get_joint_data(args, epoch=0, tokenizer=None, image_transform=None, logger=N
         if 'msrvtt' in args.video_val_data:
             video_val_dataset = dataloader_msrvtt_test(args,tokenizer)
         else:
+            # --video_test_multi_view: test mode, all segment x crop views
+            # of a video from one decode, scores averaged in the evaluator
             video_val_dataset, _ = build_video_dataset(
-                is_train=False, test_mode=False, args=args
+                is_train=False, test_mode=args.video_test_multi_view, args=args
             )
         
         num_samples = len(video_val_dataset)
@@ -1049,7 +1250,7 @@ def get_joint_data(args, epoch=0, tokenizer=None, image_transform=None, logger=N
             drop_last=False,
             collate_fn=rgbd_val_dataset.collater
                 if hasattr(video_val_dataset, "collator")
-                else BatchCollator(dataset_type="val"),
+                else make_collate(args, "val"),
         )
         dataloader.num_samples = num_samples
         dataloader.num_batches = len(dataloader)
@@ -1134,6 +1335,52 @@ def get_joint_data(args, epoch=0, tokenizer=None, image_transform=None, logger=N
             drop_last=True,
         )
 
+        collate_fn = (
+            dataset_list[i].collater
+            if hasattr(dataset_list[i], "collator")
+            else make_collate(args, "train")
+        )
+        if args.collate_benchmark > 0 and rank == 0:
+            benchmark_collate(
+                dataset_list[i],
+                real_batch_size[i],
+                args.collate_benchmark,
+                name=args.train_modal_list[i],
+                logger=logger,
+            )
+        if (
+            args.train_modal_list[i] == "audio"
+            and args.audio_length_buckets
+            and hasattr(dataset_list[i], "frame_lengths")
+        ):
+            subsampler = LengthBucketSampler(
+                subsampler,
+                dataset_list[i].frame_lengths(),
+                real_batch_size[i],
+                args.audio_length_buckets,
+                seed=args.seed,
+            )
+            # crop before batch augmentation so masking only sees the kept frames
+            collate_fn = AudioLengthCollate(collate_fn, key="audio")
+            print_log(
+                f"Length-bucketed audio batches, boundaries {subsampler.boundaries}",
+                logger=logger,
+            )
+        # DatasetSampleWrapper (distillation) keeps the audio dataset in .dataset
+        batch_augment = getattr(
+            getattr(dataset_list[i], "dataset", dataset_list[i]), "batch_augment", None
+        )
+        if batch_augment is not None:
+            collate_fn = BatchAugmentCollate(collate_fn, batch_augment, key="audio")
+        if args.log_worker_rss > 0:
+            collate_fn = WorkerMemoryCollate(
+                collate_fn, args.log_worker_rss, name=args.train_modal_list[i]
+            )
+        if args.log_ipc_freq > 0:
+            collate_fn = IPCStatsCollate(
+                collate_fn, args.log_ipc_freq, name=args.train_modal_list[i]
+            )
+
         loader = torch.utils.data.DataLoader(
             dataset_list[i],
             sampler=subsampler,
@@ -1141,30 +1388,56 @@ def get_joint_data(args, epoch=0, tokenizer=None, image_transform=None, logger=N
             num_workers=args.num_workers,
             pin_memory=args.pin_mem,
             drop_last=True,
-            
-            collate_fn=dataset_list[i].collater
-                if hasattr(dataset_list[i], "collator")
-                else BatchCollator(dataset_type="train"),
+            collate_fn=collate_fn,
         )
 
         loader.num_samples = subsampler.total_size
         loader.num_batches = len(loader)
 
-        loader = PrefetchLoader(loader)
+        loader = PrefetchLoader(
+            loader, video_norm=get_video_norm(dataset_list[i]), depth=args.prefetch_depth
+        )
 
         train_loaders.append(DataInfo(loader, subsampler))
 
-    data["train"] = MultiLoader(args.train_modal_list, *train_loaders)
+    data["train"] = MultiLoader(
+        args.train_modal_list, *train_loaders, ready_depth=args.multiloader_depth
+    )
 
     return data, eff_batch_size, real_batch_size
 
 
+_EXHAUSTED = object()
+
+
 class MultiLoader:
-    def __init__(self, modality_list, *datainfo):
+    """Alternate batches of the per-modality loaders.
+
+    With ``ready_depth == 0`` the loaders are walked strictly round-robin.
+    With ``ready_depth > 0`` every loader is drained by a thread into a queue
+    of ``ready_depth`` batches, and each round of ``len(loaders)`` batches
+    hands out whichever modality of the round is ready first. Every round
+    still holds one batch per modality, which is what the accumulation
+    windows of ``train_one_epoch_concat`` index by.
+    """
+
+    def __init__(self, modality_list, *datainfo, ready_depth=0):
         self.datainfo = datainfo
         self.loaders = [d.dataloader for d in datainfo]
-        self.iterators = [iter(loader) for loader in self.loaders]
+        self.ready_depth = ready_depth
+        self.threads = None
+        self.iterators = (
+            [iter(loader) for loader in self.loaders] if ready_depth == 0 else []
+        )
         self.current_loader_idx = 0
+        # seconds the training loop waited for every modality, and batches served
+        self.wait_time = [0.0 for _ in self.loaders]
+        self.wait_count = [0 for _ in self.loaders]
+        self.epoch = 0
+        # batches taken from every loader this epoch, for mid-epoch resume
+        self.consumed = [0 for _ in self.loaders]
+        self.start_step = 0
+        self._resume_state = None
         self.modality_list = modality_list
         self.datasets = {}
         for i, modal in enumerate(modality_list):
@@ -1177,9 +1450,13 @@ class MultiLoader:
         return self
 
     def __next__(self):
+        if self.ready_depth > 0:
+            return self._next_ready()
+
         if not self.iterators:
             raise StopIteration
 
+        start = time.time()
         current_iterator = self.iterators[self.current_loader_idx]
         
         try:
@@ -1193,17 +1470,150 @@ class MultiLoader:
             batch = next(current_iterator)
 
         current_modal = self.modality_list[self.current_loader_idx]
+        self.consumed[self.current_loader_idx] += 1
+        self.wait_time[self.current_loader_idx] += time.time() - start
+        self.wait_count[self.current_loader_idx] += 1
         
         self.current_loader_idx = (self.current_loader_idx + 1) % len(self.loaders)
 
         return batch, current_modal
 
+    def _start_threads(self):
+        device = torch.cuda.current_device() if torch.cuda.is_available() else None
+        self._stop = threading.Event()
+        self._ready = threading.Condition()
+        self.queues = [queue.Queue(maxsize=self.ready_depth) for _ in self.loaders]
+        self.active = [True for _ in self.loaders]
+        self.pending = []
+        self.threads = []
+        for i, loader in enumerate(self.loaders):
+            thread = threading.Thread(
+                target=self._produce, args=(i, loader, device), daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def _stop_threads(self):
+        if self.threads is None:
+            return
+        self._stop.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = None
+
+    def _put(self, i, item):
+        while not self._stop.is_set():
+            try:
+                self.queues[i].put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            with self._ready:
+                self._ready.notify()
+            return True
+        return False
+
+    def _produce(self, i, loader, device):
+        # the PrefetchLoader copies on the current device, which is per thread
+        if device is not None:
+            torch.cuda.set_device(device)
+        try:
+            for batch in loader:
+                if not self._put(i, batch):
+                    return
+            self._put(i, _EXHAUSTED)
+        except Exception as e:
+            self._put(i, e)
+
+    def _next_ready(self):
+        if self.threads is None:
+            self._start_threads()
+        start = time.time()
+        while True:
+            with self._ready:
+                while True:
+                    if not self.pending:
+                        # new round, resumed rounds start at current_loader_idx
+                        order = list(range(self.current_loader_idx, len(self.loaders)))
+                        order += list(range(self.current_loader_idx))
+                        self.current_loader_idx = 0
+                        self.pending = [i for i in order if self.active[i]]
+                        if not self.pending:
+                            raise StopIteration
+                    ready = [i for i in self.pending if not self.queues[i].empty()]
+                    if ready:
+                        break
+                    self._ready.wait(timeout=0.1)
+            i = ready[0]
+            item = self.queues[i].get_nowait()
+            if item is _EXHAUSTED:
+                self.active[i] = False
+                self.pending.remove(i)
+                continue
+            if isinstance(item, Exception):
+                raise item
+            break
+
+        self.pending.remove(i)
+        self.consumed[i] += 1
+        self.wait_time[i] += time.time() - start
+        self.wait_count[i] += 1
+        return item, self.modality_list[i]
+
+    def report_wait(self, logger=None):
+        total = max(sum(self.wait_time), 1e-9)
+        for i, modal in enumerate(self.modality_list):
+            n = max(self.wait_count[i], 1)
+            print_log(
+                f"[MultiLoader] {modal}: data wait {self.wait_time[i]:.1f}s "
+                f"({self.wait_time[i] / n * 1000:.1f} ms/batch, "
+                f"{self.wait_time[i] / total * 100:.0f}% of the wait)",
+                logger=logger,
+            )
+
+    @staticmethod
+    def _batch_size(loader):
+        return getattr(loader, "loader", loader).batch_size
+
+    def state_dict(self):
+        """Position in the current epoch. The samplers get the number of
+        indices actually consumed, not the (prefetched) number they yielded."""
+        return {
+            "epoch": self.epoch,
+            "current_loader_idx": self.current_loader_idx,
+            "consumed": list(self.consumed),
+            "samplers": [
+                d.sampler.state_dict(n * self._batch_size(d.dataloader))
+                if hasattr(d.sampler, "state_dict")
+                else None
+                for d, n in zip(self.datainfo, self.consumed)
+            ],
+        }
+
+    def load_state_dict(self, state):
+        # applied by the next set_epoch(state["epoch"])
+        self._resume_state = state
+
     def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._stop_threads()
         self.current_loader_idx = 0
+        self.consumed = [0 for _ in self.loaders]
+        self.start_step = 0
+        self.wait_time = [0.0 for _ in self.loaders]
+        self.wait_count = [0 for _ in self.loaders]
+        state, self._resume_state = self._resume_state, None
+        if state is not None and state["epoch"] == epoch:
+            for data_info, sampler_state in zip(self.datainfo, state["samplers"]):
+                if sampler_state is not None:
+                    data_info.sampler.load_state_dict(sampler_state)
+            self.current_loader_idx = state["current_loader_idx"]
+            self.consumed = list(state["consumed"])
+            self.start_step = sum(self.consumed)
         self.iterators = []
         for data_info in self.datainfo:
             data_info.set_epoch(epoch)
-            self.iterators.append(iter(data_info.dataloader))
+            if self.ready_depth == 0:
+                self.iterators.append(iter(data_info.dataloader))
 
     def __len__(self):
         return sum([len(loader) for loader in self.loaders])
@@ -473,7 +473,60 @@ class ConcatDataset(Dataset):
         return self.cumulative_sizes
 
 
-class ConcatDatasetSampler(torch.utils.data.Sampler):
+def resample_indices(rng, num, repeat_factor, sample_weight=None, offset=0):
+    """``int(num * repeat_factor)`` indices in ``[offset, offset + num)`` drawn with
+    replacement (weighted by ``sample_weight`` if given), as an int64 array."""
+    new_size = int(num * repeat_factor)
+    if sample_weight is None:
+        indices = rng.integers(0, num, size=new_size, dtype=np.int64)
+    else:
+        p = np.asarray(sample_weight, dtype=np.float64)
+        indices = rng.choice(num, size=new_size, p=p / p.sum())
+    return indices + offset
+
+
+class ResumableSamplerMixin:
+    """Epoch + in-epoch position bookkeeping shared by the samplers below.
+
+    Indices are drawn from ``np.random.default_rng((seed, epoch))``, so the
+    order only depends on ``(seed, epoch)``; ``position`` counts the indices
+    handed out in the current epoch. ``load_state_dict`` makes the next
+    ``__iter__`` skip the first ``position`` indices of that epoch.
+    """
+
+    def _init_state(self):
+        self.position = 0
+        self.start_position = 0
+
+    def _rng(self):
+        return np.random.default_rng((self.seed, self.epoch))
+
+    def _iter_from(self, indices):
+        start, self.start_position = self.start_position, 0
+        self.position = start
+        for idx in indices[start:]:
+            self.position += 1
+            yield int(idx)
+
+    def state_dict(self, position=None):
+        """``position`` overrides the number of indices yielded so far, e.g.
+        with the number actually consumed when the DataLoader prefetches."""
+        return {
+            "epoch": self.epoch,
+            "seed": self.seed,
+            "position": self.position if position is None else int(position),
+        }
+
+    def load_state_dict(self, state):
+        self.epoch = state["epoch"]
+        self.seed = state["seed"]
+        self.start_position = state["position"]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+class ConcatDatasetSampler(ResumableSamplerMixin, torch.utils.data.Sampler):
     def __init__(
         self,
         datasets,
@@ -522,90 +575,51 @@ class ConcatDatasetSampler(torch.utils.data.Sampler):
             self.num_samples += int(self.subdataset_lens[i] / self.world_size)
             
             self.real_batch_size.append(real_ratio_batch)
-        
-        # if real_len % self.world_size != 0:  # type: ignore[arg-type]
-        #     # Split to nearest available length that is evenly divisible.
-        #     # This is to ensure each rank receives the same amount of data when
-        #     # using this Sampler.
-        #     self.num_samples = math.ceil(
-        #         (real_len - self.world_size) / self.world_size  # type: ignore[arg-type]
-        #     )
-        # else:
-        #     self.num_samples = math.ceil(real_len / self.world_size)  # type: ignore[arg-type]
-        # self.num_samples = int((real_len / self.world_size))
-
-    @staticmethod
-    def resample_list(train_indice, repeat_factor, sample_weight=None):
-        # 如果repeat_factor大于1，那么我们将扩大列表
-        # 如果repeat_factor小于1，那么我们将缩小列表
-        # 如果repeat_factor等于1，那么列表保持不变
-        new_size = int(len(train_indice) * repeat_factor)
-        new_train_indice = random.choices(
-            train_indice, weights=sample_weight, k=new_size
-        )
-        return new_train_indice
+        self._init_state()
 
-    def __iter__(self):
-        random.seed(self.seed + self.epoch)
+    def epoch_indices(self):
+        """All indices this rank sees in the current epoch, as one int64 array."""
+        rng = self._rng()
 
         batch_train_indices = []
-        num_batches = []
         for i in range(len(self.datasets.datasets)):
             if self.repeat_factors[i] > 0:
-                # get train_indices
                 start_idx = self.datasets.cumulative_sizes[i - 1] if i > 0 else 0
                 end_idx = self.datasets.cumulative_sizes[i]
-                train_indice = list(range(start_idx, end_idx))
-                # random.shuffle(train_indice)
-
-                resample_train_indice = self.resample_list(
-                    train_indice, self.repeat_factors[i], self.sample_weights[i]
+                resample_train_indice = resample_indices(
+                    rng,
+                    end_idx - start_idx,
+                    self.repeat_factors[i],
+                    self.sample_weights[i],
+                    offset=start_idx,
                 )
 
                 num_batch = int(len(resample_train_indice) / self.real_batch_size[i])
-
-                num_batches.append(num_batch)
-                # get batch indices for each rank
-                batch_train_indice = [
-                    resample_train_indice[
-                        batch * self.real_batch_size[i] : (batch + 1)
-                        * self.real_batch_size[i]
-                    ][self.rank_id :: self.world_size]
-                    for batch in range(num_batch)
-                ]
+                # (num_batch, real_batch_size) -> this rank's columns
+                batch_train_indice = resample_train_indice[
+                    : num_batch * self.real_batch_size[i]
+                ].reshape(num_batch, self.real_batch_size[i])[:, self.rank_id :: self.world_size]
                 batch_train_indices.append(batch_train_indice)
             else:
                 assert (
                     self.repeat_factors[i] == -1
                 ), "repetition factor must be > 0 or -1"
-        # min_num_batch = min(num_batches)
-        # train_indices_min = []
-
-        # for batch in range(min_num_batch):
-        #     for i in range(len(self.datasets.datasets)):
-        #         train_indices_min.extend(batch_train_indices[i][batch])
-
-        train_indices = []
-        # for dataset_iters in itertools.zip_longest(*batch_train_indices):
-        #     for dataset_iter in dataset_iters:
-        #         if dataset_iter is not None:
-        #             train_indices.extend(dataset_iter)
-        for dataset_iters in zip(*batch_train_indices):
-            for dataset_iter in dataset_iters:
-                if dataset_iter is not None:
-                    train_indices.extend(dataset_iter)
 
-        return iter(train_indices)
+        # interleave one batch of every dataset, stop at the shortest one
+        min_num_batch = min(len(b) for b in batch_train_indices)
+        return np.concatenate(
+            [b[:min_num_batch] for b in batch_train_indices], axis=1
+        ).reshape(-1)
 
-    def set_epoch(self, epoch):
-        self.epoch = epoch
+    def __iter__(self):
+        return self._iter_from(self.epoch_indices())
 
     def __len__(self):
         # 返回数据集中样本的数量
         return self.num_samples
 
 
-class SubDatasetSampler(torch.utils.data.Sampler):
+class SubDatasetSampler(ResumableSamplerMixin, torch.utils.data.Sampler):
     def __init__(
         self,
         dataset,
@@ -639,34 +653,18 @@ class SubDatasetSampler(torch.utils.data.Sampler):
         else:
             self.num_samples = math.ceil(real_len / self.world_size)  # type: ignore[arg-type]
         self.total_size = self.num_samples * self.world_size
-        
-
-    @staticmethod
-    def resample_list(train_indice, repeat_factor, sample_weight=None):
-        # 如果repeat_factor大于1，那么我们将扩大列表
-        # 如果repeat_factor小于1，那么我们将缩小列表
-        # 如果repeat_factor等于1，那么列表保持不变
-        new_size = int(len(train_indice) * repeat_factor)
-        new_train_indice = random.choices(
-            train_indice, weights=sample_weight, k=new_size
-        )
-        return new_train_indice
+        self._init_state()
 
-    def __iter__(self):
-        random.seed(self.seed + self.epoch)
-        train_indice = list(range(len(self.dataset)))
-
-        indices = self.resample_list(
-            train_indice, self.repeat_factors, self.sample_weights
+    def epoch_indices(self):
+        """All indices this rank sees in the current epoch, as one int64 array."""
+        indices = resample_indices(
+            self._rng(), len(self.dataset), self.repeat_factors, self.sample_weights
         )
 
         if not self.drop_last:
-            # add extra samples to make it evenly divisible
+            # add extra samples to make it evenly divisible (np.resize repeats)
             padding_size = self.total_size - len(indices)
-            if padding_size <= len(indices):
-                indices += indices[:padding_size]
-            else:
-                indices += (indices * math.ceil(padding_size / len(indices)))[:padding_size]
+            indices = np.concatenate([indices, np.resize(indices, padding_size)])
         else:
             # remove tail of data to make it evenly divisible.
             indices = indices[:self.total_size]
@@ -675,11 +673,10 @@ class SubDatasetSampler(torch.utils.data.Sampler):
         # subsample
         indices = indices[self.rank_id:self.total_size:self.world_size]
         assert len(indices) == self.num_samples
+        return indices
 
-        return iter(indices)
-
-    def set_epoch(self, epoch):
-        self.epoch = epoch
+    def __iter__(self):
+        return self._iter_from(self.epoch_indices())
 
     def __len__(self):
         return self.num_samples
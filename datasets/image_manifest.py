@@ -0,0 +1,160 @@
+"""File manifest and reduced-size JPEG decode for ImageFolder datasets.
+
+``torchvision.datasets.ImageFolder`` walks the whole directory tree on
+construction (1.28M files for ImageNet train), on every rank and every run.
+The manifest stores the walk result once as a single ``.npz`` (packed utf-8
+relative paths + offsets, int16 labels, class names), and keeps the samples
+in memory as NumPy buffers instead of a list of tuples.
+"""
+import os
+import time
+import hashlib
+import argparse
+
+import numpy as np
+from PIL import Image
+
+from datasets.annotation import StringArray
+from util.logger import print_log
+
+
+class ManifestSamples:
+    """``ImageFolder.samples`` look-alike: ``samples[i] -> (path, label)``."""
+
+    def __init__(self, root, paths, labels):
+        self.root = root
+        self.paths = paths
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        return os.path.join(self.root, self.paths[index]), int(self.labels[index])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def manifest_path(root, manifest_dir):
+    root = os.path.abspath(root)
+    key = hashlib.md5(root.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(manifest_dir, f"{os.path.basename(root)}_{key}.npz")
+
+
+def _pack(strings):
+    array = StringArray(strings)
+    return array.buffer, array.offsets
+
+
+def _unpack(buffer, offsets):
+    array = StringArray([])
+    array.buffer, array.offsets = buffer, offsets
+    return array
+
+
+def save_manifest(root, classes, samples, manifest_dir):
+    """Write the ``(path, label)`` list of an ImageFolder walk of ``root``."""
+    os.makedirs(manifest_dir, exist_ok=True)
+    path = manifest_path(root, manifest_dir)
+    root_abs = os.path.abspath(root)
+    rel_paths = [os.path.relpath(p, root_abs) for p, _ in samples]
+    path_buffer, path_offsets = _pack(rel_paths)
+    class_buffer, class_offsets = _pack(classes)
+    tmp = path + f".tmp{os.getpid()}.npz"
+    np.savez(
+        tmp,
+        path_buffer=path_buffer,
+        path_offsets=path_offsets,
+        labels=np.array([t for _, t in samples], dtype=np.int16),
+        class_buffer=class_buffer,
+        class_offsets=class_offsets,
+        root_mtime=np.array(os.path.getmtime(root_abs)),
+    )
+    # several ranks may write the same manifest: rename is atomic
+    os.replace(tmp, path)
+    return path
+
+
+def load_manifest(root, manifest_dir):
+    """``(classes, ManifestSamples)`` or None when there is no valid manifest.
+
+    A manifest is considered stale when the mtime of ``root`` changed (a class
+    directory was added or removed); files added inside a class directory are
+    not detected, delete the manifest to rebuild it.
+    """
+    path = manifest_path(root, manifest_dir)
+    if not os.path.exists(path):
+        return None
+    root_abs = os.path.abspath(root)
+    with np.load(path) as f:
+        if float(f["root_mtime"]) != os.path.getmtime(root_abs):
+            print_log(f"[Manifest] {path} is stale, walking {root}", "Manifest")
+            return None
+        classes = list(_unpack(f["class_buffer"], f["class_offsets"]))
+        paths = _unpack(f["path_buffer"], f["path_offsets"])
+        labels = f["labels"].astype(np.int64)
+    return classes, ManifestSamples(root_abs, paths, labels)
+
+
+def draft_pil_loader(path, draft_size=None):
+    """``torchvision`` pil_loader that lets libjpeg downscale in the DCT domain.
+
+    ``Image.draft`` picks the largest power-of-two reduction (up to 1/8) that
+    keeps both sides >= ``draft_size``, so it only kicks in when the source is
+    at least twice ``draft_size`` on its short side.
+    """
+    with open(path, "rb") as f:
+        img = Image.open(f)
+        if draft_size and img.format == "JPEG" and min(img.size) >= 2 * draft_size:
+            img.draft("RGB", (draft_size, draft_size))
+        return img.convert("RGB")
+
+
+def benchmark_decode(dataset, num_samples=512, draft_size=None, seed=0):
+    """Images/s of full-size decode versus draft decode on random samples of
+    an ImageFolder-like ``dataset``; transforms are not applied."""
+    rng = np.random.RandomState(seed)
+    indices = rng.choice(len(dataset), size=min(num_samples, len(dataset)), replace=False)
+    paths = [dataset.samples[i][0] for i in indices]
+    results = {}
+    for name, size in (("full", None), ("draft", draft_size)):
+        if name == "draft" and not size:
+            continue
+        start = time.time()
+        pixels = 0
+        for p in paths:
+            w, h = draft_pil_loader(p, size).size
+            pixels += w * h
+        elapsed = max(time.time() - start, 1e-6)
+        results[name] = len(paths) / elapsed
+        print_log(
+            f"[Decode] {name}: {len(paths) / elapsed:.1f} img/s, "
+            f"{pixels / len(paths) / 1e6:.2f} MP/img",
+            "Decode",
+        )
+    if "draft" in results:
+        print_log(f"[Decode] draft speed-up {results['draft'] / results['full']:.2f}x", "Decode")
+    return results
+
+
+def get_args():
+    parser = argparse.ArgumentParser("Build ImageFolder manifests")
+    parser.add_argument("--roots", type=str, nargs="+", required=True, help="ImageFolder roots")
+    parser.add_argument("--output", type=str, required=True, help="manifest dir")
+    parser.add_argument("--draft_size", type=int, default=None)
+    parser.add_argument(
+        "--benchmark", type=int, default=0, help="benchmark decode on N images after building"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from datasets.data import ImageFolder_Sampler
+
+    args = get_args()
+    for root in args.roots:
+        dataset = ImageFolder_Sampler(root, manifest_dir=args.output, draft_size=args.draft_size)
+        if args.benchmark > 0:
+            benchmark_decode(dataset, args.benchmark, args.draft_size)
@@ -16,6 +16,7 @@ from .io import IO
 
 # from open_clip.util.logger import *
 from datasets.Sample import Sample, SampleCollator
+from datasets.annotation import ColumnarAnnotation
 from datasets.util.build import DATASETS, build_dataset_from_cfg
 from datasets.constants import OBJAVERSE_DATA_DIR
 
@@ -28,6 +29,7 @@ from datasets.constants import PC_DATA_DIR, PC_META_DATA_DIR
 import logging
 from datasets.aug_random import np_random
 from util.logger import print_log
+from util.precision import get_policy
 
 pc_data_config = {
     "shapenet": {
@@ -532,7 +534,7 @@ class ModelNet(data.Dataset):
         if self.subset == "train":
             template_idx = random.randint(0, 59)
             text_feature = self.pc_text_features[label][template_idx].to(
-                dtype=torch.float16
+                dtype=get_policy().feature_dtype
             )
 
             rtn["text_feature"] = text_feature
@@ -755,11 +757,11 @@ class Objaverse_Lvis_Colored(data.Dataset):
             if isinstance(self.pc_text_features[label], dict):
                 text_feature = random.choice(self.pc_text_features[label])[
                     template_idx
-                ].to(dtype=torch.float16)
+                ].to(dtype=get_policy().feature_dtype)
 
             else:
                 text_feature = self.pc_text_features[label][template_idx].to(
-                    dtype=torch.float16
+                    dtype=get_policy().feature_dtype
                 )
 
         tokenized_caption = self.tokenizer([name])[0]
@@ -907,14 +909,21 @@ class ShapeNet(data.Dataset):
                 test_lines = f.readlines()
             print_log(f"[DATASET] Open file {test_data_list_file}", "ShapeNet")
             lines = test_lines + lines
-        self.file_list = []
+        file_list = []
         for line in lines:
             line = line.strip()
             taxonomy_id = line.split("-")[0]
             model_id = line[len(taxonomy_id) + 1 :].split(".")[0]
-            self.file_list.append(
+            file_list.append(
                 {"taxonomy_id": taxonomy_id, "model_id": model_id, "file_path": line}
             )
+        self.file_list = ColumnarAnnotation(file_list)
+        del file_list, lines
+        # precomputed class ids, avoids the taxonomy dict lookup per sample
+        self.label_ids = np.array(
+            [self.index_list[t] for t in self.file_list.column("taxonomy_id")],
+            dtype=np.int64,
+        )
         print_log(f"[DATASET] {len(self.file_list)} instances were loaded", "ShapeNet")
 
         self.permutation = np.arange(self.npoints)
@@ -1007,8 +1016,7 @@ class ShapeNet(data.Dataset):
             else:
                 data = torch.from_numpy(data).float()
 
-            index = self.index_list[sample["taxonomy_id"]]
-            label = torch.tensor(index)
+            label = torch.tensor(self.label_ids[idx])
 
             captions = self.synset_id_map[sample["taxonomy_id"]]["name"]
             captions = [
@@ -1044,7 +1052,7 @@ class ShapeNet(data.Dataset):
 
                 template_idx = random.randint(0, npy_text_features.shape[0] - 1)
                 text_feature = torch.from_numpy(npy_text_features[template_idx]).to(
-                    dtype=torch.float16
+                    dtype=get_policy().feature_dtype
                 )
 
             try:
@@ -18,6 +18,7 @@ from omegaconf import OmegaConf
 from easydict import EasyDict as edict
 
 from datasets.Sample import Sample, SampleCollator
+from datasets.annotation import ColumnarAnnotation, encode_label_strings
 from datasets.modal_audio.processors.at_processor import (
     PVProcessorTrain,
     PVProcessorEval,
@@ -27,9 +28,13 @@ from datasets.modal_audio.processors.at_processor import (
     CLAPProcessprEval,
     BlipCaptionProcessor,
 )
+from datasets.modal_audio.fbank_cache import FbankCache
+from datasets.modal_audio.spec_augment import BatchSpecAugment
+from datasets.modal_audio.length_bucket import clip_frame_lengths
 from datasets.modal_audio.data.sound_cls_template import SOUND_AS_IMAGE_TEMPLATE
 from datasets.constants import AUDIO_DATA_DIR, AUDIO_META_DATA_DIR
 from util.logger import print_log
+from util.precision import get_policy
 
 norm_stats = {
     "audioset": [-4.2677393, 4.5689974],
@@ -43,6 +48,10 @@ target_length = {
     "esc50": 512,
     "speechcommands": 128,
 }
+# rows of the whole-file fbank cache, 10 ms frames: AudioSet / VGGSound clips
+# are 10 s, longer files are not cached
+FULL_FILE_FRAMES = 1024
+
 multilabel_dataset = {
     "audioset": True,
     "esc50": False,
@@ -178,6 +187,8 @@ class AudioBaseDataset(Dataset):
 
         # whether load vision for training
         self.load_vision = args.audio_load_vision
+        # set by ASTProcessorTrain with --audio_batch_specaug, run on the collated batch
+        self.batch_augment = getattr(audio_processor, "batch_augment", None)
 
     def __len__(self):
         return len(self.annotation)
@@ -283,6 +294,7 @@ class AudioSetDataset(AudioBaseDataset):
                 for item in self.annotation
                 if item["is_good_video"] == True  # some videos are corrupted
             ]
+        self.annotation = ColumnarAnnotation(self.annotation)
 
         self.init_class_labels()
 
@@ -297,9 +309,43 @@ class AudioSetDataset(AudioBaseDataset):
         ]
         self.mix_up = self.is_train and self.args.audio_mix_up
 
+        # --fbank_cache_dir: fbanks of whole files, the training clips of
+        # samples without mixup are cut from them (mixup mixes waveforms)
+        self.fbank_cache = None
+        if self.is_train and getattr(args, "fbank_cache_dir", None):
+            paths = self.annotation.column("audio_path")
+            self.fbank_cache = FbankCache(
+                args.fbank_cache_dir,
+                len(self.annotation),
+                dict(
+                    num_mel_bins=self.audio_processor.mel_bins,
+                    target_length=FULL_FILE_FRAMES,
+                    sample_frequency=self.audio_processor.sampling_rate,
+                    htk_compat=True,
+                    use_energy=False,
+                    window_type="hanning",
+                    dither=0.0,
+                    frame_shift=10,
+                    full_file=True,
+                ),
+                paths.buffer.tobytes() + paths.offsets.tobytes(),
+            )
+
         # Evaluation specific
         self.eval_metric = "mAP"
 
+    def frame_lengths(self):
+        """Valid fbank frame count per clip, used for length bucketing."""
+        if getattr(self, "_frame_lengths", None) is None:
+            self._frame_lengths = clip_frame_lengths(
+                [
+                    os.path.join(self.data_root, p)
+                    for p in self.annotation.column("audio_path")
+                ],
+                self.audio_processor.target_length,
+            )
+        return self._frame_lengths
+
     def init_class_labels(self):
         
         self.num_classes = 527
@@ -358,12 +404,18 @@ class AudioSetDataset(AudioBaseDataset):
                         )  # already sub mean
                         mix_wf = mix_lambda * wf + (1 - mix_lambda) * sec_wf
                         mix_wf = mix_wf - mix_wf.mean()
-                        audio_data = self.audio_processor(mix_wf)
+                        audio_data, audio_len = self.audio_processor(
+                            mix_wf, return_length=True
+                        )
 
                     else:  # no mixup
                         vis_data, (start, end) = self.vis_processor(ann["video_path"])
-                        audio_data = self.audio_processor(
-                            ann["audio_path"], se=(start, end)
+                        audio_data, audio_len = self.audio_processor(
+                            ann["audio_path"],
+                            se=(start, end),
+                            return_length=True,
+                            fbank_cache=self.fbank_cache,
+                            index=index,
                         )
 
                 else:
@@ -377,9 +429,16 @@ class AudioSetDataset(AudioBaseDataset):
                         )  # already sub mean
                         mix_wf = mix_lambda * wf + (1 - mix_lambda) * sec_wf
                         mix_wf = mix_wf - mix_wf.mean()
-                        audio_data = self.audio_processor(mix_wf)
+                        audio_data, audio_len = self.audio_processor(
+                            mix_wf, return_length=True
+                        )
                     else:  # no mixup
-                        audio_data = self.audio_processor(ann["audio_path"])
+                        audio_data, audio_len = self.audio_processor(
+                            ann["audio_path"],
+                            return_length=True,
+                            fbank_cache=self.fbank_cache,
+                            index=index,
+                        )
 
                 if vis_data is not None:
                     if (
@@ -395,6 +454,7 @@ class AudioSetDataset(AudioBaseDataset):
 
                 rtn["image"] = vis_data
                 rtn["audio"] = audio_data
+                rtn["audio_len"] = torch.tensor(audio_len)
 
                 # text; TODO: make caption and template configurable later
                 caption = None
@@ -481,11 +541,15 @@ class AudiosetDataset_ast(Dataset):
         tokenizer=None,
         use_text=False,
         args=None,
+        fbank_cache_dir=None,
+        batch_spec_augment=False,
     ):
         """
         Dataset that manages audio recordings
         :param audio_conf: Dictionary containing the audio loading and preprocessing settings
         :param dataset_json_file
+        :param fbank_cache_dir: if set, fbanks of samples without mixup / roll-mag are computed once and kept in a memmap cache
+        :param batch_spec_augment: leave SpecAugment/normalisation to the collated batch (see `batch_augment`)
         """
         self.datapath = dataset_json_file
         with open(dataset_json_file, "r") as fp:
@@ -493,7 +557,8 @@ class AudiosetDataset_ast(Dataset):
         self.use_fbank = use_fbank
         self.fbank_dir = fbank_dir
 
-        self.data = data_json["data"]
+        self.data = ColumnarAnnotation(data_json["data"])
+        del data_json
         self.audio_conf = audio_conf
         print(
             "---------------the {:s} dataloader---------------".format(
@@ -536,6 +601,43 @@ class AudiosetDataset_ast(Dataset):
             self.audio_text_features = torch.load(args.audio_text_template_path)
 
         self.label_num = len(self.index_dict)
+        # label strings are split and mapped to class ids once, not per sample
+        self.wav_paths = self.data.column("wav")
+        self.label_ids = encode_label_strings(
+            self.data.column("labels"), self.index_dict
+        )
+
+        # one augmenter for all samples instead of new masking modules per call;
+        # with batch_spec_augment it is applied to the collated (B, T, F) batch
+        self.spec_augment = BatchSpecAugment(
+            self.freqm, self.timem, self.norm_mean, self.norm_std, noise=self.noise
+        )
+        if args is not None and mode == "train":
+            # eval loaders have no BatchAugmentCollate
+            batch_spec_augment = batch_spec_augment or getattr(
+                args, "audio_batch_specaug", False
+            )
+        self.batch_augment = self.spec_augment if batch_spec_augment else None
+
+        self.fbank_cache = None
+        if fbank_cache_dir is None and args is not None:
+            fbank_cache_dir = getattr(args, "fbank_cache_dir", None)
+        # roll-mag changes the waveform of every sample, nothing to cache
+        if fbank_cache_dir is not None and not self.use_fbank and not roll_mag_aug:
+            self.fbank_cache = FbankCache(
+                fbank_cache_dir,
+                len(self.data),
+                dict(
+                    num_mel_bins=self.melbins,
+                    target_length=self.audio_conf.get("target_length"),
+                    htk_compat=True,
+                    use_energy=False,
+                    window_type="hanning",
+                    dither=0.0,
+                    frame_shift=10,
+                ),
+                self.wav_paths.buffer.tobytes() + self.wav_paths.offsets.tobytes(),
+            )
         self.roll_mag_aug = roll_mag_aug
         print(f"number of classes: {self.label_num}")
         print(f"size of dataset {self.__len__()}")
@@ -626,6 +728,14 @@ class AudiosetDataset_ast(Dataset):
             dither=0.0,
             frame_shift=10,
         )
+        fbank, n_frames = self._pad_or_cut(fbank)
+
+        if filename2 == None:
+            return fbank, 0, n_frames
+        else:
+            return fbank, mix_lambda, n_frames
+
+    def _pad_or_cut(self, fbank):
         # 512
         target_length = self.audio_conf.get("target_length")
         n_frames = fbank.shape[0]
@@ -639,10 +749,28 @@ class AudiosetDataset_ast(Dataset):
         elif p < 0:
             fbank = fbank[0:target_length, :]
 
-        if filename2 == None:
-            return fbank, 0
+        return fbank, min(n_frames, target_length)
+
+    def _load_cached_fbank(self, index):
+        cached = self.fbank_cache.get(index)
+        if cached is None:
+            waveform, sr = torchaudio.load(self.wav_paths[index])
+            waveform = waveform - waveform.mean()
+            fbank = torchaudio.compliance.kaldi.fbank(
+                waveform,
+                htk_compat=True,
+                sample_frequency=sr,
+                use_energy=False,
+                window_type="hanning",
+                num_mel_bins=self.melbins,
+                dither=0.0,
+                frame_shift=10,
+            )
+            fbank, n_frames = self._pad_or_cut(fbank)
+            self.fbank_cache.put(index, fbank, n_frames)
         else:
-            return fbank, mix_lambda
+            fbank, n_frames = cached
+        return fbank, n_frames
 
     def _fbank(self, filename, filename2=None):
         if filename2 == None:
@@ -650,7 +778,7 @@ class AudiosetDataset_ast(Dataset):
                 self.fbank_dir, os.path.basename(filename).replace(".wav", ".npy")
             )
             fbank = np.load(fn1)
-            return torch.from_numpy(fbank), 0
+            return torch.from_numpy(fbank), 0, fbank.shape[0]
         else:
             fn1 = os.path.join(
                 self.fbank_dir, os.path.basename(filename).replace(".wav", ".npy")
@@ -661,7 +789,7 @@ class AudiosetDataset_ast(Dataset):
             # sample lambda from beta distribtion
             mix_lambda = np.random.beta(10, 10)
             fbank = mix_lambda * np.load(fn1) + (1 - mix_lambda) * np.load(fn2)
-            return torch.from_numpy(fbank), mix_lambda
+            return torch.from_numpy(fbank), mix_lambda, fbank.shape[0]
 
     def collater(self, samples):
         return SampleCollator(self, samples)
@@ -680,75 +808,61 @@ class AudiosetDataset_ast(Dataset):
         if (
             random.random() < self.mixup
         ):  # for audio_exp, when using mixup, assume multilabel
-            datum = self.data[index]
             # find another sample to mix, also do balance sampling
             # sample the other sample from the multinomial distribution, will make the performance worse
             # mix_sample_idx = np.random.choice(len(self.data), p=self.sample_weight_file)
             # sample the other sample from the uniform distribution
             mix_sample_idx = random.randint(0, len(self.data) - 1)
-            mix_datum = self.data[mix_sample_idx]
 
-            # get the mixed fbank
+            # get the mixed fbank, mixed as waveforms (never from the cache)
             if not self.use_fbank:
-                fbank, mix_lambda = self._wav2fbank(datum["wav"], mix_datum["wav"])
+                fbank, mix_lambda, n_frames = self._wav2fbank(
+                    self.wav_paths[index], self.wav_paths[mix_sample_idx]
+                )
             else:
-                fbank, mix_lambda = self._fbank(datum["wav"], mix_datum["wav"])
-            # initialize the label
-            label_indices = np.zeros(self.label_num)
-            # add sample 1 labels
-            for label_str in datum["labels"].split(","):
-                label_indices[int(self.index_dict[label_str])] += mix_lambda
-            # add sample 2 labels
-            for label_str in mix_datum["labels"].split(","):
-                label_indices[int(self.index_dict[label_str])] += 1.0 - mix_lambda
-            label_indices = torch.FloatTensor(label_indices)
+                fbank, mix_lambda, n_frames = self._fbank(
+                    self.wav_paths[index], self.wav_paths[mix_sample_idx]
+                )
+            label_name_idx = self.label_ids[index].tolist()
+            # initialize the label, add sample 1 labels, then sample 2 labels
+            label_indices = np.zeros(self.label_num, dtype=np.float32)
+            np.add.at(label_indices, self.label_ids[index], mix_lambda)
+            np.add.at(label_indices, self.label_ids[mix_sample_idx], 1.0 - mix_lambda)
+            label_indices = torch.from_numpy(label_indices)
         # if not do mixup
         else:
-            try:
-                datum = self.data[index]
-            except IndexError:
+            if index >= len(self.data):
                 print("index out of range")
                 print(f"index: {index}")
                 return None
 
-            label_indices = np.zeros(self.label_num)
-            label_name_idx = []
-            if not self.use_fbank:
-                fbank, mix_lambda = self._wav2fbank(datum["wav"])
+            if self.fbank_cache is not None:
+                fbank, n_frames = self._load_cached_fbank(index)
+                mix_lambda = 0
+            elif not self.use_fbank:
+                fbank, mix_lambda, n_frames = self._wav2fbank(self.wav_paths[index])
             else:
-                fbank, mix_lambda = self._fbank(datum["wav"])
-            for label_str in datum["labels"].split(","):
-                label_indices[int(self.index_dict[label_str])] = 1.0
-                label_name_idx.append(int(self.index_dict[label_str]))
+                fbank, mix_lambda, n_frames = self._fbank(self.wav_paths[index])
+            label_name_idx = self.label_ids[index].tolist()
 
             if self.multilabel:
-                label_indices = torch.FloatTensor(label_indices)
+                label_indices = torch.zeros(self.label_num, dtype=torch.float)
+                label_indices[label_name_idx] = 1.0
             else:
                 # remark : for ft cross-ent
-                label_indices = int(self.index_dict[label_str])
+                label_indices = label_name_idx[-1]
 
         rtn["target"] = label_indices
         rtn["id"] = index
 
-        # SpecAug for training (not for eval)
-        freqm = torchaudio.transforms.FrequencyMasking(self.freqm)
-        timem = torchaudio.transforms.TimeMasking(self.timem)
-        fbank = fbank.transpose(0, 1).unsqueeze(0)  # 1, 128, 1024 (...,freq,time)
-        if self.freqm != 0:
-            fbank = freqm(fbank)
-        if self.timem != 0:
-            fbank = timem(fbank)  # (..., freq, time)
-        fbank = torch.transpose(fbank.squeeze(), 0, 1)  # time, freq
-        fbank = (fbank - self.norm_mean) / (self.norm_std * 2)
-        if self.noise:  # default is false, true for spc
-            fbank = (
-                fbank
-                + torch.rand(fbank.shape[0], fbank.shape[1]) * np.random.rand() / 10
-            )
-            fbank = torch.roll(fbank, np.random.randint(-10, 10), 0)
+        # SpecAug for training (not for eval), normalisation and noise (spc);
+        # deferred to the collated batch when `batch_augment` is set
+        if self.batch_augment is None:
+            fbank = self.spec_augment(fbank.float().unsqueeze(0))[0]
         # the output fbank shape is [time_frame_num, frequency_bins], e.g., [1024, 128]
 
         rtn["audio"] = fbank
+        rtn["audio_len"] = torch.tensor(n_frames)
 
         if self.use_text and self.mode == "train" and not self.args.use_text_branch:
             if self.multilabel:
@@ -760,7 +874,7 @@ class AudiosetDataset_ast(Dataset):
                         template_idx = random.randint(0, 4)
                     text_features.append(
                         self.audio_text_features[name][template_idx].to(
-                            dtype=torch.float16
+                            dtype=get_policy().feature_dtype
                         )
                     )
                 text_feature = torch.stack(text_features).mean(dim=0)
@@ -770,7 +884,7 @@ class AudiosetDataset_ast(Dataset):
                 template_idx = random.randint(0, 4)
                 text_feature = self.audio_text_features[str(label_indices)][
                     template_idx
-                ].to(dtype=torch.float16)
+                ].to(dtype=get_policy().feature_dtype)
 
             rtn["text_feature"] = text_feature
 
@@ -786,6 +900,14 @@ class AudiosetDataset_ast(Dataset):
     def __len__(self):
         return len(self.data)
 
+    def frame_lengths(self):
+        """Valid fbank frame count per clip, used for length bucketing."""
+        if getattr(self, "_frame_lengths", None) is None:
+            self._frame_lengths = clip_frame_lengths(
+                self.wav_paths, self.audio_conf.get("target_length")
+            )
+        return self._frame_lengths
+
 
 class AudioCapsDataset(AudioBaseDataset):
     def __init__(
@@ -827,7 +949,9 @@ class AudioCapsDataset(AudioBaseDataset):
             **kwargs,
         )
 
-        self.annotation = load_annotation(anno_path[split]["audio"], header=0, sep="\t")
+        self.annotation = ColumnarAnnotation(
+            load_annotation(anno_path[split]["audio"], header=0, sep="\t")
+        )
 
         self.text_ids = None
         self.texts = None
@@ -848,7 +972,7 @@ class AudioCapsDataset(AudioBaseDataset):
         # TODO: move `text_ids` to cuda, do when evaluating this task
 
     def __getitem__(self, index):
-        ann = self.annotation.iloc[index]
+        ann = self.annotation[index]
         uniq_id = int(ann["uniq_id"])
 
         apath = os.path.join(self.data_root, ann["audio"])
@@ -904,7 +1028,9 @@ class ClothoDataset(AudioBaseDataset):
             **kwargs,
         )
 
-        self.annotation = load_annotation(anno_path[split]["audio"], header=0, sep="\t")
+        self.annotation = ColumnarAnnotation(
+            load_annotation(anno_path[split]["audio"], header=0, sep="\t")
+        )
 
         self.text_ids = None
         self.texts = None
@@ -925,7 +1051,7 @@ class ClothoDataset(AudioBaseDataset):
         # TODO: move `text_ids` to cuda, do when evaluating this task
 
     def __getitem__(self, index):
-        ann = self.annotation.iloc[index]
+        ann = self.annotation[index]
         uniq_id = int(ann["uniq_id"])
 
         apath = os.path.join(self.data_root, ann["audio"])
@@ -977,7 +1103,7 @@ class ESC50Dataset(AudioBaseDataset):
             **kwargs,
         )
 
-        self.annotation = load_annotation(anno_path[split])
+        self.annotation = ColumnarAnnotation(load_annotation(anno_path[split]))
         self.init_class_labels()
 
         # Evaluation specific
@@ -1053,7 +1179,7 @@ class VGGSoundCLSDataset(AudioBaseDataset):
             **kwargs,
         )
 
-        self.annotation = load_annotation(anno_path[split])
+        self.annotation = ColumnarAnnotation(load_annotation(anno_path[split]))
         self.init_class_labels()
 
         # Evaluation specific
@@ -1130,7 +1256,7 @@ class VGGSoundVideoDataset(AudioBaseDataset):
             **kwargs,
         )
 
-        self.annotation = load_annotation(anno_path[split])
+        self.annotation = ColumnarAnnotation(load_annotation(anno_path[split]))
         self.init_class_labels()
 
         # Evaluation specific
@@ -1277,6 +1403,7 @@ def create_audio_datasets(
                     "freqm": args.freqm,
                     "timem": args.timem,
                     "noise_aug": args.audio_noise_aug,
+                    "batch_specaug": bool(is_train and args.audio_batch_specaug),
                     "agg_eval": True,
                 },
             }
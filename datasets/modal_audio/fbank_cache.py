@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import hashlib
+
+import numpy as np
+import torch
+
+from util.logger import print_log
+
+
+class FbankCache:
+    """Sharded on-disk cache of fixed-size fbank features.
+
+    Clip ``i`` of a dataset lives in row ``i // num_shards`` of shard
+    ``i % num_shards``. Every shard is a float16 ``.npy`` memmap of shape
+    ``(rows, target_length, num_mel_bins)`` plus an int32 array holding the
+    number of valid (unpadded) frames, ``-1`` meaning "not computed yet" and
+    ``-2`` "not cacheable" (see ``skip``).
+    Entries are filled lazily by whichever process first needs them, so the
+    first epoch populates the cache and later ones skip decoding.
+
+    The cache directory is keyed by the fbank parameters and by a hash of the
+    dataset's file list, so changing either never reads stale features.
+
+    Args:
+        cache_root (str): root directory, a sub directory is created per key.
+        num_items (int): number of clips in the dataset.
+        fbank_params (dict): everything that changes the fbank output.
+        file_key (bytes): bytes identifying the ordered file list.
+        num_shards (int): number of memmap shards.
+        log_freq (int): report hit rate and samples/s every N lookups.
+    """
+
+    def __init__(
+        self,
+        cache_root,
+        num_items,
+        fbank_params,
+        file_key,
+        num_shards=16,
+        log_freq=2000,
+    ):
+        self.num_items = num_items
+        self.num_shards = max(1, min(num_shards, num_items))
+        self.rows = (num_items + self.num_shards - 1) // self.num_shards
+        self.target_length = fbank_params["target_length"]
+        self.num_mel_bins = fbank_params["num_mel_bins"]
+        self.log_freq = log_freq
+
+        key = hashlib.sha1(
+            json.dumps(fbank_params, sort_keys=True).encode("utf-8") + file_key
+        ).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_root, key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        meta_path = os.path.join(self.cache_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            tmp_path = f"{meta_path}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(dict(fbank_params, num_items=num_items), f)
+            os.replace(tmp_path, meta_path)
+
+        for k in range(self.num_shards):
+            self._create(
+                self._feat_path(k),
+                np.float16,
+                (self.rows, self.target_length, self.num_mel_bins),
+                0,
+            )
+            self._create(self._frames_path(k), np.int32, (self.rows,), -1)
+
+        self._feats = None
+        self._frames = None
+        self.reset_stats()
+
+        print_log(
+            f"[FbankCache] {self.cache_dir}: {num_items} clips in {self.num_shards} shards",
+            "FbankCache",
+        )
+
+    def _feat_path(self, k):
+        return os.path.join(self.cache_dir, f"shard_{k:03d}.npy")
+
+    def _frames_path(self, k):
+        return os.path.join(self.cache_dir, f"shard_{k:03d}_frames.npy")
+
+    @staticmethod
+    def _create(path, dtype, shape, fill):
+        # build aside, then hard-link into place: concurrent ranks either win
+        # the link or find the finished file, never a half-written header
+        if os.path.exists(path):
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        arr = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+        if fill != 0:
+            arr[:] = fill
+        arr.flush()
+        del arr
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        os.remove(tmp_path)
+
+    def _open(self):
+        # opened lazily so every DataLoader worker maps the shards itself
+        self.reset_stats()
+        self._feats = [
+            np.load(self._feat_path(k), mmap_mode="r+") for k in range(self.num_shards)
+        ]
+        self._frames = [
+            np.load(self._frames_path(k), mmap_mode="r+")
+            for k in range(self.num_shards)
+        ]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_feats"] = None
+        state["_frames"] = None
+        return state
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self._start = time.time()
+
+    def get(self, index):
+        """Return ``(fbank, n_frames)`` for clip ``index`` or ``None`` on a miss."""
+        if self._feats is None:
+            self._open()
+        shard, row = index % self.num_shards, index // self.num_shards
+        n_frames = int(self._frames[shard][row])
+        if n_frames < 0:
+            self.misses += 1
+            self._maybe_report()
+            return None
+        self.hits += 1
+        self._maybe_report()
+        return torch.from_numpy(self._feats[shard][row].astype(np.float32)), n_frames
+
+    def put(self, index, fbank, n_frames):
+        if self._feats is None:
+            self._open()
+        shard, row = index % self.num_shards, index // self.num_shards
+        self._feats[shard][row] = fbank.numpy().astype(np.float16)
+        # the frame count marks the entry valid, so write it last
+        self._frames[shard][row] = n_frames
+
+    def skip(self, index):
+        """Mark clip ``index`` as never cached, e.g. too long for a row."""
+        if self._feats is None:
+            self._open()
+        self._frames[index % self.num_shards][index // self.num_shards] = -2
+
+    def skipped(self, index):
+        if self._feats is None:
+            self._open()
+        return int(self._frames[index % self.num_shards][index // self.num_shards]) == -2
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def _maybe_report(self):
+        total = self.hits + self.misses
+        if self.log_freq <= 0 or total % self.log_freq != 0:
+            return
+        info = torch.utils.data.get_worker_info()
+        worker_id = info.id if info is not None else -1
+        elapsed = max(time.time() - self._start, 1e-6)
+        print_log(
+            f"[FbankCache] worker {worker_id}: {total} lookups, "
+            f"hit rate {self.hit_rate * 100:.1f}%, {total / elapsed:.1f} samples/s",
+            "FbankCache",
+        )
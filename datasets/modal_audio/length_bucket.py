@@ -0,0 +1,229 @@
+import math
+import random
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torchaudio
+
+from util.logger import print_log
+
+
+def fbank_num_frames(num_samples, sample_rate, frame_length=25.0, frame_shift=10.0):
+    """Frame count of ``kaldi.fbank`` (snip_edges=True) for a clip of ``num_samples``."""
+    window_size = int(sample_rate * frame_length * 0.001)
+    window_shift = int(sample_rate * frame_shift * 0.001)
+    if num_samples < window_size:
+        return 0
+    return 1 + (num_samples - window_size) // window_shift
+
+
+def clip_frame_lengths(paths, target_length, log_freq=100000):
+    """Valid (unpadded) fbank frame count of every clip, from the file headers.
+
+    Clips whose header has no frame count are assumed to fill ``target_length``.
+    Under torch.distributed only rank 0 reads the headers and broadcasts.
+    """
+    lengths = np.full(len(paths), target_length, dtype=np.int64)
+    distributed = dist.is_available() and dist.is_initialized()
+    if distributed and dist.get_rank() != 0:
+        return _broadcast_lengths(lengths)
+    for i, path in enumerate(paths):
+        try:
+            info = torchaudio.info(path)
+        except Exception:
+            continue
+        if info.num_frames > 0:
+            lengths[i] = min(
+                fbank_num_frames(info.num_frames, info.sample_rate), target_length
+            )
+        if log_freq > 0 and (i + 1) % log_freq == 0:
+            print_log(f"[audio bucket] read {i + 1}/{len(paths)} headers", "AudioBucket")
+    if distributed:
+        return _broadcast_lengths(lengths)
+    return lengths
+
+
+def _broadcast_lengths(lengths):
+    # nccl only moves device tensors
+    device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+    t = torch.from_numpy(lengths).to(device)
+    dist.broadcast(t, 0)
+    return t.cpu().numpy()
+
+
+def parse_bucket_boundaries(boundaries):
+    if isinstance(boundaries, str):
+        boundaries = [int(b) for b in boundaries.split(",") if b]
+    return sorted(boundaries)
+
+
+class LengthBucketSampler(torch.utils.data.Sampler):
+    """Reorder the indices of a per-rank sampler so every batch comes from one
+    length bucket.
+
+    The wrapped sampler decides *which* samples this rank sees (repeat factors,
+    class weights, rank split); this sampler only groups them: indices are put
+    into buckets by frame length, cut into ``batch_size`` chunks, and the
+    chunks are shuffled. The few left-over indices of every bucket are merged,
+    sorted by length and chunked last, so the number of yielded indices (and
+    of batches per rank) is unchanged.
+
+    Args:
+        sampler (Sampler): per-rank index sampler, e.g. ``SubDatasetSampler``.
+        lengths (np.ndarray): valid frame count of every dataset item.
+        batch_size (int): DataLoader batch size.
+        boundaries (list[int] | str): upper bucket edges, e.g. ``"256,512,768"``.
+        seed (int): shuffle seed, combined with the epoch.
+    """
+
+    def __init__(self, sampler, lengths, batch_size, boundaries, seed=0):
+        self.sampler = sampler
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.boundaries = parse_bucket_boundaries(boundaries)
+        self.seed = seed
+        self.epoch = 0
+        self.position = 0
+        self.start_position = 0
+
+    def bucket_of(self, index):
+        return int(np.searchsorted(self.boundaries, self.lengths[index], side="left"))
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        indices = np.fromiter(iter(self.sampler), dtype=np.int64)
+        buckets = np.searchsorted(self.boundaries, self.lengths[indices], side="left")
+
+        batches, leftover = [], []
+        for b in np.unique(buckets):
+            members = indices[buckets == b]
+            n_full = len(members) // self.batch_size
+            if n_full > 0:
+                batches.extend(np.split(members[: n_full * self.batch_size], n_full))
+            leftover.append(members[n_full * self.batch_size :])
+        rng.shuffle(batches)
+
+        leftover = np.concatenate(leftover) if len(leftover) > 0 else indices[:0]
+        if len(leftover) > 0:
+            leftover = leftover[np.argsort(self.lengths[leftover], kind="stable")]
+            for start in range(0, len(leftover), self.batch_size):
+                batches.append(leftover[start : start + self.batch_size])
+
+        order = np.concatenate(batches) if len(batches) > 0 else indices[:0]
+        start, self.start_position = self.start_position, 0
+        self.position = start
+        for idx in order[start:]:
+            self.position += 1
+            yield int(idx)
+
+    def state_dict(self, position=None):
+        return {
+            "epoch": self.epoch,
+            "seed": self.seed,
+            "position": self.position if position is None else int(position),
+        }
+
+    def load_state_dict(self, state):
+        # the wrapped sampler always yields its full epoch, the skip happens here
+        self.epoch = state["epoch"]
+        self.seed = state["seed"]
+        self.start_position = state["position"]
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(self.epoch)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return len(self.sampler)
+
+    @property
+    def total_size(self):
+        return self.sampler.total_size
+
+
+class AudioLengthCollate:
+    """Crop the collated, zero-padded fbank batch to its longest valid clip.
+
+    ``batch[key]`` is ``(B, T, F)`` padded to ``target_length``;
+    ``batch[key + "_len"]`` holds the valid frame counts. The time axis is cut
+    to the batch maximum rounded up to ``pad_multiple`` frames, which keeps the
+    number of distinct shapes (and cudnn autotune runs) small.
+    """
+
+    def __init__(self, collate_fn, pad_multiple=16, min_length=16, key="audio"):
+        self.collate_fn = collate_fn
+        self.pad_multiple = pad_multiple
+        self.min_length = min_length
+        self.key = key
+
+    def __call__(self, batch):
+        out = self.collate_fn(batch)
+        lengths = out.get(f"{self.key}_len")
+        if lengths is None:
+            return out
+        x = out[self.key]
+        t = max(int(lengths.max()), self.min_length)
+        t = int(math.ceil(t / self.pad_multiple) * self.pad_multiple)
+        if t < x.size(1):
+            out[self.key] = x[:, :t].contiguous()
+        return out
+
+
+class BucketThroughput:
+    """Accumulate samples/s per padded audio length.
+
+    On CUDA the forward is bracketed by events, read back once in ``report``,
+    so timing does not synchronise the training step.
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.use_cuda = torch.cuda.is_available()
+        # CUDA: (length, start, end) per forward
+        self.events = []
+        self._start = None
+
+    def start(self):
+        if self.use_cuda:
+            self._start = torch.cuda.Event(enable_timing=True)
+            self._start.record()
+        else:
+            self._start = time.time()
+
+    def stop(self, length, n_samples):
+        if self._start is None:
+            return
+        if self.use_cuda:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            self.events.append((length, self._start, end))
+        else:
+            self.seconds[length] += time.time() - self._start
+        self.samples[length] += n_samples
+        self._start = None
+
+    def report(self, logger=None):
+        if self.events:
+            torch.cuda.synchronize()
+            for length, start, end in self.events:
+                self.seconds[length] += start.elapsed_time(end) / 1000
+            self.events = []
+        for length in sorted(self.samples):
+            sps = self.samples[length] / max(self.seconds[length], 1e-6)
+            print_log(
+                f"[audio bucket] T={length}: {self.samples[length]} samples, "
+                f"{sps:.1f} samples/s",
+                logger=logger,
+            )
+
+    def reset(self):
+        self.samples.clear()
+        self.seconds.clear()
+        self.events = []
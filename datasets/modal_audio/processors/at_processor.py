@@ -33,6 +33,7 @@ from datasets.modal_audio.processors.util_transforms import (
     SpatialCrop,
     AdjustableConstantClipsPerVideoSampler,
 )
+from datasets.modal_audio.spec_augment import BatchSpecAugment
 
 
 from timm.data.constants import (
@@ -224,13 +225,110 @@ def audio_get_clip(
     return wf
 
 
+_resamplers = {}
+
+
+def resample(waveform, orig_freq, new_freq):
+    # Resample keeps its sinc kernel, so build it once per rate pair
+    if orig_freq == new_freq:
+        return waveform
+    key = (orig_freq, new_freq)
+    if key not in _resamplers:
+        _resamplers[key] = torchaudio.transforms.Resample(orig_freq, new_freq)
+    return _resamplers[key](waveform)
+
+
+def get_audio_duration(path):
+    """Duration in seconds read from the header, None if unknown."""
+    try:
+        info = torchaudio.info(path)
+    except Exception:
+        return None
+    if info.num_frames <= 0 or info.sample_rate <= 0:
+        return None
+    return info.num_frames / info.sample_rate
+
+
+def load_audio_segment(path, sampling_rate, start=None, end=None):
+    """Decode only the [start, end) window of `path`, resampled to `sampling_rate`.
+
+    The window is kept under the same rule as `audio_get_clip` (inside the
+    file and longer than 0.5s); otherwise the whole file is returned. Seeking
+    uses the header's frame count, files without one fall back to a full
+    decode followed by slicing.
+    """
+    info = None
+    if start is not None and end is not None:
+        try:
+            info = torchaudio.info(path)
+        except Exception:
+            info = None
+
+    if info is not None and info.num_frames > 0:
+        sr = info.sample_rate
+        orig_duration = info.num_frames / sr
+        if start < orig_duration and end <= orig_duration and end - start > 0.5:
+            frame_offset = int(start * sr)
+            num_frames = int(end * sr) - frame_offset
+            wav, sr = torchaudio.load(
+                path, frame_offset=frame_offset, num_frames=num_frames
+            )
+            return resample(wav, sr, sampling_rate)
+
+    wav, sr = torchaudio.load(path)
+    wav = resample(wav, sr, sampling_rate)
+    if start is not None and end is not None:
+        orig_duration = float(wav.shape[1] / sampling_rate)
+        if start < orig_duration and end <= orig_duration and end - start > 0.5:
+            wav = wav[:, int(start * sampling_rate) : int(end * sampling_rate)]
+    return wav
+
+
+def benchmark_audio_decode(paths, sampling_rate=16000, clip_duration=5.0, n_repeat=3):
+    """Compare full-file decode + slice with `load_audio_segment` on `paths`.
+
+    Meant for long clips (VGGSound, AudioCaps); returns the mean seconds per
+    clip for both paths and logs the speed-up. The first pass over a rate
+    pair builds the resampler for both, so it is not counted. Run as::
+
+        python -m datasets.modal_audio.processors.at_processor --audio_dir <dir>
+    """
+    full_t, seg_t = 0.0, 0.0
+    n = 0
+    for path in paths:
+        duration = get_audio_duration(path)
+        if duration is None or duration <= clip_duration:
+            continue
+        start = random.uniform(0, duration - clip_duration)
+        end = start + clip_duration
+        # warm up: build the resampler kernel for this file's rate
+        load_audio_segment(path, sampling_rate, start, end)
+        for _ in range(n_repeat):
+            t0 = time.time()
+            wav, sr = torchaudio.load(path)
+            # same cached resampler as the segment path, only the decode differs
+            wav = resample(wav, sr, sampling_rate)
+            audio_get_clip(wav, sampling_rate, clip_duration, start, end)
+            t1 = time.time()
+            wav = load_audio_segment(path, sampling_rate, start, end)
+            audio_get_clip(wav, sampling_rate, clip_duration)
+            t2 = time.time()
+            full_t += t1 - t0
+            seg_t += t2 - t1
+            n += 1
+    if n == 0:
+        return None, None
+    full_t, seg_t = full_t / n, seg_t / n
+    logging.info(
+        f"[audio decode] {n} runs, full {full_t * 1000:.1f}ms, "
+        f"segment {seg_t * 1000:.1f}ms, speed-up {full_t / max(seg_t, 1e-9):.2f}x"
+    )
+    return full_t, seg_t
+
+
 def load_audio(path, sampling_rate=16000, target_duration=5.0, start=None, end=None):
-    waveform, sr = torchaudio.load(path)  # [1, sr*duration]
-    if sr != sampling_rate:
-        waveform = torchaudio.functional.resample(
-            waveform, orig_freq=sr, new_freq=sampling_rate
-        )
-    waveform = audio_get_clip(waveform, sampling_rate, target_duration, start, end)
+    waveform = load_audio_segment(path, sampling_rate, start, end)
+    waveform = audio_get_clip(waveform, sampling_rate, target_duration)
     return waveform
 
 
@@ -332,6 +430,22 @@ class ASTProcessorTrain(BaseProcessor):
             annotation=None,
         )
 
+        # --audio_batch_specaug (train loader only): masking, normalisation and
+        # noise run once on the collated batch, the dataset hands
+        # `batch_augment` to BatchAugmentCollate; the fbank is returned as is
+        self.batch_augment = None
+        if args.get("batch_specaug", False):
+            self.batch_augment = BatchSpecAugment(
+                args.freqm,
+                args.timem,
+                self.mean[0],
+                self.std[0],
+                noise=args.noise_aug,
+                std_factor=1.0,
+            )
+            self.transform = lambda x: x
+            return
+
         # data transform
         transform_list = []
         transform_list.extend(
@@ -362,12 +476,14 @@ class ASTProcessorTrain(BaseProcessor):
         self.transform = transforms.Compose(transform_list)
 
     def load_audio_clip(self, path, start=None, end=None):
-        wav, sr = torchaudio.load(path)  # Size: (1, sr*duration)
-        if sr != self.sampling_rate:
-            wav = torchaudio.functional.resample(
-                wav, orig_freq=sr, new_freq=self.sampling_rate
-            )
-        audio_duration = wav.shape[1] / self.sampling_rate
+        # the duration comes from the header so only the sampled window is decoded
+        audio_duration = get_audio_duration(path)
+        if audio_duration is None:
+            wav, sr = torchaudio.load(path)  # Size: (1, sr*duration)
+            wav = resample(wav, sr, self.sampling_rate)
+            audio_duration = wav.shape[1] / self.sampling_rate
+        else:
+            wav = None
         if start is None and end is None:
             sample_clip_info = self.clip_sampler(video_duration=audio_duration)
             start = sample_clip_info[0]
@@ -375,6 +491,9 @@ class ASTProcessorTrain(BaseProcessor):
 
         start = max(0.0, start)
         end = min(end, audio_duration)
+        if wav is None:
+            wav = load_audio_segment(path, self.sampling_rate, start, end)
+            start, end = None, None
         waveform = audio_get_clip(
             wav,
             sampling_rate=self.sampling_rate,
@@ -385,7 +504,7 @@ class ASTProcessorTrain(BaseProcessor):
 
         return waveform
 
-    def convert2fbank(self, waveform):
+    def convert2fbank(self, waveform, return_length=False):
         fbank = torchaudio.compliance.kaldi.fbank(
             waveform,
             htk_compat=True,
@@ -396,6 +515,7 @@ class ASTProcessorTrain(BaseProcessor):
             dither=0.0,
             frame_shift=10,
         )
+        n_frames = min(fbank.shape[0], self.target_length)
         p = self.target_length - fbank.shape[0]
         if p > 0:
             m = torch.nn.ZeroPad2d((0, 0, 0, p))
@@ -403,8 +523,66 @@ class ASTProcessorTrain(BaseProcessor):
         elif p < 0:
             fbank = fbank[0 : self.target_length, :]
 
+        if return_length:
+            return fbank, n_frames
         return fbank
 
+    def cached_clip_fbank(self, path, fbank_cache, index, start=None):
+        """``(fbank, n_frames)`` of a training clip cut from the cached fbank of
+        the whole file, None when the clip has to be decoded instead.
+
+        kaldi fbank frames are local (per-frame DC removal, no dither), so the
+        frames of a clip starting on the 10 ms frame grid are the frames of
+        the whole file at that offset; the clip start is drawn as in
+        ``load_audio_clip`` and snapped to that grid. Files not longer than
+        ``clip_duration`` (``audio_get_clip`` repeats them) or longer than
+        the cache rows are marked skipped and always decoded.
+        """
+        cached = fbank_cache.get(index)
+        if cached is None:
+            if fbank_cache.skipped(index):
+                return None
+            wav, sr = torchaudio.load(path)
+            wav = resample(wav, sr, self.sampling_rate)
+            fbank = torchaudio.compliance.kaldi.fbank(
+                wav,
+                htk_compat=True,
+                sample_frequency=self.sampling_rate,
+                use_energy=False,
+                window_type="hanning",
+                num_mel_bins=self.mel_bins,
+                dither=0.0,
+                frame_shift=10,
+            )
+            n_frames = fbank.shape[0]
+            if (
+                wav.shape[1] <= self.sampling_rate * self.clip_duration
+                or n_frames > fbank_cache.target_length
+            ):
+                fbank_cache.skip(index)
+                return None
+            full = torch.zeros(fbank_cache.target_length, fbank.shape[1])
+            full[:n_frames] = fbank
+            fbank_cache.put(index, full, n_frames)
+        else:
+            full, n_frames = cached
+
+        shift = self.sampling_rate // 100  # frame_shift=10 ms
+        window = self.sampling_rate * 25 // 1000  # frame_length=25 ms
+        clip_frames = 1 + (int(self.sampling_rate * self.clip_duration) - window) // shift
+        duration = ((n_frames - 1) * shift + window) / self.sampling_rate
+        if start is None:
+            start = self.clip_sampler(video_duration=duration)[0]
+        first = min(int(max(0.0, start) * self.sampling_rate) // shift, n_frames - clip_frames)
+        fbank = full[first : first + clip_frames]
+        n_valid = min(fbank.shape[0], self.target_length)
+        p = self.target_length - fbank.shape[0]
+        if p > 0:
+            fbank = torch.nn.functional.pad(fbank, (0, 0, 0, p))
+        elif p < 0:
+            fbank = fbank[0 : self.target_length, :]
+        return fbank, n_valid
+
     def _wav2fbank(self, filename, filename2=None):
         if filename2 == None:
             waveform, sr = torchaudio.load(filename)
@@ -476,30 +654,40 @@ class ASTProcessorTrain(BaseProcessor):
         elif p < 0:
             fbank = fbank[0:target_length, :]
 
+        n_frames = min(n_frames, target_length)
         if filename2 == None:
-            return fbank, 0
+            return fbank, 0, n_frames
         else:
-            return fbank, mix_lambda
+            return fbank, mix_lambda, n_frames
 
-    def __call__(self, wav, se=None, **kwargs):
+    def __call__(
+        self, wav, se=None, return_length=False, fbank_cache=None, index=None, **kwargs
+    ):
         if se is not None:
             assert len(se) == 2
             st, end = se[0], se[1]
         else:
             st, end = None, None
 
-        # if not isinstance(wav, torch.Tensor):
-            # wav = self.load_audio_clip(wav, start=st, end=end)
-        fbank, mix_lambda = self._wav2fbank(wav)
-
-        # assert wav.shape[1] == int(self.sampling_rate * self.clip_duration)
+        cached = None
+        if fbank_cache is not None and not isinstance(wav, torch.Tensor):
+            cached = self.cached_clip_fbank(wav, fbank_cache, index, start=st)
+        if cached is not None:
+            fbank, n_frames = cached
+        else:
+            # a path is range-decoded to one clip_duration clip (at [st, end)
+            # when given); mixup passes the already mixed waveform
+            if not isinstance(wav, torch.Tensor):
+                wav = self.load_audio_clip(wav, start=st, end=end)
 
-        # convert to spectrogram
-        # fbank = self.convert2fbank(wav)
+            # convert to spectrogram
+            fbank, n_frames = self.convert2fbank(wav, return_length=True)
 
         # transform below
         transformed_fbank = self.transform(fbank)
 
+        if return_length:
+            return transformed_fbank, n_frames
         return transformed_fbank
 
     @classmethod
@@ -565,10 +753,7 @@ class ASTProcessorEval(BaseProcessor):
         self, path, **kwargs
     ):  # no need for start and end from video at eval/inference stage
         wav, sr = torchaudio.load(path)  # [1, sr*duration]
-        if sr != self.sampling_rate:
-            wav = torchaudio.functional.resample(
-                wav, orig_freq=sr, new_freq=self.sampling_rate
-            )
+        wav = resample(wav, sr, self.sampling_rate)
         audio_duration = wav.shape[1] / self.sampling_rate
 
         audio_list = []
@@ -952,10 +1137,7 @@ class AudioASTProcessorEval(BaseProcessor):
         self, path, **kwargs
     ):  # no need for start and end from video at eval/inference stage
         wav, sr = torchaudio.load(path)  # [1, sr*duration]
-        if sr != self.sampling_rate:
-            wav = torchaudio.functional.resample(
-                wav, orig_freq=sr, new_freq=self.sampling_rate
-            )
+        wav = resample(wav, sr, self.sampling_rate)
         audio_duration = wav.shape[1] / self.sampling_rate
 
         audio_list = []
@@ -978,3 +1160,23 @@ class AudioASTProcessorEval(BaseProcessor):
         adata = torch.stack(audio_list, dim=0)
 
         return adata
+
+
+if __name__ == "__main__":
+    import glob
+    import argparse
+
+    parser = argparse.ArgumentParser("Full-file vs. range audio decode")
+    parser.add_argument("--audio_dir", type=str, required=True)
+    parser.add_argument("--ext", type=str, default="wav")
+    parser.add_argument("--num_files", type=int, default=50)
+    parser.add_argument("--sampling_rate", type=int, default=16000)
+    parser.add_argument("--clip_duration", type=float, default=5.0)
+    parser.add_argument("--n_repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    paths = sorted(glob.glob(os.path.join(args.audio_dir, "**", f"*.{args.ext}"), recursive=True))
+    benchmark_audio_decode(
+        paths[: args.num_files], args.sampling_rate, args.clip_duration, args.n_repeat
+    )
@@ -0,0 +1,129 @@
+import torch
+
+
+def _mask_bands(batch_size, size, mask_param, device):
+    """Per-sample [start, end) bands, same distribution as torchaudio's
+    ``mask_along_axis``: width ~ U(0, mask_param), start ~ U(0, size - width)."""
+    value = torch.rand(batch_size, device=device) * mask_param
+    min_value = torch.rand(batch_size, device=device) * (size - value)
+    start = min_value.long()
+    end = start + value.long()
+    pos = torch.arange(size, device=device)
+    return (pos[None, :] >= start[:, None]) & (pos[None, :] < end[:, None])
+
+
+class BatchSpecAugment:
+    """SpecAugment + normalisation + noise for a whole (B, T, F) fbank batch.
+
+    Replaces the per-sample ``FrequencyMasking``/``TimeMasking`` modules of
+    ``ASTProcessorTrain`` and ``AudiosetDataset_ast``: one random draw gives
+    every sample its own frequency and time band, masked values are filled
+    with the normalised zero so masking and normalisation run as one pass.
+    Works on CPU tensors in the collate function or on device tensors.
+
+    Args:
+        freqm (int): max frequency mask width, 0 disables.
+        timem (int): max time mask width, 0 disables.
+        norm_mean (float): dataset fbank mean.
+        norm_std (float): dataset fbank std.
+        noise (bool): add uniform noise and a random time roll (speechcommands).
+        std_factor (float): divide by ``std_factor * norm_std``; 2 for the AST
+            datasets, 1 for ``ASTProcessorTrain`` (``Normalize(mean, std)``).
+    """
+
+    def __init__(self, freqm, timem, norm_mean, norm_std, noise=False, std_factor=2.0):
+        self.freqm = freqm
+        self.timem = timem
+        self.norm_mean = norm_mean
+        self.norm_scale = 1.0 / (norm_std * std_factor)
+        self.noise = noise
+
+    def __call__(self, fbank):
+        B, T, F = fbank.shape
+        fbank = (fbank - self.norm_mean) * self.norm_scale
+
+        mask = None
+        if self.freqm != 0:
+            mask = _mask_bands(B, F, self.freqm, fbank.device)[:, None, :]
+        if self.timem != 0:
+            time_mask = _mask_bands(B, T, self.timem, fbank.device)[:, :, None]
+            mask = time_mask if mask is None else mask | time_mask
+        if mask is not None:
+            fbank = fbank.masked_fill(mask, -self.norm_mean * self.norm_scale)
+
+        if self.noise:
+            scale = torch.rand(B, 1, 1, device=fbank.device) / 10
+            fbank = fbank + torch.rand_like(fbank) * scale
+            shift = torch.randint(-10, 10, (B, 1), device=fbank.device)
+            index = (torch.arange(T, device=fbank.device)[None, :] - shift) % T
+            fbank = torch.gather(fbank, 1, index[:, :, None].expand(B, T, F))
+        return fbank
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(freqm={self.freqm}, timem={self.timem}, "
+            f"noise={self.noise})"
+        )
+
+
+class BatchAugmentCollate:
+    """Run a batch-level augmentation on one field after collation."""
+
+    def __init__(self, collate_fn, augment, key="audio"):
+        self.collate_fn = collate_fn
+        self.augment = augment
+        self.key = key
+
+    def __call__(self, batch):
+        out = self.collate_fn(batch)
+        out[self.key] = self.augment(out[self.key])
+        return out
+
+
+def _check(batch_size=16):
+    """``--audio_batch_specaug``: ``ASTProcessorTrain`` returns the fbank
+    untouched and the collate masks every sample exactly once, one frequency
+    band and one time band, everything else normalised."""
+    from omegaconf import OmegaConf
+
+    from datasets.modal_audio.processors.at_processor import ASTProcessorTrain
+
+    conf = dict(
+        sampling_rate=16000,
+        clip_duration=10,
+        n_clip=1,
+        target_length=1024,
+        mel_bins=128,
+        freqm=48,
+        timem=192,
+        noise_aug=False,
+    )
+    proc = ASTProcessorTrain(OmegaConf.create(dict(conf, batch_specaug=True)), None, None)
+    assert ASTProcessorTrain(OmegaConf.create(conf), None, None).batch_augment is None
+
+    torch.manual_seed(0)
+    fbank = proc.convert2fbank(torch.randn(1, 16000 * 10))
+    assert torch.equal(proc.transform(fbank), fbank)
+    collate = BatchAugmentCollate(
+        lambda b: {"audio": torch.stack([s["audio"] for s in b])}, proc.batch_augment
+    )
+    batch = collate([{"audio": proc.transform(fbank)} for _ in range(batch_size)])["audio"]
+
+    mean, std = proc.mean[0], proc.std[0]
+    ref = (fbank - mean) / std
+    fill = torch.tensor(-mean / std)
+    for out in batch:
+        masked = torch.isclose(out, fill)
+        freq, time = masked.all(0), masked.all(1)
+        for band, width in ((freq, conf["freqm"]), (time, conf["timem"])):
+            idx = band.nonzero().flatten()
+            # a second masking pass would leave a second band or a wider one
+            assert len(idx) < width
+            assert len(idx) == 0 or idx[-1] - idx[0] + 1 == len(idx)
+        changed = ~torch.isclose(out, ref)
+        assert torch.equal(changed, freq[None, :] | time[:, None])
+    print(f"[BatchSpecAugment] ok, {batch_size} samples masked once each")
+
+
+if __name__ == "__main__":
+    _check()
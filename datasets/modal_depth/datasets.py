@@ -10,16 +10,21 @@ from omegaconf import OmegaConf
 from easydict import EasyDict as edict
 
 from datasets.Sample import Sample, SampleCollator
+from datasets.annotation import ColumnarAnnotation
 from datasets.constants import DEPTH_META_DATA_DIR, DEPTH_DATA_DIR
+from datasets.modal_depth.depth_cache import DepthCache
 from util.logger import print_log
+from util.precision import get_policy
 from zmq import device
 from .data.scene_cls_template import SCENE_CLS_TEMPLATE
 from .processors.vt_processor import (
+    rgbd_conf,
     BlipCaptionProcessor,
     RGBD_Processor_Train,
     RGBD_Processor_Eval,
 )
 
+import numpy as np
 import torch
 
 # from open_clip_train.distributed import is_master
@@ -112,6 +117,22 @@ class RGBDBaseDataset(Dataset):
             self.rgbd_text_features =None
         
         self.device = torch.device(args.device) if not args.pin_mem else None
+        self.depth_cache = self.load_depth_cache(getattr(args, "rgbd_depth_cache", None))
+
+    def load_depth_cache(self, root):
+        if not DepthCache.exists(root):
+            if root is not None:
+                print_log(f"[RGBD] no depth cache at {root}, loading .pt disparity", "RGBD")
+            return None
+        cache = DepthCache(root)
+        if not cache.matches(rgbd_conf.max_depth, rgbd_conf.clamp_max_before_scale):
+            print_log(
+                f"[RGBD] depth cache {root} was built with max_depth {cache.max_depth}, "
+                f"clamp {cache.clamp_max_before_scale}; ignoring it",
+                "RGBD",
+            )
+            return None
+        return cache
 
     def __len__(self):
         return len(self.annotation)
@@ -123,12 +144,28 @@ class RGBDBaseDataset(Dataset):
         self.vis_processor = vis_processor
         self.text_processor = text_processor
 
+    def init_label_ids(self):
+        # precomputed class id per sample, looked up once instead of per call
+        self.label_ids = np.array(
+            [self.label2idx[l] for l in self.annotation.column("cleaned_label")],
+            dtype=np.int64,
+        )
+
     def __getitem__(self, index):
         rtn = dict()
         ann = self.annotation[index]
         img_path = os.path.join(DEPTH_DATA_DIR, ann["image_path"])
         disp_path = os.path.join(DEPTH_DATA_DIR, ann["disparity_path"])
-        rgb, depth = self.vis_processor(img_path=img_path, depth_path=disp_path, device=self.device)
+        # decode the image once, shared by the RGB-D processor and the openclip transform
+        pil = Image.open(img_path).convert("RGB")
+        depth = self.depth_cache.get(ann["disparity_path"]) if self.depth_cache is not None else None
+        rgb, depth = self.vis_processor(
+            img=pil,
+            depth_path=disp_path,
+            device=self.device,
+            depth=depth,
+            depth_normed=depth is not None,
+        )
         cleaned_label = ann["cleaned_label"]
         benchmark_label = ann["benchmark_label"] if "benchmark_label" in ann else None
 
@@ -137,8 +174,7 @@ class RGBDBaseDataset(Dataset):
         tokenized_caption = self.tokenizer([caption])[0]
 
         if self.args.use_openclip_transform:
-            rgb = Image.open(img_path).convert("RGB")
-            rgb = self.image_transform(rgb)
+            rgb = self.image_transform(pil)
         
         if self.args.depth_channel==3:
             depth = depth.repeat(3, 1, 1)
@@ -149,13 +185,13 @@ class RGBDBaseDataset(Dataset):
             "cleaned_label": self.text_processor(cleaned_label),
             "benchmark_label": self.text_processor(benchmark_label),
             "id": f"{index}_{img_path}",
-            "label": self.label2idx[cleaned_label],
+            "label": int(self.label_ids[index]),
             "caption": tokenized_caption,
         }
         
         if self.split == "train" and not self.args.use_text_branch:
             template_idx = random.randint(0,18)
-            text_feature = self.rgbd_text_features[cleaned_label][template_idx].to(dtype=torch.float16)
+            text_feature = self.rgbd_text_features[cleaned_label][template_idx].to(dtype=get_policy().feature_dtype)
             rtn.update({"text_feature": text_feature})
         
         return Sample(rtn)
@@ -191,9 +227,11 @@ class SUNRGBDDataset(RGBDBaseDataset):
             **kwargs,
         )
 
-        self.annotation = json.load(open(anno_path[split], "r"))
+        annotation = json.load(open(anno_path[split], "r"))
         if split == "train" and n_repeat_train > 1:
-            self.annotation = self.annotation * n_repeat_train
+            annotation = annotation * n_repeat_train
+        self.annotation = ColumnarAnnotation(annotation)
+        del annotation
 
         self.init_labels()
         
@@ -206,12 +244,12 @@ class SUNRGBDDataset(RGBDBaseDataset):
 
     def init_labels(self):
         labelset = set()
-        for ann in self.annotation:
-            cleaned_label = ann["cleaned_label"]
+        for cleaned_label in self.annotation.column("cleaned_label"):
             labelset.add(cleaned_label)
 
         self.idx2label = list(labelset)
         self.label2idx = {self.idx2label[i]: i for i in range(len(self.idx2label))}
+        self.init_label_ids()
         
         print_log(f"[SUN-RGBD] idx2label: {self.idx2label}.",'SUN-RGBD')
         print_log(f"[SUN-RGBD] label2idx: {self.label2idx}.",'SUN-RGBD')
@@ -246,7 +284,7 @@ class NYUDepthV2Dataset(RGBDBaseDataset):
             **kwargs,
         )
 
-        self.annotation = json.load(open(anno_path[split], "r"))
+        self.annotation = ColumnarAnnotation(json.load(open(anno_path[split], "r")))
         self.init_labels()
         
         print_log(
@@ -256,15 +294,17 @@ class NYUDepthV2Dataset(RGBDBaseDataset):
     def init_labels(self):
         labelset = set()
         map_to_others = set()
-        for ann in self.annotation:
-            cleaned_label = ann["cleaned_label"]
-            benchmark_label = ann["benchmark_label"]
+        for cleaned_label, benchmark_label in zip(
+            self.annotation.column("cleaned_label"),
+            self.annotation.column("benchmark_label"),
+        ):
             labelset.add(cleaned_label)
             if cleaned_label != benchmark_label:
                 map_to_others.add(cleaned_label)
 
         self.idx2label = list(labelset)
         self.label2idx = {self.idx2label[i]: i for i in range(len(self.idx2label))}
+        self.init_label_ids()
 
         self.other_idx = 100
         self.map_to_others = map_to_others
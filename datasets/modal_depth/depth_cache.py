@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from datasets.annotation import RaggedArray
+from datasets.constants import DEPTH_META_DATA_DIR, DEPTH_DATA_DIR
+from datasets.modal_depth.processors import transforms_rgbd as rgbd_T
+from util.logger import print_log
+
+
+class DepthCache:
+    """Read-only store of ``DepthNorm``-ed disparity maps.
+
+    Layout of ``root``::
+
+        meta.json       max_depth, clamp_max_before_scale, disparity paths
+        values.bin      raw float16, every map flattened and concatenated
+        offsets.npy     int64 (N + 1,), row i is values[offsets[i]:offsets[i + 1]]
+        shapes.npy      int64 (N, 2), H x W of every map
+
+    The maps are stored at full resolution right after ``DepthNorm``, so the
+    random crops of the train processor and the resize of the eval processor
+    still run on them; only the ``torch.load`` of the ``.pt`` file and the
+    clamp / scale are skipped.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.max_depth = meta["max_depth"]
+        self.clamp_max_before_scale = meta["clamp_max_before_scale"]
+        self.rows = {p: i for i, p in enumerate(meta["paths"])}
+        self.shapes = np.load(os.path.join(root, "shapes.npy"))
+        self.offsets = np.load(os.path.join(root, "offsets.npy"))
+        self._maps = None
+
+    @staticmethod
+    def exists(root):
+        return root is not None and os.path.exists(os.path.join(root, "meta.json"))
+
+    def matches(self, max_depth, clamp_max_before_scale):
+        return (
+            self.max_depth == max_depth
+            and self.clamp_max_before_scale == clamp_max_before_scale
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_maps"] = None
+        return state
+
+    def get(self, disparity_path):
+        """(1, H, W) float32 normalised disparity, or None if not cached."""
+        row = self.rows.get(disparity_path)
+        if row is None:
+            return None
+        if self._maps is None:
+            # mapped lazily so every DataLoader worker maps the file itself
+            values = np.memmap(
+                os.path.join(self.root, "values.bin"), dtype=np.float16, mode="r"
+            )
+            self._maps = RaggedArray(values, self.offsets)
+        h, w = self.shapes[row]
+        depth = np.asarray(self._maps[row], dtype=np.float32).reshape(1, h, w)
+        return torch.from_numpy(depth)
+
+
+def build_depth_cache(disparity_paths, root, max_depth=75, clamp_max_before_scale=True):
+    """Load and normalise every disparity map once and write a :class:`DepthCache`."""
+    os.makedirs(root, exist_ok=True)
+    disparity_paths = list(dict.fromkeys(disparity_paths))
+    depth_norm = rgbd_T.DepthNorm(
+        max_depth=max_depth, clamp_max_before_scale=clamp_max_before_scale
+    )
+    start = time.time()
+    shapes = np.zeros((len(disparity_paths), 2), dtype=np.int64)
+    offsets = np.zeros(len(disparity_paths) + 1, dtype=np.int64)
+    with open(os.path.join(root, "values.bin"), "wb") as f:
+        for i, path in enumerate(disparity_paths):
+            depth = torch.load(os.path.join(DEPTH_DATA_DIR, path))
+            if depth.ndim == 2:
+                depth = depth.unsqueeze(0)
+            # DepthNorm only touches the 4th channel
+            rgbd = torch.cat([torch.zeros(3, *depth.shape[1:]), depth.float()], dim=0)
+            depth = depth_norm(rgbd)[3].numpy().astype(np.float16)
+            f.write(depth.tobytes())
+            shapes[i] = depth.shape
+            offsets[i + 1] = offsets[i] + depth.size
+            if (i + 1) % 1000 == 0:
+                print_log(f"[DepthCache] {i + 1}/{len(disparity_paths)}", "DepthCache")
+
+    np.save(os.path.join(root, "shapes.npy"), shapes)
+    np.save(os.path.join(root, "offsets.npy"), offsets)
+    # meta.json last: its presence marks the cache complete
+    with open(os.path.join(root, "meta.json"), "w") as f:
+        json.dump(
+            dict(
+                max_depth=max_depth,
+                clamp_max_before_scale=clamp_max_before_scale,
+                paths=disparity_paths,
+            ),
+            f,
+        )
+    print_log(
+        f"[DepthCache] {len(disparity_paths)} maps, {offsets[-1] * 2 / 2**30:.2f} GB "
+        f"in {time.time() - start:.0f}s -> {root}",
+        "DepthCache",
+    )
+    return DepthCache(root)
+
+
+def get_args():
+    parser = argparse.ArgumentParser("Precompute normalised SUN RGB-D / NYUv2 disparity")
+    parser.add_argument(
+        "--anno",
+        type=str,
+        nargs="+",
+        default=[
+            f"{DEPTH_META_DATA_DIR}/SUN-RGBD_train.json",
+            f"{DEPTH_META_DATA_DIR}/SUN-RGBD_val.json",
+            f"{DEPTH_META_DATA_DIR}/NYU-Depth-v2_train.json",
+            f"{DEPTH_META_DATA_DIR}/NYU-Depth-v2_val.json",
+        ],
+    )
+    parser.add_argument("--output", type=str, required=True, help="cache dir")
+    parser.add_argument("--max_depth", type=float, default=75)
+    parser.add_argument("--no_clamp_max_before_scale", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    paths = []
+    for anno in args.anno:
+        paths.extend(ann["disparity_path"] for ann in json.load(open(anno, "r")))
+    build_depth_cache(
+        paths,
+        args.output,
+        max_depth=args.max_depth,
+        clamp_max_before_scale=not args.no_clamp_max_before_scale,
+    )
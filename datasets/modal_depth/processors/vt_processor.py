@@ -134,14 +134,22 @@ class RGBD_Processor_Train(BaseProcessor):
                 transforms.Normalize(mean=self.mean, std=self.std),
             ]
         )
+        # for depth maps already DepthNorm-ed by the depth cache
+        self.rgbd_transform_normed = transforms.Compose(self.rgbd_transform.transforms[1:])
 
-    def __call__(self, img_path, depth_path, device=None):
+    def __call__(
+        self, img_path=None, depth_path=None, device=None, img=None, depth=None, depth_normed=False
+    ):
         # here depth refers to disparity, in torch savefile format
         # note use ToTensor to scale image to [0,1] first
-        img = Image.open(img_path).convert("RGB")
+        # img / depth: already decoded PIL image / disparity tensor, skips the file reads
+        if img is None:
+            img = Image.open(img_path).convert("RGB")
         img = self.img_to_tensor(img)
 
-        depth = torch.load(depth_path)
+        if depth is None:
+            depth = torch.load(depth_path)
+            depth_normed = False
         if depth.ndim == 2:
             depth = depth.unsqueeze(0)
 
@@ -150,7 +158,10 @@ class RGBD_Processor_Train(BaseProcessor):
             rgbd = rgbd.to(device)
         
         #.to(device)
-        transform_rgbd = self.rgbd_transform(rgbd)
+        if depth_normed:
+            transform_rgbd = self.rgbd_transform_normed(rgbd)
+        else:
+            transform_rgbd = self.rgbd_transform(rgbd)
         
         img = transform_rgbd[0:3, ...]
         depth = transform_rgbd[3:4, ...]
@@ -248,19 +259,29 @@ class RGBD_Processor_Eval(BaseProcessor):
                 transforms.Normalize(mean=self.mean, std=self.std),
             ]
         )
+        # for depth maps already DepthNorm-ed by the depth cache
+        self.rgbd_transform_normed = transforms.Compose(self.rgbd_transform.transforms[1:])
 
-    def __call__(self, img_path, depth_path, device=None):
+    def __call__(
+        self, img_path=None, depth_path=None, device=None, img=None, depth=None, depth_normed=False
+    ):
         # here depth refers to disparity, in torch savefile format
         # note use ToTensor to scale image to [0,1] first
-        img = Image.open(img_path).convert("RGB")
+        if img is None:
+            img = Image.open(img_path).convert("RGB")
         img = self.img_to_tensor(img)
 
-        depth = torch.load(depth_path)
+        if depth is None:
+            depth = torch.load(depth_path)
+            depth_normed = False
         if depth.ndim == 2:
             depth = depth.unsqueeze(0)
 
         rgbd = torch.cat([img, depth], dim=0)
-        transform_rgbd = self.rgbd_transform(rgbd)
+        if depth_normed:
+            transform_rgbd = self.rgbd_transform_normed(rgbd)
+        else:
+            transform_rgbd = self.rgbd_transform(rgbd)
         img = transform_rgbd[0:3, ...]
         depth = transform_rgbd[3:4, ...]
 
@@ -13,6 +13,13 @@ import json
 import random
 from datasets.modal_video.rawvideo_util import RawVideoExtractor
 from datasets.Sample import Sample
+from datasets.annotation import ColumnarAnnotation, RaggedArray, StringArray
+from datasets.modal_video.frame_store import FrameStore
+from datasets.Video.uint8_transforms import (
+    frames_to_uint8,
+    resize_short_side,
+    center_crop,
+)
 
 try:
     from petrel_client.client import Client
@@ -40,6 +47,32 @@ from torchvision.transforms import (
     InterpolationMode,
 )
 
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def open_msrvtt_video(features_path, video_id):
+    video_path = os.path.join(features_path, "{}.mp4".format(video_id))
+
+    if video_path.startswith("s3://"):
+        video_path = video_path.replace("videos", "MSRVTT_Videos")
+        video_bytes = client.get(video_path, enable_stream=True)
+        assert video_bytes is not None, "Get video failed from {}".format(
+            video_path
+        )
+        video_path = video_bytes
+        if isinstance(video_path, bytes):
+            video_path = io.BytesIO(video_bytes)
+    return VideoReader(video_path, ctx=cpu(0))
+
+
+def load_frame_store(frame_store, feature_framerate, image_resolution):
+    if not FrameStore.exists(frame_store):
+        return None
+    store = FrameStore(frame_store)
+    store.check(feature_framerate, image_resolution)
+    return store
+
 
 class MSRVTT_DataLoader(Dataset):
     """MSRVTT dataset loader."""
@@ -55,8 +88,11 @@ class MSRVTT_DataLoader(Dataset):
         image_resolution=224,
         frame_order=0,
         slice_framepos=0,
+        frame_store=None,
     ):
-        self.data = pd.read_csv(csv_path)
+        self.data = ColumnarAnnotation(
+            pd.read_csv(csv_path), columns=["video_id", "sentence"]
+        )
         self.features_path = features_path
         self.feature_framerate = feature_framerate
         self.max_words = max_words
@@ -73,6 +109,12 @@ class MSRVTT_DataLoader(Dataset):
         self.rawVideoExtractor = RawVideoExtractor(
             framerate=feature_framerate, size=image_resolution
         )
+        # pre-extracted uint8 frames, see datasets/modal_video/frame_store.py
+        self.frame_store = load_frame_store(
+            frame_store, feature_framerate, image_resolution
+        )
+        # videos leave the workers as uint8 C x T x H x W
+        self.video_norm = (CLIP_MEAN, CLIP_STD)
         self.SPECIAL_TOKEN = {
             "CLS_TOKEN": "<|startoftext|>",
             "SEP_TOKEN": "<|endoftext|>",
@@ -87,10 +129,7 @@ class MSRVTT_DataLoader(Dataset):
                 CenterCrop(image_resolution),
                 lambda image: image.convert("RGB"),
                 ToTensor(),
-                Normalize(
-                    (0.48145466, 0.4578275, 0.40821073),
-                    (0.26862954, 0.26130258, 0.27577711),
-                ),
+                Normalize(CLIP_MEAN, CLIP_STD),
                 # Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
             ]
         )
@@ -146,18 +185,15 @@ class MSRVTT_DataLoader(Dataset):
         # max_video_length = 0
         max_video_length = [0] * len(choice_video_ids)
 
-        # T x 3 x H x W
-        # video = np.zeros((self.max_frames, 3, self.image_resolution, self.image_resolution), dtype=float)
-        video = np.zeros(
-            (
-                len(choice_video_ids),
-                self.max_frames,
-                1,
-                3,
-                self.image_resolution,
-                self.image_resolution,
-            ),
-            dtype=float,
+        # T x 3 x H x W, uint8; normalised on the device (self.video_norm)
+        video = torch.zeros(
+            len(choice_video_ids),
+            self.max_frames,
+            1,
+            3,
+            self.image_resolution,
+            self.image_resolution,
+            dtype=torch.uint8,
         )
 
         if s is None:
@@ -174,17 +210,7 @@ class MSRVTT_DataLoader(Dataset):
         # video_path = self.video_dict[video_id]
         for i, video_id in enumerate(choice_video_ids):
             video_path = os.path.join(self.features_path, "{}.mp4".format(video_id))
-
-            if video_path.startswith("s3://"):
-                video_path = video_path.replace("videos", "MSRVTT_Videos")
-                video_bytes = client.get(video_path, enable_stream=True)
-                assert video_bytes is not None, "Get video failed from {}".format(
-                    video_path
-                )
-                video_path = video_bytes
-                if isinstance(video_path, bytes):
-                    video_path = io.BytesIO(video_bytes)
-            vreader = VideoReader(video_path, ctx=cpu(0))
+            vreader = open_msrvtt_video(self.features_path, video_id)
 
             fps = vreader.get_avg_fps()
             f_start = 0 if start_time is None else int(start_time * fps)
@@ -218,12 +244,12 @@ class MSRVTT_DataLoader(Dataset):
                 else:
                     sample_pos = all_pos
 
-                patch_images = [
-                    Image.fromarray(f) for f in vreader.get_batch(sample_pos).asnumpy()
-                ]
-                patch_images = torch.stack(
-                    [self.transform(img) for img in patch_images]
+                # all frames resized / cropped in one batched op
+                patch_images = frames_to_uint8(vreader.get_batch(sample_pos).asnumpy())
+                patch_images = resize_short_side(
+                    patch_images, self.image_resolution, interpolation="bicubic"
                 )
+                patch_images = center_crop(patch_images, self.image_resolution)
 
                 patch_images = patch_images.unsqueeze(1)
 
@@ -248,6 +274,32 @@ class MSRVTT_DataLoader(Dataset):
         # print(video.shape, video_mask.shape)
         return video, video_mask
 
+    def _get_rawvideo_store(self, choice_video_ids):
+        video_mask = np.zeros((len(choice_video_ids), self.max_frames), dtype=np.int64)
+        video = torch.zeros(
+            len(choice_video_ids),
+            self.max_frames,
+            1,
+            3,
+            self.image_resolution,
+            self.image_resolution,
+            dtype=torch.uint8,
+        )
+        for i, video_id in enumerate(choice_video_ids):
+            if video_id not in self.frame_store:
+                # not extracted, decode this one
+                v, m = self._get_rawvideo_dec([video_id])
+                video[i], video_mask[i] = v[0], m[0]
+                continue
+            frames, slice_len = self.frame_store.sample(video_id, self.max_frames)
+            if slice_len < 1:
+                print("video id: {} missing in frame store".format(video_id))
+                continue
+            video[i][:slice_len, 0] = frames_to_uint8(frames)
+            video_mask[i][:slice_len] = 1
+
+        return video, video_mask
+
     def _get_rawvideo(self, choice_video_ids):
         video_mask = np.zeros((len(choice_video_ids), self.max_frames), dtype=np.int64)
         max_video_length = [0] * len(choice_video_ids)
@@ -318,16 +370,18 @@ class MSRVTT_DataLoader(Dataset):
         return video, video_mask
 
     def __getitem__(self, idx):
-        video_id = self.data["video_id"].values[idx]
-        sentence = self.data["sentence"].values[idx]
+        video_id = self.data.column("video_id")[idx]
+        sentence = self.data.column("sentence")[idx]
 
         pairs_text, choice_video_ids = self._get_text(
             video_id, sentence
         )
         # video, video_mask = self._get_rawvideo(choice_video_ids)
-        video, video_mask = self._get_rawvideo_dec(choice_video_ids)
+        if self.frame_store is not None:
+            video, video_mask = self._get_rawvideo_store(choice_video_ids)
+        else:
+            video, video_mask = self._get_rawvideo_dec(choice_video_ids)
         # return pairs_text, pairs_mask, pairs_segment, video, video_mask
-        video = torch.as_tensor(video).float()
         video = video.squeeze(2).squeeze(0).permute(1,0,2,3 )
         
         vid = int(video_id.replace("video", ""))
@@ -356,9 +410,10 @@ class MSRVTT_TrainDataLoader(Dataset):
         image_resolution=224,
         frame_order=0,
         slice_framepos=0,
+        frame_store=None,
     ):
-        self.csv = pd.read_csv(csv_path)
-        self.data = json.load(open(json_path, "r"))
+        self.csv = ColumnarAnnotation(pd.read_csv(csv_path), columns=["video_id"])
+        data = json.load(open(json_path, "r"))
         self.features_path = features_path
         self.feature_framerate = feature_framerate
         self.max_words = max_words
@@ -375,37 +430,49 @@ class MSRVTT_TrainDataLoader(Dataset):
         self.unfold_sentences = unfold_sentences
         self.sample_len = 0
         if self.unfold_sentences:
-            train_video_ids = list(self.csv["video_id"].values)
-            self.sentences_dict = {}
-            for itm in self.data["sentences"]:
-                if itm["video_id"] in train_video_ids:
-                    self.sentences_dict[len(self.sentences_dict)] = (
-                        itm["video_id"],
-                        itm["caption"],
-                    )
+            train_video_ids = set(self.csv.column("video_id"))
+            sentences = [
+                itm
+                for itm in data["sentences"]
+                if itm["video_id"] in train_video_ids
+            ]
+            # (video_id, caption) pairs kept as two packed string columns
+            self.sentences_dict = ColumnarAnnotation.from_columns(
+                len(sentences),
+                video_id=StringArray(itm["video_id"] for itm in sentences),
+                caption=StringArray(itm["caption"] for itm in sentences),
+            )
             self.sample_len = len(self.sentences_dict)
         else:
-            num_sentences = 0
-            self.sentences = defaultdict(list)
-            s_video_id_set = set()
-            for itm in self.data["sentences"]:
-                self.sentences[itm["video_id"]].append(itm["caption"])
-                num_sentences += 1
-                s_video_id_set.add(itm["video_id"])
+            sentences = defaultdict(list)
+            for itm in data["sentences"]:
+                sentences[itm["video_id"]].append(itm["caption"])
+
+            # captions of the i-th csv video are row i of a CSR string array
+            self.sentences = RaggedArray.from_lists(
+                [sentences[vid] for vid in self.csv.column("video_id")], dtype=str
+            )
 
             # Use to find the clips in the same video
             self.parent_ids = {}
             self.children_video_ids = defaultdict(list)
-            for itm in self.data["videos"]:
+            for itm in data["videos"]:
                 vid = itm["video_id"]
                 url_posfix = itm["url"].split("?v=")[-1]
                 self.parent_ids[vid] = url_posfix
                 self.children_video_ids[url_posfix].append(vid)
             self.sample_len = len(self.csv)
+        del data
 
         self.rawVideoExtractor = RawVideoExtractor(
             framerate=feature_framerate, size=image_resolution
         )
+        # pre-extracted uint8 frames, see datasets/modal_video/frame_store.py
+        self.frame_store = load_frame_store(
+            frame_store, feature_framerate, image_resolution
+        )
+        # videos leave the workers as uint8 C x T x H x W
+        self.video_norm = (CLIP_MEAN, CLIP_STD)
         self.SPECIAL_TOKEN = {
             "CLS_TOKEN": "<|startoftext|>",
             "SEP_TOKEN": "<|endoftext|>",
@@ -419,10 +486,7 @@ class MSRVTT_TrainDataLoader(Dataset):
                 CenterCrop(image_resolution),
                 lambda image: image.convert("RGB"),
                 ToTensor(),
-                Normalize(
-                    (0.48145466, 0.4578275, 0.40821073),
-                    (0.26862954, 0.26130258, 0.27577711),
-                ),
+                Normalize(CLIP_MEAN, CLIP_STD),
                 # Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
             ]
         )
@@ -430,13 +494,13 @@ class MSRVTT_TrainDataLoader(Dataset):
     def __len__(self):
         return self.sample_len
 
-    def _get_text(self, video_id, caption=None):
+    def _get_text(self, video_id, caption=None, idx=None):
         # k = 1
         choice_video_ids = [video_id]
         if caption is not None:
             tokenized_caption = self.tokenizer([caption])[0]
         else:
-            tokenized_caption = self._get_single_text(video_id)
+            tokenized_caption = self._get_single_text(idx)
 
         return tokenized_caption, choice_video_ids
 
@@ -473,9 +537,10 @@ class MSRVTT_TrainDataLoader(Dataset):
 
         # return pairs_text, pairs_mask, pairs_segment, choice_video_ids
 
-    def _get_single_text(self, video_id):
-        rind = random.randint(0, len(self.sentences[video_id]) - 1)
-        caption = self.sentences[video_id][rind]
+    def _get_single_text(self, idx):
+        captions = self.sentences[idx]
+        rind = random.randint(0, len(captions) - 1)
+        caption = captions[rind]
         words = self.tokenizer(caption)[0]
         return words
 
@@ -487,18 +552,15 @@ class MSRVTT_TrainDataLoader(Dataset):
         # max_video_length = 0
         max_video_length = [0] * len(choice_video_ids)
 
-        # T x 3 x H x W
-        # video = np.zeros((self.max_frames, 3, self.image_resolution, self.image_resolution), dtype=float)
-        video = np.zeros(
-            (
-                len(choice_video_ids),
-                self.max_frames,
-                1,
-                3,
-                self.image_resolution,
-                self.image_resolution,
-            ),
-            dtype=float,
+        # T x 3 x H x W, uint8; normalised on the device (self.video_norm)
+        video = torch.zeros(
+            len(choice_video_ids),
+            self.max_frames,
+            1,
+            3,
+            self.image_resolution,
+            self.image_resolution,
+            dtype=torch.uint8,
         )
 
         if s is None:
@@ -515,17 +577,7 @@ class MSRVTT_TrainDataLoader(Dataset):
         # video_path = self.video_dict[video_id]
         for i, video_id in enumerate(choice_video_ids):
             video_path = os.path.join(self.features_path, "{}.mp4".format(video_id))
-
-            if video_path.startswith("s3://"):
-                video_path = video_path.replace("videos", "MSRVTT_Videos")
-                video_bytes = client.get(video_path, enable_stream=True)
-                assert video_bytes is not None, "Get video failed from {}".format(
-                    video_path
-                )
-                video_path = video_bytes
-                if isinstance(video_path, bytes):
-                    video_path = io.BytesIO(video_bytes)
-            vreader = VideoReader(video_path, ctx=cpu(0))
+            vreader = open_msrvtt_video(self.features_path, video_id)
 
             fps = vreader.get_avg_fps()
             f_start = 0 if start_time is None else int(start_time * fps)
@@ -560,12 +612,12 @@ class MSRVTT_TrainDataLoader(Dataset):
                 else:
                     sample_pos = all_pos
 
-                patch_images = [
-                    Image.fromarray(f) for f in vreader.get_batch(sample_pos).asnumpy()
-                ]
-                patch_images = torch.stack(
-                    [self.transform(img) for img in patch_images]
+                # all frames resized / cropped in one batched op
+                patch_images = frames_to_uint8(vreader.get_batch(sample_pos).asnumpy())
+                patch_images = resize_short_side(
+                    patch_images, self.image_resolution, interpolation="bicubic"
                 )
+                patch_images = center_crop(patch_images, self.image_resolution)
 
                 patch_images = patch_images.unsqueeze(1)
 
@@ -589,6 +641,32 @@ class MSRVTT_TrainDataLoader(Dataset):
         # print(video.shape, video_mask.shape)
         return video, video_mask
 
+    def _get_rawvideo_store(self, choice_video_ids):
+        video_mask = np.zeros((len(choice_video_ids), self.max_frames), dtype=np.int64)
+        video = torch.zeros(
+            len(choice_video_ids),
+            self.max_frames,
+            1,
+            3,
+            self.image_resolution,
+            self.image_resolution,
+            dtype=torch.uint8,
+        )
+        for i, video_id in enumerate(choice_video_ids):
+            if video_id not in self.frame_store:
+                # not extracted, decode this one
+                v, m = self._get_rawvideo_dec([video_id])
+                video[i], video_mask[i] = v[0], m[0]
+                continue
+            frames, slice_len = self.frame_store.sample(video_id, self.max_frames)
+            if slice_len < 1:
+                print("video id: {} missing in frame store".format(video_id))
+                continue
+            video[i][:slice_len, 0] = frames_to_uint8(frames)
+            video_mask[i][:slice_len] = 1
+
+        return video, video_mask
+
     def _get_rawvideo(self, choice_video_ids):
         video_mask = np.zeros((len(choice_video_ids), self.max_frames), dtype=np.int64)
         max_video_length = [0] * len(choice_video_ids)
@@ -660,13 +738,16 @@ class MSRVTT_TrainDataLoader(Dataset):
 
     def __getitem__(self, idx):
         if self.unfold_sentences:
-            video_id, caption = self.sentences_dict[idx]
+            video_id = self.sentences_dict.column("video_id")[idx]
+            caption = self.sentences_dict.column("caption")[idx]
         else:
-            video_id, caption = self.csv["video_id"].values[idx], None
-        tokenized_caption, choice_video_ids = self._get_text(video_id, caption)
+            video_id, caption = self.csv.column("video_id")[idx], None
+        tokenized_caption, choice_video_ids = self._get_text(video_id, caption, idx)
         # video, video_mask = self._get_rawvideo(choice_video_ids)
-        video, video_mask = self._get_rawvideo_dec(choice_video_ids)
-        video = torch.as_tensor(video).float()
+        if self.frame_store is not None:
+            video, video_mask = self._get_rawvideo_store(choice_video_ids)
+        else:
+            video, video_mask = self._get_rawvideo_dec(choice_video_ids)
         video = video.squeeze(2).squeeze(0).permute(1,0,2,3 )
 
         rtn = {"caption": tokenized_caption, "video": video}
@@ -685,6 +766,7 @@ def dataloader_msrvtt_train(args, tokenizer):
         unfold_sentences=args.expand_msrvtt_sentences,
         frame_order=args.video_train_frame_order,
         slice_framepos=args.video_slice_framepos,
+        frame_store=args.video_frame_store,
     )
 
     return msrvtt_dataset
@@ -700,6 +782,7 @@ def dataloader_msrvtt_test(args, tokenizer, subset="test"):
         max_frames=args.video_num_frames,
         frame_order=args.video_eval_frame_order,
         slice_framepos=args.video_slice_framepos,
+        frame_store=args.video_frame_store,
     )
 
     return msrvtt_testset
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import logging
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+from torchvision.transforms import Compose, Resize, CenterCrop, InterpolationMode
+
+
+def sample_positions(fps, num_video_frames, feature_framerate):
+    """Frame indices the MSRVTT loaders decode: every ``fps / feature_framerate``
+    frame of the video, plus the last frame used for padding."""
+    f_end = num_video_frames - 1
+    if f_end < 0:
+        return [], f_end
+    t_stride = max(int(round(float(fps) / int(feature_framerate))), 1)
+    return list(range(0, f_end + 1, t_stride)), f_end
+
+
+class FrameStore:
+    """Read-only store of pre-extracted, resized uint8 video frames.
+
+    Layout of ``root``::
+
+        meta.json           feature_framerate, image_resolution, num_shards, video_ids
+        index.npy           int64 (num_videos, 3): shard, first row, number of rows
+        shard_XXX.bin       uint8 rows of (image_resolution, image_resolution, 3)
+
+    Every video stores its frames sampled at ``feature_framerate`` followed by
+    one extra row holding the last frame of the video, which the loaders use to
+    pad short clips. Videos that failed to decode have shard ``-1``.
+    Shards are memory mapped lazily so every DataLoader worker maps its own.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.feature_framerate = meta["feature_framerate"]
+        self.image_resolution = meta["image_resolution"]
+        self.num_shards = meta["num_shards"]
+        self.video_rows = {vid: i for i, vid in enumerate(meta["video_ids"])}
+        self.index = np.load(os.path.join(root, "index.npy"))
+        self._shards = None
+
+    @staticmethod
+    def exists(root):
+        return root is not None and os.path.exists(os.path.join(root, "meta.json"))
+
+    def check(self, feature_framerate, image_resolution):
+        assert (
+            self.feature_framerate == feature_framerate
+            and self.image_resolution == image_resolution
+        ), (
+            f"frame store {self.root} was built with framerate {self.feature_framerate} "
+            f"and resolution {self.image_resolution}, loader wants "
+            f"{feature_framerate} / {image_resolution}"
+        )
+
+    def _open(self):
+        res = self.image_resolution
+        self._shards = []
+        for k in range(self.num_shards):
+            path = os.path.join(self.root, f"shard_{k:03d}.bin")
+            if os.path.getsize(path) == 0:
+                self._shards.append(np.zeros((0, res, res, 3), dtype=np.uint8))
+            else:
+                self._shards.append(
+                    np.memmap(path, dtype=np.uint8, mode="r").reshape(-1, res, res, 3)
+                )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    def __contains__(self, video_id):
+        return video_id in self.video_rows
+
+    def get(self, video_id):
+        """All stored rows of ``video_id`` (sampled frames + last frame) or None."""
+        if self._shards is None:
+            self._open()
+        row = self.video_rows.get(video_id)
+        if row is None:
+            return None
+        shard, start, count = self.index[row]
+        if shard < 0:
+            return None
+        return self._shards[shard][start : start + count]
+
+    def sample(self, video_id, max_frames):
+        """Return ``(frames, length)``: uint8 (max_frames, H, W, 3) picked the same
+        way as ``_get_rawvideo_dec``, and the number of frames before padding."""
+        rows = self.get(video_id)
+        if rows is None or len(rows) < 2:
+            return None, 0
+        all_pos, tail = rows[:-1], rows[-1:]
+        if len(all_pos) > max_frames:
+            sel = np.linspace(0, len(all_pos) - 1, num=max_frames, dtype=int)
+            return all_pos[sel], max_frames
+        if len(all_pos) < max_frames:
+            pad = np.repeat(tail, max_frames - len(all_pos), axis=0)
+            return np.concatenate((all_pos, pad), axis=0), max_frames
+        return np.asarray(all_pos), max_frames
+
+
+def _extract_shard(job):
+    shard, video_ids, features_path, root, feature_framerate, image_resolution = job
+    from datasets.modal_video.dataloader_msrvtt_retrieval import open_msrvtt_video
+
+    resize = Compose(
+        [
+            Resize(image_resolution, interpolation=InterpolationMode.BICUBIC),
+            CenterCrop(image_resolution),
+            lambda image: image.convert("RGB"),
+        ]
+    )
+    index = []
+    n_rows = 0
+    with open(os.path.join(root, f"shard_{shard:03d}.bin"), "wb") as f:
+        for video_id in video_ids:
+            try:
+                vreader = open_msrvtt_video(features_path, video_id)
+                all_pos, f_end = sample_positions(
+                    vreader.get_avg_fps(), len(vreader), feature_framerate
+                )
+                if len(all_pos) == 0:
+                    raise ValueError("empty video")
+                frames = vreader.get_batch(all_pos + [f_end]).asnumpy()
+            except Exception as e:
+                print(f"[FrameStore] skip {video_id}: {e}")
+                index.append((video_id, -1, 0, 0))
+                continue
+            frames = np.stack([np.asarray(resize(Image.fromarray(x))) for x in frames])
+            f.write(np.ascontiguousarray(frames, dtype=np.uint8).tobytes())
+            index.append((video_id, shard, n_rows, len(frames)))
+            n_rows += len(frames)
+    return index
+
+
+def build_frame_store(
+    video_ids,
+    features_path,
+    root,
+    feature_framerate=1,
+    image_resolution=224,
+    num_shards=16,
+    num_workers=8,
+):
+    """Decode every video once and write a :class:`FrameStore` to ``root``."""
+    os.makedirs(root, exist_ok=True)
+    video_ids = list(dict.fromkeys(video_ids))
+    num_shards = max(1, min(num_shards, len(video_ids)))
+    jobs = [
+        (k, video_ids[k::num_shards], features_path, root, feature_framerate, image_resolution)
+        for k in range(num_shards)
+    ]
+    start = time.time()
+    with Pool(num_workers) as pool:
+        results = pool.map(_extract_shard, jobs)
+    rows = {}
+    for shard_index in results:
+        for video_id, shard, first, count in shard_index:
+            rows[video_id] = (shard, first, count)
+    index = np.array([rows[vid] for vid in video_ids], dtype=np.int64).reshape(-1, 3)
+    np.save(os.path.join(root, "index.npy"), index)
+    # meta.json last: its presence marks the store complete
+    with open(os.path.join(root, "meta.json"), "w") as f:
+        json.dump(
+            dict(
+                feature_framerate=feature_framerate,
+                image_resolution=image_resolution,
+                num_shards=num_shards,
+                video_ids=video_ids,
+            ),
+            f,
+        )
+    logging.info(
+        f"[FrameStore] {len(video_ids)} videos ({int((index[:, 0] < 0).sum())} failed), "
+        f"{int(index[:, 2].sum())} frames in {time.time() - start:.0f}s -> {root}"
+    )
+    return FrameStore(root)
+
+
+def benchmark_frame_store(store, features_path, video_ids, max_frames=12):
+    """Seconds per video for decord decode + resize versus reading ``store``."""
+    from datasets.modal_video.dataloader_msrvtt_retrieval import open_msrvtt_video
+
+    resize = Compose(
+        [
+            Resize(store.image_resolution, interpolation=InterpolationMode.BICUBIC),
+            CenterCrop(store.image_resolution),
+        ]
+    )
+    dec_t, store_t = 0.0, 0.0
+    n = 0
+    for video_id in video_ids:
+        if store.get(video_id) is None:
+            continue
+        t0 = time.time()
+        vreader = open_msrvtt_video(features_path, video_id)
+        all_pos, _ = sample_positions(
+            vreader.get_avg_fps(), len(vreader), store.feature_framerate
+        )
+        sel = np.linspace(0, len(all_pos) - 1, num=min(max_frames, len(all_pos)), dtype=int)
+        frames = vreader.get_batch([all_pos[i] for i in sel]).asnumpy()
+        [resize(Image.fromarray(x)) for x in frames]
+        t1 = time.time()
+        frames, _ = store.sample(video_id, max_frames)
+        np.ascontiguousarray(frames)
+        t2 = time.time()
+        dec_t += t1 - t0
+        store_t += t2 - t1
+        n += 1
+    if n == 0:
+        return None, None
+    dec_t, store_t = dec_t / n, store_t / n
+    logging.info(
+        f"[FrameStore] {n} videos, decord {dec_t * 1000:.1f}ms, "
+        f"store {store_t * 1000:.1f}ms, speed-up {dec_t / max(store_t, 1e-9):.1f}x"
+    )
+    return dec_t, store_t
+
+
+def get_args():
+    parser = argparse.ArgumentParser("Extract MSRVTT frames into a FrameStore")
+    parser.add_argument("--csv", type=str, nargs="+", required=True, help="MSRVTT csv files")
+    parser.add_argument("--features_path", type=str, required=True, help="video dir")
+    parser.add_argument("--output", type=str, required=True, help="frame store dir")
+    parser.add_argument("--feature_framerate", type=int, default=1)
+    parser.add_argument("--image_resolution", type=int, default=224)
+    parser.add_argument("--num_shards", type=int, default=16)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument(
+        "--benchmark", type=int, default=0, help="benchmark on N videos after building"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import pandas as pd
+
+    logging.basicConfig(level=logging.INFO)
+    args = get_args()
+    video_ids = []
+    for csv_path in args.csv:
+        video_ids.extend(pd.read_csv(csv_path)["video_id"].tolist())
+    store = build_frame_store(
+        video_ids,
+        args.features_path,
+        args.output,
+        feature_framerate=args.feature_framerate,
+        image_resolution=args.image_resolution,
+        num_shards=args.num_shards,
+        num_workers=args.num_workers,
+    )
+    if args.benchmark > 0:
+        benchmark_frame_store(store, args.features_path, video_ids[: args.benchmark])
@@ -0,0 +1,89 @@
+# --------------------------------------------------------
+# Selective activation checkpointing: how many leading transformer blocks
+# of each modality to recompute in backward, from a memory budget.
+# Activation sizes follow Korthikanti et al., "Reducing Activation
+# Recomputation in Large Transformer Models", 2022.
+# --------------------------------------------------------
+from util.logger import print_log
+
+
+def parse_budgets(specs):
+    """``["video:6", "audio:4"]`` -> ``{"video": 6.0, "audio": 4.0}`` (GB)."""
+    budgets = {}
+    for spec in specs or []:
+        modal, gb = spec.split(":")
+        budgets[modal] = float(gb)
+    return budgets
+
+
+class CheckpointPlan:
+    """Per-modality number of leading blocks run under ``checkpoint``.
+
+    A block keeps ``34 * dim`` bytes of half-precision activations per token
+    for backward, plus ``5 * heads * seq_len`` for the attention scores when
+    attention is not fused (flash attention stores none). A checkpointed
+    block keeps only its fp32 input (``4 * dim`` bytes per token) and
+    recomputes its forward in backward, about 1/3 of its training cost.
+    The plan is the fewest checkpointed blocks whose activations fit the
+    modality's budget; it is made on the first batch of a modality and
+    redone when a later batch has more tokens.
+    """
+
+    def __init__(self, budgets, depth, dim, num_heads, flash_attn=False, logger=None):
+        self.budgets = budgets
+        self.depth = depth
+        self.dim = dim
+        self.num_heads = num_heads
+        self.flash_attn = flash_attn
+        self.logger = logger
+        # modal -> (tokens, seq_len, blocks)
+        self.plans = {}
+
+    def block_bytes(self, tokens, seq_len):
+        per_token = 34 * self.dim
+        if not self.flash_attn:
+            per_token += 5 * self.num_heads * seq_len
+        return tokens * per_token
+
+    def checkpointed_bytes(self, tokens):
+        return tokens * 4 * self.dim
+
+    def activation_bytes(self, tokens, seq_len, blocks):
+        return (self.depth - blocks) * self.block_bytes(tokens, seq_len) + blocks * (
+            self.checkpointed_bytes(tokens)
+        )
+
+    def blocks_for(self, modal, tokens, seq_len):
+        """Leading blocks to checkpoint for a batch of ``tokens`` tokens
+        (batch x sequence, padding excluded) of length ``seq_len``."""
+        if modal not in self.budgets:
+            return 0
+        plan = self.plans.get(modal)
+        if plan is not None and tokens <= plan[0] and seq_len <= plan[1]:
+            return plan[2]
+        budget = self.budgets[modal] * 2**30
+        blocks = next(
+            (
+                n
+                for n in range(self.depth + 1)
+                if self.activation_bytes(tokens, seq_len, n) <= budget
+            ),
+            self.depth,
+        )
+        self.plans[modal] = (tokens, seq_len, blocks)
+        self.report(modal)
+        return blocks
+
+    def report(self, modal):
+        tokens, seq_len, blocks = self.plans[modal]
+        full = self.activation_bytes(tokens, seq_len, 0)
+        planned = self.activation_bytes(tokens, seq_len, blocks)
+        fits = planned <= self.budgets[modal] * 2**30
+        print_log(
+            f"[CheckpointPlan] {modal}: checkpoint {blocks}/{self.depth} blocks for "
+            f"{tokens} tokens (seq {seq_len}), activations {full / 2**30:.2f} -> "
+            f"{planned / 2**30:.2f} GB (budget {self.budgets[modal]:.1f} GB"
+            f"{'' if fits else ', not met'}), ~{100 * blocks / self.depth / 3:.0f}% "
+            f"more encoder compute",
+            logger=self.logger,
+        )
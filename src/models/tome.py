@@ -0,0 +1,97 @@
+# --------------------------------------------------------
+# Token merging (ToMe) for inference, see
+# Bolya et al., "Token Merging: Your ViT But Faster", ICLR 2023
+# --------------------------------------------------------
+import math
+import time
+
+import torch
+
+from util.logger import print_log
+
+
+def bipartite_soft_matching(metric, r, class_token=True):
+    """Merge ``r`` tokens of ``metric`` [N, L, C] by bipartite soft matching.
+
+    Tokens are split alternately into sets A and B, every A token is matched
+    to its most similar B token (cosine), and the ``r`` best matched A tokens
+    are merged into their partner. The CLS token is never merged.
+    Returns a function that applies the same merge to any [N, L, *] tensor.
+    """
+    protected = int(class_token)
+    r = min(r, (metric.shape[1] - protected) // 2)
+    if r <= 0:
+        return lambda x, mode="mean": x
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[..., ::2, :], metric[..., 1::2, :]
+        scores = a @ b.transpose(-1, -2)
+        if class_token:
+            scores[..., 0, :] = -math.inf
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]  # unmerged A tokens
+        src_idx = edge_idx[..., :r, :]  # merged A tokens
+        dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
+        if class_token:
+            # keep the CLS token (A[0], never merged) in front
+            unm_idx = unm_idx.sort(dim=1)[0]
+
+    def merge(x, mode="mean"):
+        src, dst = x[..., ::2, :], x[..., 1::2, :]
+        n, t1, c = src.shape
+        unm = src.gather(dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = src.gather(dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+        return torch.cat([unm, dst], dim=1)
+
+    return merge
+
+
+def merge_wavg(merge, x, size=None):
+    """Size-weighted average merge; ``size`` [N, L, 1] counts the original
+    tokens behind every merged token."""
+    if size is None:
+        size = torch.ones_like(x[..., 0, None])
+    x = merge(x * size, mode="sum")
+    size = merge(size, mode="sum")
+    return x / size, size
+
+
+def merge_tokens(x, ratio, size=None, class_token=True):
+    """Merge ``ratio`` of the current non-CLS tokens of ``x`` [N, L, D]."""
+    r = int(ratio * (x.shape[1] - int(class_token)))
+    merge = bipartite_soft_matching(x, r, class_token=class_token)
+    return merge_wavg(merge, x, size)
+
+
+def token_merge_sweep(model, modal, ratios, run_eval, logger=None):
+    """Run ``run_eval()`` once per merge ratio of ``modal`` and log the metrics
+    next to the eval wall time, then restore the configured ratio."""
+    default = model.merge_ratio[modal]
+    results = []
+    for ratio in ratios:
+        model.merge_ratio[modal] = ratio
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.time()
+        metrics = run_eval()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+        results.append((ratio, elapsed, metrics))
+        print_log(
+            f"[ToMe] {modal} merge ratio {ratio:.2f}: {elapsed:.1f}s, metrics {metrics}",
+            logger=logger,
+        )
+    model.merge_ratio[modal] = default
+
+    base = results[0][1]
+    for ratio, elapsed, _ in results:
+        print_log(
+            f"[ToMe] {modal} ratio {ratio:.2f}: {base / max(elapsed, 1e-6):.2f}x eval speed",
+            logger=logger,
+        )
+    return results
@@ -19,16 +19,20 @@ import torch.nn.functional as F
 from knn_cuda import KNN
 from clip import model
 from util import misc
+from util.precision import get_policy
 import timm
 
 from timm.layers import trunc_normal_
 from flash_attn.modules.mha import MHA as FlashMHA
 from flash_attn.modules.mlp import Mlp as FlashMlp
+from flash_attn.bert_padding import pad_input, unpad_input
 from timm.models._manipulate import checkpoint_seq
 
 import numpy as np
 from torch.utils.checkpoint import checkpoint
 from util.pos_embed import build_2d_sincos_posemb
+from src.models.tome import merge_tokens
+from src.models.checkpoint_plan import CheckpointPlan, parse_budgets
 from einops import rearrange
 
 # sin-cos position encoding
@@ -79,6 +83,12 @@ class Flash_Block(timm.models.vision_transformer.Block):
         mlp_width = int(dim * 4)
         self.mlp = FlashMlp(dim, hidden_features=mlp_width, activation=QuickGELU())
 
+    def forward(self, x: torch.Tensor, **mixer_kwargs) -> torch.Tensor:
+        # mixer_kwargs: cu_seqlens / max_seqlen for unpadded (varlen) tokens
+        x = x + self.drop_path1(self.ls1(self.attn(self.norm1(x), **mixer_kwargs)))
+        x = x + self.drop_path2(self.ls2(self.mlp(self.norm2(x))))
+        return x
+
 
 class MoEMlp(timm.layers.Mlp):
     def __init__(self, in_features, hidden_features):
@@ -116,8 +126,8 @@ class Flash_MoE_Block(timm.models.vision_transformer.Block):
         mlp_width = int(dim * 4)
         self.mlp = MoEMlp(dim, mlp_width)
 
-    def forward(self, x: torch.Tensor, modal) -> torch.Tensor:
-        x = x + self.drop_path1(self.ls1(self.attn(self.norm1(x))))
+    def forward(self, x: torch.Tensor, modal, **mixer_kwargs) -> torch.Tensor:
+        x = x + self.drop_path1(self.ls1(self.attn(self.norm1(x), **mixer_kwargs)))
         x = x + self.drop_path2(self.ls2(self.mlp(self.norm2(x), modal)))
         return x
 
@@ -540,6 +550,25 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
         
         self.use_moe_loss = args.use_moe_loss
 
+        # token merging between blocks at inference, fraction of tokens per block
+        self.merge_ratio = {
+            "video": args.video_merge_ratio,
+            "audio": args.audio_merge_ratio,
+        }
+
+        # selective activation checkpointing, modalities without a budget
+        # follow grad_checkpointing (all blocks or none)
+        budgets = parse_budgets(getattr(args, "ckpt_memory_budget", None))
+        self.checkpoint_plan = None
+        if budgets:
+            self.checkpoint_plan = CheckpointPlan(
+                budgets,
+                depth=len(self.blocks),
+                dim=self.embed_dim,
+                num_heads=kwargs.get("num_heads", 12),
+                flash_attn=self.use_flash_attn,
+            )
+
         self.apply(self._init_weights)
 
         if self.use_modality_adapter:
@@ -602,16 +631,29 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
 
         return x_masked, mask, ids_restore
 
-    def random_masking_2d(self, x, mask_t_prob, mask_f_prob, audio_dataset="audioset"):
+    def random_masking_2d(
+        self,
+        x,
+        mask_t_prob,
+        mask_f_prob,
+        audio_dataset="audioset",
+        grid=None,
+        time_valid=None,
+    ):
         """
         2D: Spectrogram (masking t and f under mask_t_prob and mask_f_prob)
         Perform per-sample random masking by per-sample shuffling.
         Per-sample shuffling is done by argsort random noise.
         x: [N, L, D], sequence
+        grid: (T, F) patch grid of x, defaults to the full-length grid of audio_dataset
+        time_valid: [N, T] bool, False for time patches that only cover padding;
+            returned as the [N, L'] token mask of the kept patches
         """
 
         N, L, D = x.shape  # batch, length, dim
-        if self.use_custom_patch:
+        if grid is not None:
+            T, F = grid
+        elif self.use_custom_patch:
             if audio_dataset == "audioset":
                 # for AS
                 # T = 101  # 64,101
@@ -660,6 +702,8 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
         # x_masked = torch.gather(x, dim=1, index=index)
         # x_masked = x_masked.reshape(N,len_keep_T*F,D)
         x = torch.gather(x, dim=1, index=index)  # N, len_keep_T(T'), F, D
+        if time_valid is not None:
+            time_valid = torch.gather(time_valid, dim=1, index=ids_keep)
 
         # mask F
         # x = x.reshape(N, T, F, D)
@@ -678,29 +722,78 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
         # x_masked = x_masked.reshape(N,len_keep*T,D)
         x_masked = x_masked.reshape(N, len_keep_F * len_keep_T, D)
 
-        return x_masked, None, None
+        if time_valid is not None:
+            # token order is T' major, F' minor
+            time_valid = time_valid.repeat_interleave(len_keep_F, dim=1)
+        return x_masked, time_valid, None
+
+    def audio_padding_mask(self, modal, n_frames, x_len):
+        """Patch grid (T, F) of a (N, n_frames, 128) fbank batch and the [N, T]
+        mask of time patches that start inside the valid frames."""
+        proj = self.patch_embed[modal].proj
+        k_t, k_f = proj.kernel_size
+        s_t, s_f = proj.stride
+        T = (n_frames - k_t) // s_t + 1
+        F = (self.patch_embed[modal].img_size[1] - k_f) // s_f + 1
+        if x_len is None:
+            return (T, F), None
+        starts = torch.arange(T, device=x_len.device) * s_t
+        return (T, F), starts[None, :] < x_len[:, None]
+
+    def num_checkpointed_blocks(self, x, modal, seq_len=None):
+        """Leading blocks to run under activation checkpointing for ``x``."""
+        if torch.jit.is_scripting() or not torch.is_grad_enabled():
+            return 0
+        if self.checkpoint_plan is not None and modal in self.checkpoint_plan.budgets:
+            tokens = x.numel() // x.shape[-1]
+            return self.checkpoint_plan.blocks_for(
+                modal, tokens, seq_len if seq_len is not None else x.shape[1]
+            )
+        return len(self.blocks) if self.grad_checkpointing else 0
 
     def forward_features(
-        self, x: torch.Tensor, modal: str, anchor:str, mask_t_prob=0.0, mask_f_prob=0.0
+        self,
+        x: torch.Tensor,
+        modal: str,
+        anchor: str,
+        mask_t_prob=0.0,
+        mask_f_prob=0.0,
+        x_len=None,
+        return_padding_mask=False,
     ) -> torch.Tensor:
         bsz = x.size(0)
+        padding_mask = None  # [N, L] token weights: bool padding mask or merged sizes
         if anchor == "image":
             x = self.patch_embed[anchor](x)
             cls_token = self.cls_token[anchor].expand(bsz, -1, -1)
             x = torch.cat((cls_token, x), dim=1)
             x = x + self.pos_embed[anchor]
         elif anchor == "audio":
+            # length-bucketed batches are cropped along time: use the matching
+            # prefix of the position grid
+            grid, time_valid = self.audio_padding_mask(modal, x.size(1), x_len)
             x = self.patch_embed[modal](x)
-            x = x + self.pos_embed[modal][:, 1:, :]
+            pos_embed = self.pos_embed[modal][:, 1:, :]
+            if x.size(1) != pos_embed.size(1):
+                pos_embed = pos_embed.reshape(1, -1, grid[1], pos_embed.size(-1))
+                pos_embed = pos_embed[:, : grid[0]].flatten(1, 2)
+            x = x + pos_embed
             if self.random_masking_2d:
-                x, mask, ids_restore = self.random_masking_2d(
-                    x, mask_t_prob, mask_f_prob, self.audio_dataset
+                x, time_valid, ids_restore = self.random_masking_2d(
+                    x,
+                    mask_t_prob,
+                    mask_f_prob,
+                    self.audio_dataset,
+                    grid=grid if x_len is not None else None,
+                    time_valid=time_valid,
                 )
             else:
                 x, mask, ids_restore = self.random_masking(x, mask_t_prob)
             cls_token = self.cls_token[anchor] #+ self.pos_embed[modal][:, :1, :]
             cls_token = cls_token.expand(bsz, -1, -1)
             x = torch.cat((cls_token, x), dim=1)
+            if time_valid is not None and not bool(time_valid.all()):
+                padding_mask = F.pad(time_valid, (1, 0), value=True)
         elif anchor == "point":
             neighborhood, center = self.group_divider(x)
             group_pc_input_tokens = self.patch_embed[anchor](neighborhood)
@@ -738,17 +831,43 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
             x = x + self.modal_adapter[anchor](x)
         
         x = self.norm_pre(x)
-        if self.moe_type=='lora_moe_mg':
+        if padding_mask is not None and self.use_flash_attn:
+            # drop the padded tokens and run variable-length flash attention
+            seqlen = x.size(1)
+            x, indices, cu_seqlens, max_seqlen = unpad_input(x, padding_mask)[:4]
+            mixer_kwargs = dict(cu_seqlens=cu_seqlens, max_seqlen=max_seqlen)
+            num_ckpt = self.num_checkpointed_blocks(x, modal, seq_len=max_seqlen)
+            for i, blk in enumerate(self.blocks):
+                if self.moe_type == 'lora_moe_mg':
+                    blk_fn = partial(blk, modal=modal, **mixer_kwargs)
+                else:
+                    blk_fn = partial(blk, **mixer_kwargs)
+                if i < num_ckpt:
+                    x = checkpoint(blk_fn, x)
+                else:
+                    x = blk_fn(x)
+            x = pad_input(x, indices, bsz, seqlen)
+        elif self.merge_ratio.get(anchor, 0.0) > 0 and not self.training:
+            # ToMe: merge similar tokens after every block, CLS is kept first;
+            # the merged token sizes weight the mean pooling in forward()
+            ratio = self.merge_ratio[anchor]
+            size = None
             for blk in self.blocks:
-                if self.grad_checkpointing and not torch.jit.is_scripting():
+                x = blk(x, modal) if self.moe_type == 'lora_moe_mg' else blk(x)
+                x, size = merge_tokens(x, ratio, size)
+            padding_mask = size[..., 0]
+        elif self.moe_type=='lora_moe_mg':
+            num_ckpt = self.num_checkpointed_blocks(x, modal)
+            for i, blk in enumerate(self.blocks):
+                if i < num_ckpt:
                     x = checkpoint(blk, x, modal)
                 else:
                     x = blk(x, modal)
         else:
-            if self.grad_checkpointing and not torch.jit.is_scripting():
-                x = checkpoint_seq(self.blocks, x)
-            else:
-                x = self.blocks(x)
+            num_ckpt = self.num_checkpointed_blocks(x, modal)
+            if num_ckpt > 0:
+                x = checkpoint_seq(self.blocks[:num_ckpt], x)
+            x = self.blocks[num_ckpt:](x)
 
         x = self.norm[anchor](x)
         
@@ -761,6 +880,8 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
             x = self.avg_pool(x)
             x = x.view(x.shape[0], -1)
 
+        if return_padding_mask:
+            return x, padding_mask
         return x
 
     def forward_head(
@@ -819,15 +940,24 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
             
             for anchor in anchor_list:
                 x_anchor = x_list[i][anchor]
-                x_feature = self.forward_features(
-                    x_anchor, modal,anchor, mask_t_prob, mask_f_prob
+                x_feature, padding_mask = self.forward_features(
+                    x_anchor,
+                    modal,
+                    anchor,
+                    mask_t_prob,
+                    mask_f_prob,
+                    x_len=x_list[i].get(f"{anchor}_len"),
+                    return_padding_mask=True,
                 )
                 if self.has_cls_head[modal] and anchor == modal:
                     x = self.forward_head(x_feature, modal)
                     logits[modal] = x
                 
                 if anchor != "video":
-                    if self.global_pool_dict[anchor]:
+                    if self.global_pool_dict[anchor] and padding_mask is not None:
+                        w = padding_mask.unsqueeze(-1).to(x_feature.dtype)
+                        pooled_faeature = (x_feature * w).sum(dim=1) / w.sum(dim=1)
+                    elif self.global_pool_dict[anchor]:
                         pooled_faeature = x_feature.mean(dim=1)
                     else:
                         pooled_faeature = x_feature[:, 0, :]
@@ -854,7 +984,7 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
                 visual_feature = visual_feature / visual_feature.norm(
                     dim=-1, keepdim=True
                 )
-                visual_feature = visual_feature.to(dtype=torch.float16)
+                visual_feature = visual_feature.to(dtype=get_policy().feature_dtype)
                 
                 anchor_feature[anchor] = visual_feature
             feature_dict[modal] = anchor_feature
@@ -28,6 +28,8 @@ from torchvision import transforms
 import numpy as np
 from util.stat import calculate_stats, concat_all_gather
 from util.logger import get_logger, print_log
+from util.precision import get_policy
+from util.text_embed_cache import get_text_embed_cache
 
 from datasets.ModelNetDataset import farthest_point_sample
 from datasets.aug_random import AugRandomContext, np_random
@@ -61,11 +63,17 @@ from util.clip_loss import (
     single_kd_clip_loss_gather,
     single_cross_modal_kd_loss_visual,
     single_cross_modal_kd_loss_plm,
+    get_loss_registry,
+    LossOverheadTimer,
+    begin_gather_plan,
+    end_gather_plan,
 )
 
 from datasets.constants import PC_META_DATA_DIR
 from datasets.modal_depth.data.scene_cls_template import SCENE_CLS_TEMPLATE
 from datasets.modal_audio.data.sound_cls_template import SOUND_AS_IMAGE_TEMPLATE
+from datasets.modal_audio.length_bucket import BucketThroughput
+from datasets.Video.uint8_transforms import normalize_video, get_video_norm
 from datasets.metrics import Accuracy, MAP, Recall
 from datasets.zero_shot_metadata import OPENAI_IMAGENET_TEMPLATES, IMAGENET_CLASSNAMES
 from clip.simple_tokenizer import SimpleTokenizer
@@ -345,7 +353,7 @@ def train_one_epoch(
         # import pdb; pdb.set_trace()
         points = pc_train_transforms(points)
 
-        with torch.cuda.amp.autocast():
+        with get_policy().autocast():
             if args.use_loramoe:
                 img_logits, audio_logits, pc_logits, blcls = model(
                     img_samples,
@@ -397,7 +405,8 @@ def train_one_epoch(
         if (data_iter_step + 1) % accum_iter == 0:
             optimizer.zero_grad()
 
-        torch.cuda.synchronize()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
 
         metric_logger.update(loss=loss_value)
         metric_logger.update(img_loss=img_loss_value)
@@ -535,7 +544,7 @@ def train_one_epoch_grad_norm(
         # import pdb; pdb.set_trace()
         points = pc_train_transforms(points)
 
-        with torch.cuda.amp.autocast():
+        with get_policy().autocast():
             img_logits, audio_logits, pc_logits = model(
                 img_samples,
                 audio_samples,
@@ -612,10 +621,10 @@ def train_one_epoch_grad_norm(
         # compute the GradNorm loss
         # this term has to remain constant
         constant_term = torch.tensor(
-            mean_norm * (inverse_train_rate**args.grad_norm_alpha), requires_grad=False
+            mean_norm * (inverse_train_rate**args.grad_norm_alpha),
+            requires_grad=False,
+            device=norms.device,
         )
-        if torch.cuda.is_available():
-            constant_term = constant_term.cuda()
         # print('Constant term: {}'.format(constant_term))
         # this is the GradNorm loss itself
         grad_norm_loss = torch.sum(torch.abs(norms - constant_term))
@@ -705,6 +714,22 @@ def train_one_epoch_grad_norm(
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 
+def planned_gather_tensors(
+    args, cur_modal, samples_proj2text_features, samples_text_features, features, targets
+):
+    """Tensors the clip / kd / cls losses of ``cur_modal`` all-gather this step,
+    in the same order on every rank."""
+    tensors = []
+    if (args.cross_align or args.uni_align) and cur_modal != "image":
+        tensors.extend(samples_proj2text_features[cur_modal].values())
+        tensors.append(samples_text_features[cur_modal])
+    if args.use_aux_cls_loss and cur_modal not in ["image", "video", "point"]:
+        tensors.append(features[cur_modal]["rgbd" if cur_modal == "rgbd" else cur_modal])
+        if not args.local_loss:
+            tensors.append(targets)
+    return tensors
+
+
 def train_one_epoch_concat(
     model: torch.nn.Module,
     open_clip_text_model: None,
@@ -722,7 +747,11 @@ def train_one_epoch_concat(
 ):
     model.train(True)
     logger = get_logger(args.log_name)
-    metric_logger = misc.MetricLogger(delimiter=" ", logger=logger)
+    metric_logger = misc.MetricLogger(
+        delimiter=" ", logger=logger, deferred=args.deferred_metrics
+    )
+    # --deferred_metrics: on-device "all losses finite" flag until the next optimizer step
+    losses_finite = None
     header = "Multi Tasks Merging with use_one mode ==== Epoch: [{}]".format(epoch)
     metric_logger.add_meter("lr", misc.SmoothedValue(window_size=1, fmt="{value:.6f}"))
 
@@ -733,7 +762,7 @@ def train_one_epoch_concat(
     if log_writer is not None:
         print_log("log_dir: {}".format(log_writer.log_dir), logger=logger)
 
-    has_cls_head = model.module.has_cls_head
+    has_cls_head = getattr(model, "module", model).has_cls_head
 
     world_size = misc.get_world_size()
     rank = misc.get_rank()
@@ -761,9 +790,7 @@ def train_one_epoch_concat(
             # plm_labels_features["image"] = image_labels_features
             # else:
             classifier = build_zero_shot_classifier(
-                open_clip_text_model.module
-                if args.distributed
-                else open_clip_text_model,
+                open_clip_text_model,
                 tokenizer=tokenizer,
                 classnames=IMAGENET_CLASSNAMES,
                 templates=OPENAI_IMAGENET_TEMPLATES,
@@ -798,16 +825,11 @@ def train_one_epoch_concat(
             audio_labels_features = []
             for label in idx2label:
                 texts = [t(label) for t in SOUND_AS_IMAGE_TEMPLATE]
-                texts = tokenizer(texts).cuda(args.device, non_blocking=True)
+                texts = tokenizer(texts).to(args.device, non_blocking=True)
                 if len(texts.shape) < 2:
                     texts = texts[None, ...]
                 with torch.no_grad():
-                    if args.distributed:
-                        class_embeddings = open_clip_text_model.module.encode_text(
-                            texts
-                        )
-                    else:
-                        class_embeddings = open_clip_text_model.encode_text(texts)
+                    class_embeddings = open_clip_text_model.encode_text(texts)
                 class_embeddings = class_embeddings / class_embeddings.norm(
                     dim=-1, keepdim=True
                 )
@@ -850,16 +872,11 @@ def train_one_epoch_concat(
             point_labels_features = []
             for label in labels:
                 texts = [t.format(label) for t in templates]
-                texts = tokenizer(texts).cuda(args.device, non_blocking=True)
+                texts = tokenizer(texts).to(args.device, non_blocking=True)
                 if len(texts.shape) < 2:
                     texts = texts[None, ...]
                 with torch.no_grad():
-                    if args.distributed:
-                        class_embeddings = open_clip_text_model.module.encode_text(
-                            texts
-                        )
-                    else:
-                        class_embeddings = open_clip_text_model.encode_text(texts)
+                    class_embeddings = open_clip_text_model.encode_text(texts)
                 class_embeddings = class_embeddings / class_embeddings.norm(
                     dim=-1, keepdim=True
                 )
@@ -905,16 +922,11 @@ def train_one_epoch_concat(
             templates = SCENE_CLS_TEMPLATE
             for label in labels:
                 texts = [t(label) for t in templates]
-                texts = tokenizer(texts).cuda(args.device, non_blocking=True)
+                texts = tokenizer(texts).to(args.device, non_blocking=True)
                 if len(texts.shape) < 2:
                     texts = texts[None, ...]
                 with torch.no_grad():
-                    if args.distributed:
-                        class_embeddings = open_clip_text_model.module.encode_text(
-                            texts
-                        )
-                    else:
-                        class_embeddings = open_clip_text_model.encode_text(texts)
+                    class_embeddings = open_clip_text_model.encode_text(texts)
                 class_embeddings = class_embeddings / class_embeddings.norm(
                     dim=-1, keepdim=True
                 )
@@ -928,6 +940,41 @@ def train_one_epoch_concat(
     accum_modal_iter = 0
     modal_lens = len(args.train_modal_list)
 
+    bucket_throughput = None
+    if (
+        getattr(args, "audio_length_buckets", None)
+        and args.log_bucket_time
+        and "audio" in args.train_modal_list
+    ):
+        bucket_throughput = BucketThroughput()
+
+    # loss modules shared by all steps of the run, None builds them per call
+    losses = (
+        get_loss_registry(args, args.local_loss, args.gather_with_grad, rank, world_size)
+        if args.loss_registry
+        else None
+    )
+    loss_timer = LossOverheadTimer() if args.log_loss_time else None
+    # inputs of the window wait for their re-forward in pinned host memory
+    input_cache = None
+    if args.offload_inputs and torch.cuda.is_available():
+        input_cache = misc.HostInputCache(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    # embeddings of captions already seen skip the frozen text tower
+    text_cache = None
+    if args.use_text_branch and args.text_embed_cache:
+        text_cache = get_text_embed_cache(
+            args,
+            open_clip_text_model,
+            device,
+            rank,
+        )
+
+    # > 0 when resuming from a mid-epoch checkpoint
+    start_step = getattr(train_data_loader, "start_step", 0)
+    if start_step > 0:
+        print_log(f"Resuming epoch {epoch} at step {start_step}", logger=logger)
+
     trgets_dict = {}
     modal_list = []
     anchor_list = []
@@ -943,7 +990,8 @@ def train_one_epoch_concat(
     for data_iter_step, batch in enumerate(
         metric_logger.log_every(
             train_data_loader, print_freq, header, pre_iter=int(modal_lens * accum_iter)
-        )
+        ),
+        start=start_step,
     ):
         cur_modal = None
         input = None
@@ -992,7 +1040,7 @@ def train_one_epoch_concat(
                         bstr[:item_size], dtype=np.float16
                     ).copy()
                     text_feature = torch.from_numpy(text_feature).to(
-                        device=device, dtype=torch.float16
+                        device=device, dtype=get_policy().feature_dtype
                     )
                     image_text_features.append(text_feature)
                 image_text_features = torch.stack(image_text_features)
@@ -1069,6 +1117,8 @@ def train_one_epoch_concat(
                 input = {"audio": audio_samples, "image": video_samples}
             else:
                 input = {"audio": audio_samples}
+            if "audio_len" in input_data:
+                input["audio_len"] = input_data["audio_len"].to(device, non_blocking=True)
             input_list.append(input)
             if "audio" in trgets_dict:
                 trgets_dict["audio"].append(audio_targets)
@@ -1363,8 +1413,10 @@ def train_one_epoch_concat(
 
         optimizer.zero_grad()
 
+        if bucket_throughput is not None and cur_modal == "audio":
+            bucket_throughput.start()
         with torch.no_grad():
-            with torch.cuda.amp.autocast():
+            with get_policy().autocast():
                 output = model(
                     [input],
                     [cur_modal],
@@ -1373,6 +1425,10 @@ def train_one_epoch_concat(
                     mask_f_prob=args.mask_f_prob,
                     extract_feature=args.multi_modal_distill,
                 )
+                if bucket_throughput is not None and cur_modal == "audio":
+                    bucket_throughput.stop(
+                        input["audio"].size(1), input["audio"].size(0)
+                    )
                 output.pop("logit_scale")
                 output.pop("logits")
 
@@ -1397,20 +1453,23 @@ def train_one_epoch_concat(
                 else:
                     output.pop("teacher_features")
 
-                if args.use_text_branch:
-                    if args.distributed:
-                        text_embeds = open_clip_text_model.module.encode_text(
-                            cur_text, normalize=True
-                        )
+                if text_cache is not None:
+                    text_embeds = text_cache.encode(cur_text, cur_modal)
+                    if cur_modal in accum_text_features:
+                        accum_text_features[cur_modal].append(text_embeds)
                     else:
-                        text_embeds = open_clip_text_model.encode_text(
-                            cur_text, normalize=True
-                        )
+                        accum_text_features[cur_modal] = [text_embeds]
+                elif args.use_text_branch:
+                    text_embeds = open_clip_text_model.encode_text(
+                        cur_text, normalize=True
+                    )
                     if cur_modal in accum_text_features:
                         accum_text_features[cur_modal].append(text_embeds)
                     else:
                         accum_text_features[cur_modal] = [text_embeds]
 
+        if input_cache is not None:
+            input_list[-1] = input_cache.put(input_list[-1])
         del input, output
         if (data_iter_step + 1) % (accum_iter * modal_lens) > 0:
             continue
@@ -1419,6 +1478,21 @@ def train_one_epoch_concat(
         # Re-do the forward pass for those batches, and use the cached features from the other batches as negatives.
         # Call backwards each time, but only step optimizer at the end.
         optimizer.zero_grad()
+        if getattr(args, "multiloader_depth", 0) > 0:
+            # the MultiLoader serves every round in readiness order, replay the
+            # rounds in modality order so all ranks hit the collectives alike
+            order = sorted(
+                range(len(modal_list)),
+                key=lambda k: (k // modal_lens, args.train_modal_list.index(modal_list[k])),
+            )
+            modal_list = [modal_list[k] for k in order]
+            anchor_list = [anchor_list[k] for k in order]
+            input_list = [input_list[k] for k in order]
+        if loss_timer is not None:
+            loss_timer.step()
+        if losses is not None:
+            # teacher logits are reused across the window, not across windows
+            losses.new_step()
         samples_text_features = {}
         for key, val in accum_text_features.items():
             samples_text_features[key] = torch.cat(val, dim=0)
@@ -1444,13 +1518,17 @@ def train_one_epoch_concat(
                 cur_modal = modal_list[i * modal_lens + j]
                 cur_anchor = anchor_list[i * modal_lens + j]
                 cur_input = input_list.pop(0)
+                if input_cache is not None:
+                    cur_input = input_cache.get(
+                        cur_input, input_list[0] if input_list else None
+                    )
                 loss = 0
                 loss_dict = {}
 
                 # if cur_modal not in align_train:
                 #     continue
 
-                with torch.cuda.amp.autocast():
+                with get_policy().autocast():
                     output = model(
                         [cur_input],
                         [cur_modal],
@@ -1508,6 +1586,19 @@ def train_one_epoch_concat(
                                     proj2text_feature[anchor] = torch.cat(anchor_val, dim=0)
                             samples_kd_s_features[key] = proj2text_feature
 
+                    if args.bucketed_gather and args.use_clip_loss:
+                        begin_gather_plan(
+                            planned_gather_tensors(
+                                args, cur_modal, samples_proj2text_features,
+                                samples_text_features, output["features"],
+                                trgets_dict[cur_modal][i],
+                            ),
+                            local_loss=args.local_loss,
+                            gather_with_grad=args.gather_with_grad,
+                            rank=rank,
+                            world_size=world_size,
+                        )
+
                     if has_cls_head[cur_modal]:
                         loss_cls = criterion[cur_modal](
                             output["logits"][cur_modal], trgets_dict[cur_modal][i]
@@ -1521,7 +1612,7 @@ def train_one_epoch_concat(
                                 loss += loss_cls * args.audio_weight
                                 metric_logger.update(
                                     **{
-                                        f"{cur_modal}_cls_loss": loss_cls.item()
+                                        f"{cur_modal}_cls_loss": loss_cls
                                         * args.audio_weight
                                     }
                                 )
@@ -1529,11 +1620,13 @@ def train_one_epoch_concat(
                                 loss += loss_cls
 
                                 metric_logger.update(
-                                    **{f"{cur_modal}_cls_loss": loss_cls.item()}
+                                    **{f"{cur_modal}_cls_loss": loss_cls}
                                 )
 
                     if args.cross_align and cur_modal != "image":
                         if args.use_clip_loss:
+                            if loss_timer is not None:
+                                loss_timer.start()
                             cm_kd_loss = single_cross_modal_kd_loss_gather(
                                 cur_modal,
                                 modal_list,
@@ -1545,7 +1638,10 @@ def train_one_epoch_concat(
                                 gather_with_grad=args.gather_with_grad,
                                 rank=rank,
                                 world_size=world_size,
+                                losses=losses,
                             )
+                            if loss_timer is not None:
+                                loss_timer.stop()
                             # cm_kd_loss = single_cross_modal_kd_loss_visual(
                             #     cur_modal,
                             #     modal_list,
@@ -1606,6 +1702,8 @@ def train_one_epoch_concat(
 
                     if args.uni_align and (cur_modal not in ["image"]):
                         if args.use_clip_loss:
+                            if loss_timer is not None:
+                                loss_timer.start()
                             uni_clip_loss = single_uni_modal_clip_loss_gather(
                                 cur_modal,
                                 samples_proj2text_features,
@@ -1616,7 +1714,10 @@ def train_one_epoch_concat(
                                 rank=rank,
                                 world_size=world_size,
                                 args=args,
+                                losses=losses,
                             )
+                            if loss_timer is not None:
+                                loss_timer.stop()
 
                             # uni_clip_loss = single_uni_modal_clip_loss(
                             #     cur_modal,
@@ -1737,10 +1838,16 @@ def train_one_epoch_concat(
                         weighted_task_losses, loss = loss_balancer(cur_modal, loss_dict)
                         metric_logger.update(**weighted_task_losses)
 
+                    end_gather_plan()
                     del samples_proj2text_features
-                    loss_value = loss.item()
+                    if args.deferred_metrics:
+                        # no per-loss sync: the finite flag stays on the
+                        # device and is read back once, before the step
+                        loss_value = loss.detach()
+                    else:
+                        loss_value = loss.item()
 
-                    if not math.isfinite(loss_value):
+                    if not args.deferred_metrics and not math.isfinite(loss_value):
                         print_log(
                             f"{cur_modal} Loss is {loss_value}, stopping training",
                             logger,
@@ -1752,20 +1859,44 @@ def train_one_epoch_concat(
 
                     # loss /= accum_iter
 
-                if math.isfinite(loss_value):
+                update_grad = (data_iter_step + 1) % (accum_iter * modal_lens) == 0
+                if args.deferred_metrics:
+                    finite = torch.isfinite(loss_value)
+                    losses_finite = finite if losses_finite is None else losses_finite & finite
+                    # without a GradScaler (bf16 / fp32) nothing else would
+                    # keep a non-finite loss from reaching the weights
+                    if update_grad:
+                        if not bool(losses_finite):
+                            print_log(
+                                f"{cur_modal} Loss is not finite, stopping training",
+                                logger,
+                            )
+                            sys.exit(1)
+                        losses_finite = None
+
+                if args.deferred_metrics or math.isfinite(loss_value):
                     modal_loss = {f"{cur_modal}_loss": loss_value}
                     metric_logger.update(**modal_loss)
+                    if getattr(loss_scaler, "grad_sync", None) is not None:
+                        loss_scaler.grad_sync.touch(cur_modal, *cur_anchor)
                     loss_scaler(
                         loss,
                         optimizer,
                         clip_grad=max_norm,
                         parameters=model.parameters(),
                         create_graph=False,
-                        update_grad=(data_iter_step + 1) % (accum_iter * modal_lens)
-                        == 0,
+                        update_grad=update_grad,
                     )
 
-                    torch.cuda.synchronize()
+                    if not args.deferred_metrics and torch.cuda.is_available():
+                        torch.cuda.synchronize()
+
+            if metric_logger.nonfinite:
+                print_log(
+                    f"Loss is not finite ({', '.join(metric_logger.nonfinite)}), stopping training",
+                    logger,
+                )
+                sys.exit(1)
 
             # loss_dict = {f'{cur_modal}_loss': loss_value}
             # metric_logger.update(**loss_dict)
@@ -1775,6 +1906,8 @@ def train_one_epoch_concat(
         modal_list = []
         input_list = []
         anchor_list = []
+        if input_cache is not None:
+            input_cache.reset()
 
         accum_features = {}
         accum_text_features = {}
@@ -1791,6 +1924,23 @@ def train_one_epoch_concat(
 
         metric_logger.update(lr=max_lr)
 
+        # mid-epoch checkpoint, only right after an optimizer step
+        if (
+            args.save_ckpt_steps > 0
+            and args.output_dir
+            and (data_iter_step + 1) % (accum_iter * modal_lens) == 0
+            and ((data_iter_step + 1) // (accum_iter * modal_lens)) % args.save_ckpt_steps == 0
+        ):
+            misc.save_step_checkpoint(
+                args,
+                epoch,
+                model.module if hasattr(model, "module") else model,
+                optimizer,
+                loss_scaler,
+                train_data_loader.state_dict(),
+                logger=logger,
+            )
+
         # loss_value_reduce = misc.all_reduce_mean(loss_value)
 
         # if log_writer is not None and (data_iter_step + 1) % accum_iter == 0:
@@ -1801,6 +1951,22 @@ def train_one_epoch_concat(
         #     log_writer.add_scalar("loss", loss_value_reduce, epoch_1000x)
         #     log_writer.add_scalar("lr", max_lr, epoch_1000x)
 
+    if bucket_throughput is not None:
+        bucket_throughput.report(logger)
+    if hasattr(train_data_loader, "report_wait"):
+        train_data_loader.report_wait(logger)
+    if input_cache is not None:
+        input_cache.report(logger)
+    if text_cache is not None:
+        text_cache.flush()
+        text_cache.report(logger)
+    if getattr(loss_scaler, "grad_sync", None) is not None:
+        loss_scaler.grad_sync.report(optimizer, logger)
+    if loss_timer is not None:
+        loss_timer.report(
+            logger, name="persistent loss modules" if losses is not None else "per-call loss modules"
+        )
+
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print_log(f"Averaged stats:{metric_logger}", logger)
@@ -1860,7 +2026,7 @@ def train_one_epoch_concat_use_all(
                 bstr = image_manager.read(label)
                 text_feature = np.frombuffer(bstr[:item_size], dtype=np.float16).copy()
                 text_feature = torch.from_numpy(text_feature).to(
-                    device=device, dtype=torch.float16
+                    device=device, dtype=get_policy().feature_dtype
                 )
                 image_labels_features.append(text_feature)
             image_labels_features = torch.stack(image_labels_features)
@@ -1874,7 +2040,7 @@ def train_one_epoch_concat_use_all(
                 bstr = audio_manager.read(label)
                 text_feature = np.frombuffer(bstr[:item_size], dtype=np.float16).copy()
                 text_feature = torch.from_numpy(text_feature).to(
-                    device=device, dtype=torch.float16
+                    device=device, dtype=get_policy().feature_dtype
                 )
                 audio_labels_features.append(text_feature)
             audio_labels_features = torch.stack(audio_labels_features)
@@ -1888,7 +2054,7 @@ def train_one_epoch_concat_use_all(
                 bstr = point_manager.read(label)
                 text_feature = np.frombuffer(bstr[:item_size], dtype=np.float16).copy()
                 text_feature = torch.from_numpy(text_feature).to(
-                    device=device, dtype=torch.float16
+                    device=device, dtype=get_policy().feature_dtype
                 )
                 point_labels_features.append(text_feature)
             point_labels_features = torch.stack(point_labels_features)
@@ -1902,7 +2068,7 @@ def train_one_epoch_concat_use_all(
                 bstr = video_manager.read(label)
                 text_feature = np.frombuffer(bstr[:item_size], dtype=np.float16).copy()
                 text_feature = torch.from_numpy(text_feature).to(
-                    device=device, dtype=torch.float16
+                    device=device, dtype=get_policy().feature_dtype
                 )
                 video_labels_features.append(text_feature)
             video_labels_features = torch.stack(video_labels_features)
@@ -1920,7 +2086,7 @@ def train_one_epoch_concat_use_all(
             rgbd_val_text_features = torch.load(args.rgbd_train_text_feature_path)
             for label in idx2label:
                 text_feature = rgbd_val_text_features[label].to(
-                    device=device, dtype=torch.float16
+                    device=device, dtype=get_policy().feature_dtype
                 )
                 rgbd_labels_features.append(text_feature)
             rgbd_labels_features = torch.stack(rgbd_labels_features)
@@ -1980,7 +2146,7 @@ def train_one_epoch_concat_use_all(
                             bstr[:item_size], dtype=np.float16
                         ).copy()
                         text_feature = torch.from_numpy(text_feature).to(
-                            device=device, dtype=torch.float16
+                            device=device, dtype=get_policy().feature_dtype
                         )
                         image_text_features.append(text_feature)
                     image_text_features = torch.stack(image_text_features)
@@ -2037,7 +2203,7 @@ def train_one_epoch_concat_use_all(
                             bstr[:item_size], dtype=np.float16
                         ).copy()
                         text_feature = torch.from_numpy(text_feature).to(
-                            device=device, dtype=torch.float16
+                            device=device, dtype=get_policy().feature_dtype
                         )
                         audio_text_features.append(text_feature)
                     audio_text_features = torch.stack(audio_text_features)
@@ -2102,7 +2268,7 @@ def train_one_epoch_concat_use_all(
                             bstr[:item_size], dtype=np.float16
                         ).copy()
                         text_feature = torch.from_numpy(text_feature).to(
-                            device=device, dtype=torch.float16
+                            device=device, dtype=get_policy().feature_dtype
                         )
                         point_text_features.append(text_feature)
                     point_text_features = torch.stack(point_text_features)
@@ -2158,7 +2324,7 @@ def train_one_epoch_concat_use_all(
                             bstr[:item_size], dtype=np.float16
                         ).copy()
                         text_feature = torch.from_numpy(text_feature).to(
-                            device=device, dtype=torch.float16
+                            device=device, dtype=get_policy().feature_dtype
                         )
                         video_text_features.append(text_feature)
                     video_text_features = torch.stack(video_text_features)
@@ -2226,7 +2392,7 @@ def train_one_epoch_concat_use_all(
         optimizer.zero_grad()
 
         with torch.no_grad():
-            with torch.cuda.amp.autocast():
+            with get_policy().autocast():
                 output = model(
                     input_list,
                     modal_list,
@@ -2263,7 +2429,7 @@ def train_one_epoch_concat_use_all(
 
         for j in range(args.accum_iter):
             loss = 0
-            with torch.cuda.amp.autocast():
+            with get_policy().autocast():
                 output = model(
                     accum_input_list[j],
                     accum_modal_list[j],
@@ -2426,7 +2592,8 @@ def train_one_epoch_concat_use_all(
                     create_graph=False,
                     update_grad=(data_iter_step + 1) % accum_iter == 0,
                 )
-                torch.cuda.synchronize()
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
 
         # metric_logger.update(loss=loss_value)
 
@@ -2500,7 +2667,7 @@ def evaluate(
         img_samples = img_samples.to(device, non_blocking=True)
         img_targets = img_targets.to(device, non_blocking=True)
 
-        with torch.cuda.amp.autocast():
+        with get_policy().autocast():
             # if args.use_loramoe:
             #     output_img, _, _, _ = model(img_samples, None, None)
             # else:
@@ -2523,7 +2690,7 @@ def evaluate(
         audio_samples = audio_samples.to(device, non_blocking=True)
         audio_targets = audio_targets.to(device, non_blocking=True)
 
-        with torch.cuda.amp.autocast():
+        with get_policy().autocast():
             # if args.use_loramoe:
             #     _, output_audio, _, _ = model(None, audio_samples, None)
             # else:
@@ -2562,7 +2729,7 @@ def evaluate(
 
         points = misc.fps(points, npoints)
 
-        with torch.cuda.amp.autocast():
+        with get_policy().autocast():
             # if args.use_loramoe:
             #     _, _, output_pc, _ = model(None, None, points)
             # else:
@@ -2684,7 +2851,7 @@ def evaluate_image(
             img_targets = torch.LongTensor(img_targets)
         img_targets = img_targets.to(device, non_blocking=True)
 
-        with torch.cuda.amp.autocast():
+        with get_policy().autocast():
             output = model(
                 [{"image": img_samples}],
                 ["image"],
@@ -2786,7 +2953,7 @@ def evaluate_audio(
         bstr = audio_manager.read(label)
         text_feature = np.frombuffer(bstr[:item_size], dtype=np.float16).copy()
         text_feature = torch.from_numpy(text_feature).to(
-            device=device, dtype=torch.float16
+            device=device, dtype=get_policy().feature_dtype
         )
         audio_labels_features.append(text_feature)
     audio_labels_features = torch.stack(audio_labels_features)
@@ -2806,7 +2973,7 @@ def evaluate_audio(
         audio_samples = audio_samples.to(device, non_blocking=True)
         audio_targets = audio_targets.to(device, non_blocking=True)
 
-        with torch.cuda.amp.autocast():
+        with get_policy().autocast():
             output = model(
                 [{"audio": audio_samples}],
                 ["audio"],
@@ -2917,7 +3084,7 @@ def evaluate_point(
         bstr = point_manager.read(label)
         text_feature = np.frombuffer(bstr[:item_size], dtype=np.float16).copy()
         text_feature = torch.from_numpy(text_feature).to(
-            device=device, dtype=torch.float16
+            device=device, dtype=get_policy().feature_dtype
         )
         point_labels_features.append(text_feature)
     point_labels_features = torch.stack(point_labels_features)
@@ -2928,7 +3095,7 @@ def evaluate_point(
 
         points = misc.fps(points, npoints)
 
-        with torch.cuda.amp.autocast():
+        with get_policy().autocast():
             output = model(
                 [{"point": points}],
                 ["point"],
@@ -3020,7 +3187,7 @@ def evaluate_point_zeroshot(
             bstr = point_manager.read(label)
             text_feature = np.frombuffer(bstr[:item_size], dtype=np.float16).copy()
             text_feature = torch.from_numpy(text_feature).to(
-                device=device, dtype=torch.float16
+                device=device, dtype=get_policy().feature_dtype
             )
             point_labels_features.append(text_feature)
         point_labels_features = torch.stack(point_labels_features)
@@ -3039,7 +3206,7 @@ def evaluate_point_zeroshot(
             bstr = point_manager.read(label)
             text_feature = np.frombuffer(bstr[:item_size], dtype=np.float16).copy()
             text_feature = torch.from_numpy(text_feature).to(
-                device=device, dtype=torch.float16
+                device=device, dtype=get_policy().feature_dtype
             )
             point_labels_features.append(text_feature)
         point_labels_features = torch.stack(point_labels_features)
@@ -3050,7 +3217,7 @@ def evaluate_point_zeroshot(
 
         # points = misc.fps(points, npoints)
 
-        with torch.cuda.amp.autocast():
+        with get_policy().autocast():
             output = model(
                 [{"point": points}],
                 ["point"],
@@ -3130,26 +3297,37 @@ def evaluate_video(
         bstr = video_manager.read(label)
         text_feature = np.frombuffer(bstr[:item_size], dtype=np.float16).copy()
         text_feature = torch.from_numpy(text_feature).to(
-            device=device, dtype=torch.float16
+            device=device, dtype=get_policy().feature_dtype
         )
         video_labels_features.append(text_feature)
     video_labels_features = torch.stack(video_labels_features)
 
     video_clip_pred = []
     video_clip_labels = []
+    video_norm = get_video_norm(video_data_loader.dataset)
 
     for batch in video_metric_logger.log_every(video_data_loader, 100, video_header):
         video_samples = batch[0]
         video_targets = batch[1]
         video_samples = video_samples.to(device, non_blocking=True)
+        # multi-view test batches are B x V x C x T x H x W; the B x V clips
+        # go through the model B at a time, as many as a single-view batch
+        n_views = video_samples.size(1) if video_samples.ndim == 6 else 1
+        chunk_size = video_samples.size(0)
+        video_samples = video_samples.flatten(0, video_samples.ndim - 5)
         video_targets = video_targets.to(device, non_blocking=True)
 
-        with torch.cuda.amp.autocast():
-            output = model(
-                [{"video": video_samples}],
-                ["video"],
-                ["video"],
-            )
+        video_features = []
+        for clips in video_samples.split(chunk_size):
+            if video_norm is not None:
+                clips = normalize_video(clips, *video_norm)
+            with get_policy().autocast():
+                output = model(
+                    [{"video": clips}],
+                    ["video"],
+                    ["video"],
+                )
+            video_features.append(output["features"]["video"]["video"])
 
             # loss = criterion(output["logits"]["video"], video_targets)
         # acc1, acc5 = accuracy(output["logits"]["video"], video_targets, topk=(1, 5))
@@ -3158,9 +3336,12 @@ def evaluate_video(
         # video_metric_logger.meters["acc1"].update(acc1.item(), n=batch_size)
         # video_metric_logger.meters["acc5"].update(acc5.item(), n=batch_size)
 
-        video_features = output["features"]["video"]["video"]
+        video_features = torch.cat(video_features)
         # video_features /= video_features.norm(dim=-1, keepdim=True)
         similarity = (100.0 * video_features @ video_labels_features.T).softmax(dim=-1)
+        if n_views > 1:
+            # average the class scores of all views of a video
+            similarity = similarity.view(-1, n_views, similarity.size(-1)).mean(dim=1)
 
         clip_pred = similarity.argmax(dim=1)
         clip_labels = video_targets
@@ -3237,7 +3418,7 @@ def evaluate_rgbd(
 
     for label in rgbd_data_loader.dataset.idx2label:
         text_feature = rgbd_val_text_features[label].to(
-            device=device, dtype=torch.float16
+            device=device, dtype=get_policy().feature_dtype
         )
         rgbd_labels_features.append(text_feature)
     rgbd_labels_features = torch.stack(rgbd_labels_features)
@@ -3258,7 +3439,7 @@ def evaluate_rgbd(
         #     rgbd_text_features.append(text_feature)
         # rgbd_text_features = torch.stack(rgbd_text_features)
 
-        with torch.cuda.amp.autocast():
+        with get_policy().autocast():
             output = model(
                 [{"rgbd": rgbd_samples}],
                 ["rgbd"],
@@ -3418,14 +3599,11 @@ def test_zeroshot_3d_single(
             text_features = []
             for label in labels:
                 texts = [t.format(label) for t in templates]
-                texts = tokenizer(texts).cuda(args.device, non_blocking=True)
+                texts = tokenizer(texts).to(args.device, non_blocking=True)
                 if len(texts.shape) < 2:
                     texts = texts[None, ...]
 
-                if args.distributed:
-                    class_embeddings = open_clip_text_model.module.encode_text(texts)
-                else:
-                    class_embeddings = open_clip_text_model.encode_text(texts)
+                class_embeddings = open_clip_text_model.encode_text(texts)
                 class_embeddings = class_embeddings / class_embeddings.norm(
                     dim=-1, keepdim=True
                 )
@@ -3451,7 +3629,7 @@ def test_zeroshot_3d_single(
                 target = torch.LongTensor(target)
             target = target.to(args.device, non_blocking=True)
 
-            with torch.cuda.amp.autocast():
+            with get_policy().autocast():
                 output = model(
                     [{"point": pc}],
                     ["point"],
@@ -3529,14 +3707,11 @@ def test_scanobjectnn(
     text_features = []
     for label in labels:
         texts = [t.format(label) for t in templates]
-        texts = tokenizer(texts).cuda(args.device, non_blocking=True)
+        texts = tokenizer(texts).to(args.device, non_blocking=True)
         if len(texts.shape) < 2:
             texts = texts[None, ...]
 
-        if args.distributed:
-            class_embeddings = open_clip_text_model.module.encode_text(texts)
-        else:
-            class_embeddings = open_clip_text_model.encode_text(texts)
+        class_embeddings = open_clip_text_model.encode_text(texts)
         class_embeddings = class_embeddings / class_embeddings.norm(
             dim=-1, keepdim=True
         )
@@ -3562,7 +3737,7 @@ def test_scanobjectnn(
                 target = torch.LongTensor(target)
             target = target.to(args.device, non_blocking=True)
 
-            with torch.cuda.amp.autocast():
+            with get_policy().autocast():
                 output = model(
                     [{"point": pc}],
                     ["point"],
@@ -3656,14 +3831,11 @@ def test_rgbd_cls_single(
         else:
             for label in labels:
                 texts = [t(label) for t in templates]
-                texts = tokenizer(texts).cuda(args.device, non_blocking=True)
+                texts = tokenizer(texts).to(args.device, non_blocking=True)
                 if len(texts.shape) < 2:
                     texts = texts[None, ...]
 
-                if args.distributed:
-                    class_embeddings = open_clip_text_model.module.encode_text(texts)
-                else:
-                    class_embeddings = open_clip_text_model.encode_text(texts)
+                class_embeddings = open_clip_text_model.encode_text(texts)
                 class_embeddings = class_embeddings / class_embeddings.norm(
                     dim=-1, keepdim=True
                 )
@@ -3686,7 +3858,7 @@ def test_rgbd_cls_single(
             target = target.to(args.device, non_blocking=True)
 
             # encode visual
-            with torch.cuda.amp.autocast():
+            with get_policy().autocast():
                 output = model(
                     [{"rgbd": depth}],
                     ["rgbd"],
@@ -3793,14 +3965,11 @@ def test_audio_single_map(
             labels = testloader.dataset.idx2label
             for label in labels:
                 texts = [t(label) for t in SOUND_AS_IMAGE_TEMPLATE]
-                texts = tokenizer(texts).cuda(args.device, non_blocking=True)
+                texts = tokenizer(texts).to(args.device, non_blocking=True)
                 if len(texts.shape) < 2:
                     texts = texts[None, ...]
 
-                if args.distributed:
-                    class_embeddings = open_clip_text_model.module.encode_text(texts)
-                else:
-                    class_embeddings = open_clip_text_model.encode_text(texts)
+                class_embeddings = open_clip_text_model.encode_text(texts)
                 class_embeddings = class_embeddings / class_embeddings.norm(
                     dim=-1, keepdim=True
                 )
@@ -3820,7 +3989,7 @@ def test_audio_single_map(
             targets = targets.to(args.device, non_blocking=True)
             ids = torch.tensor(ids).to(args.device)
 
-            with torch.cuda.amp.autocast():
+            with get_policy().autocast():
                 output = model(
                     [{"audio": audio}],
                     ["audio"],
@@ -3908,14 +4077,11 @@ def test_audio_single_cls(
         else:
             for label in labels:
                 texts = [t(label) for t in SOUND_AS_IMAGE_TEMPLATE]
-                texts = tokenizer(texts).cuda(args.device, non_blocking=True)
+                texts = tokenizer(texts).to(args.device, non_blocking=True)
                 if len(texts.shape) < 2:
                     texts = texts[None, ...]
 
-                if args.distributed:
-                    class_embeddings = open_clip_text_model.module.encode_text(texts)
-                else:
-                    class_embeddings = open_clip_text_model.encode_text(texts)
+                class_embeddings = open_clip_text_model.encode_text(texts)
                 class_embeddings = class_embeddings / class_embeddings.norm(
                     dim=-1, keepdim=True
                 )
@@ -3944,7 +4110,7 @@ def test_audio_single_cls(
                 n_clip = audio.size(1)
                 audio = einops.rearrange(audio, "b n ... -> (b n) ...")
 
-            with torch.cuda.amp.autocast():
+            with get_policy().autocast():
                 output = model(
                     [{"audio": audio}],
                     ["audio"],
@@ -4005,7 +4171,7 @@ def test_audio_single_ret(
             audio_manager = TxtManager(args.audio_text_feature_path, item_size, rank)
 
     with torch.no_grad():
-        text_ids = torch.tensor(text_ids).cuda()
+        text_ids = torch.tensor(text_ids, device=args.device)
 
         if args.text_embed_dim == 1536:
             text_logits = []
@@ -4014,7 +4180,7 @@ def test_audio_single_ret(
                 bstr = audio_manager.read(label)
                 text_feature = np.frombuffer(bstr[:item_size], dtype=np.float16).copy()
                 text_feature = torch.from_numpy(text_feature).to(
-                    args.device, dtype=torch.float16, non_blocking=True
+                    args.device, dtype=get_policy().feature_dtype, non_blocking=True
                 )
                 text_logits.append(text_feature)
             text_logits = torch.stack(text_logits)
@@ -4039,21 +4205,16 @@ def test_audio_single_ret(
                 for text in texts[i : min(i + 50, end_idx)]:
                     # text = text --> seems no need for template for retrieval
                     samples_list.append(text)
-                tokenized_captions = tokenizer(samples_list).cuda(
+                tokenized_captions = tokenizer(samples_list).to(
                     args.device, non_blocking=True
                 )
 
-                if args.distributed:
-                    text_logits = open_clip_text_model.module.encode_text(
-                        tokenized_captions, True
-                    )
-                else:
-                    text_logits = open_clip_text_model.encode_text(
-                        tokenized_captions, True
-                    )
+                text_logits = open_clip_text_model.encode_text(
+                    tokenized_captions, True
+                )
                 text_logits_list.append(text_logits)
 
-            text_logits = torch.cat(text_logits_list, dim=0).to(torch.float16)
+            text_logits = torch.cat(text_logits_list, dim=0).to(get_policy().feature_dtype)
             text_logits = (
                 misc.all_gather(text_logits) if args.distributed else text_logits
             )
@@ -4074,7 +4235,7 @@ def test_audio_single_ret(
                 n_clip = audio.size(1)
                 audio = einops.rearrange(audio, "b n ... -> (b n) ...")
 
-            with torch.cuda.amp.autocast():
+            with get_policy().autocast():
                 output = model(
                     [{"audio": audio}],
                     ["audio"],
@@ -4085,7 +4246,7 @@ def test_audio_single_ret(
                     afeat = einops.rearrange(afeat, "(b n) ... -> b n ...", n=n_clip)
                     afeat = torch.mean(afeat, dim=1)
                 audio_logits = afeat / afeat.norm(dim=-1, keepdim=True)
-                audio_logits = audio_logits.to(torch.float16)
+                audio_logits = audio_logits.to(get_policy().feature_dtype)
                 metric.compute(audio_ids, audio_logits)
 
         stats = metric.merge_results()
@@ -4157,13 +4318,17 @@ def test_vidret_single(
     # zs_mean_pool = args.vid_dire_mean_pool
     # n_frames = args.n_frames
 
+    video_norm = get_video_norm(testloader.dataset)
+
     with torch.no_grad():
         for batch in video_metric_logger.log_every(testloader, 50, video_header):
             video, text, vid = batch["video"], batch["caption"], batch["vid"]
 
             video = video.to(args.device, non_blocking=True)
+            if video_norm is not None:
+                video = normalize_video(video, *video_norm)
 
-            with torch.cuda.amp.autocast():
+            with get_policy().autocast():
                 output = model(
                     [{"video": video}],
                     ["video"],
@@ -4175,10 +4340,7 @@ def test_vidret_single(
             #     vfeat = einops.rearrange(vfeat, "(b t) ... -> b t ...", t=n_frames)
             #     vfeat = torch.mean(vfeat, dim=1)
             # vfeat = vfeat / vfeat.norm(dim=-1, keepdim=True)
-            if args.distributed:
-                tfeat = open_clip_text_model.module.encode_text(text, True)
-            else:
-                tfeat = open_clip_text_model.encode_text(text, True)
+            tfeat = open_clip_text_model.encode_text(text, True)
 
             tfeat = tfeat.to(vfeat.dtype)
             
@@ -33,9 +33,13 @@ import util.misc as misc
 
 from util.pos_embed import interpolate_pos_embed
 from util.misc import NativeScalerWithGradNormCount as NativeScaler
+from util.precision import PrecisionPolicy, get_policy, set_policy
+from util.grad_sync import GradReducer
+from torch.distributed.optim import ZeroRedundancyOptimizer
 
 import src.models.vit_one_anchor as vit_one
 from src.models.lora_module.lora import LoraConfig, LoraModel
+from src.models.tome import token_merge_sweep
 from src.train.engine_pretrain_one_anchor import (
     train_one_epoch_concat,
     train_one_epoch_concat_use_all,
@@ -247,6 +251,24 @@ def get_args_parser():
         type=str,
         help="dataset path",
     )
+    parser.add_argument(
+        "--img_manifest_dir",
+        type=str,
+        default=None,
+        help="cache the ImageFolder file list here and skip the directory walk",
+    )
+    parser.add_argument(
+        "--img_draft_size",
+        type=int,
+        default=None,
+        help="train JPEGs are DCT-downscaled at decode, keeping the short side >= this",
+    )
+    parser.add_argument(
+        "--img_decode_benchmark",
+        type=int,
+        default=0,
+        help="report full vs draft decode throughput on N train images at startup",
+    )
     parser.add_argument(
         "--image_nb_classes",
         default=1000,
@@ -376,9 +398,32 @@ def get_args_parser():
     parser.add_argument(
         "--device", default="cuda", help="device to use for training / testing"
     )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="auto",
+        choices=["auto", "fp16", "bf16", "fp32"],
+        help="autocast dtype, auto = fp16 on cuda, bf16 on cpu",
+    )
     parser.add_argument("--seed", default=0, type=int)
     parser.add_argument("--resume", default="", help="resume from checkpoint")
 
+    parser.add_argument(
+        "--save_ckpt_steps",
+        default=0,
+        type=int,
+        help="also save step_ckpt.pth (with the sampler position) every N optimizer steps",
+    )
+    parser.add_argument(
+        "--resume_step",
+        action="store_true",
+        help="continue from output_dir/step_ckpt.pth if it is not older than the resumed epoch",
+    )
+    parser.add_argument(
+        "--deferred_metrics",
+        action="store_true",
+        help="keep logged loss values on device and read them back only when printing",
+    )
     parser.add_argument(
         "--start_epoch", default=0, type=int, metavar="N", help="start epoch"
     )
@@ -390,6 +435,29 @@ def get_args_parser():
         help="Enabling distributed evaluation (recommended during training for faster monitor",
     )
     parser.add_argument("--num_workers", default=2, type=int)
+    parser.add_argument(
+        "--prefetch_depth",
+        default=1,
+        type=int,
+        help="train batches copied to the device ahead of the step",
+    )
+    parser.add_argument(
+        "--multiloader_depth",
+        default=0,
+        type=int,
+        help="batches in flight per modality; > 0 serves whichever modality is ready first",
+    )
+    parser.add_argument(
+        "--columnar_collate",
+        action="store_true",
+        help="collate with datasets/fast_collate.py instead of SampleList",
+    )
+    parser.add_argument(
+        "--collate_benchmark",
+        default=0,
+        type=int,
+        help="time SampleList vs columnar collate on N batches of every train modality",
+    )
     parser.add_argument(
         "--pin_mem",
         action="store_true",
@@ -468,6 +536,32 @@ def get_args_parser():
         default="/checkpoint/berniehuang/ast/egs/esc50/data/ESC-50-master/fbank",
         help="fbank dir",
     )
+    parser.add_argument(
+        "--fbank_cache_dir",
+        type=str,
+        default=None,
+        help="cache whole-file fbanks of the AudioSet training clips as float16 "
+        "memmap shards under this dir (samples without mixup)",
+    )
+    parser.add_argument(
+        "--audio_batch_specaug",
+        default=False,
+        action="store_true",
+        help="training audio: SpecAugment, fbank normalisation and noise on the "
+        "collated batch instead of per sample in the workers",
+    )
+    parser.add_argument(
+        "--audio_length_buckets",
+        type=str,
+        default=None,
+        help="comma separated fbank frame boundaries, e.g. 256,512,768; batch "
+        "audio clips of similar length and crop the padding (needs --use_flash_attn)",
+    )
+    parser.add_argument(
+        "--log_bucket_time",
+        action="store_true",
+        help="log audio samples/s per padded length at epoch end (with --audio_length_buckets)",
+    )
     parser.add_argument(
         "--audio_load_vision",
         default=False,
@@ -590,6 +684,14 @@ def get_args_parser():
     parser.add_argument("--pc_rep_w", type=float, default=1.0, help="pc repeat weight")
     parser.add_argument("--concat", action="store_true", help="concatenate datasets")
     parser.add_argument("--use_flash_attn", action="store_true", help="use flash attn")
+    parser.add_argument(
+        "--ckpt_memory_budget",
+        type=str,
+        nargs="+",
+        default=None,
+        help="activation checkpointing budget per modality in GB, e.g. video:6 audio:4; "
+        "the fewest leading blocks that fit are checkpointed",
+    )
     parser.add_argument(
         "--frozen_backbone", action="store_true", default=False, help="frozen backbone"
     )
@@ -673,6 +775,12 @@ def get_args_parser():
     parser.add_argument("--rgbd_logits_name", type=str, default=None)
     parser.add_argument("--rgbd_text_logits_name", type=str, default=None)
     parser.add_argument("--rgbd_image_logits_name", type=str, default=None)
+    parser.add_argument(
+        "--rgbd_depth_cache",
+        type=str,
+        default=None,
+        help="dir of DepthNorm-ed disparity built by datasets/modal_depth/depth_cache.py",
+    )
 
     parser.add_argument("--rgbd_topk", type=int, default=768, help="rgbd topk")
     parser.add_argument("--rgbd_rep_w", type=float, default=1.0, help="rgbd rep weight")
@@ -745,6 +853,31 @@ def get_args_parser():
     parser.add_argument("--video_short_side_size", type=int, default=224)
     parser.add_argument("--video_test_num_segment", type=int, default=10)
     parser.add_argument("--video_test_num_crop", type=int, default=3)
+    parser.add_argument(
+        "--video_merge_ratio",
+        type=float,
+        default=0.0,
+        help="token merging at inference: fraction of video tokens merged after each block",
+    )
+    parser.add_argument(
+        "--audio_merge_ratio",
+        type=float,
+        default=0.0,
+        help="token merging at inference: fraction of audio tokens merged after each block",
+    )
+    parser.add_argument(
+        "--merge_ratio_sweep",
+        type=str,
+        default=None,
+        help="with --eval, rerun the video/audio evals for each merge ratio, e.g. 0,0.05,0.1,0.2",
+    )
+    parser.add_argument(
+        "--video_test_multi_view",
+        action="store_true",
+        default=False,
+        help="test mode decodes each video once and returns all segment x crop views "
+        "stacked; the eval forward runs over them one loader batch of clips at a time",
+    )
 
     parser.add_argument(
         "--video_color_jitter",
@@ -838,6 +971,13 @@ def get_args_parser():
     )
     parser.add_argument("--video_max_words", type=int, default=77, help="")
     parser.add_argument("--video_feature_framerate", type=int, default=1, help="")
+    parser.add_argument(
+        "--video_frame_store",
+        type=str,
+        default=None,
+        help="dir of pre-extracted MSRVTT frames (datasets/modal_video/frame_store.py); "
+        "read instead of decoding the videos when present",
+    )
 
     parser.add_argument(
         "--loose_type",
@@ -920,6 +1060,17 @@ def get_args_parser():
 
     parser.add_argument("--local_loss", action="store_true")
     parser.add_argument("--gather_with_grad", action="store_true")
+    parser.add_argument(
+        "--static_grad_buckets",
+        action="store_true",
+        help="average the gradients in per-modality buckets, only those of the "
+        "modalities a backward used, instead of DDP(find_unused_parameters=True)",
+    )
+    parser.add_argument(
+        "--shard_optimizer",
+        action="store_true",
+        help="shard the AdamW states across ranks (ZeroRedundancyOptimizer)",
+    )
 
     parser.add_argument(
         "--patch_drop_rate", type=float, default=0.0, help="patch drop rate"
@@ -929,6 +1080,33 @@ def get_args_parser():
 
     parser.add_argument("--use_sigliploss", action="store_true")
     parser.add_argument("--use_clip_loss", action="store_true")
+    parser.add_argument(
+        "--clip_loss_block",
+        type=int,
+        default=0,
+        help="rows of logits per block for a memory-efficient clip loss, 0 = dense",
+    )
+    parser.add_argument(
+        "--no_loss_registry",
+        action="store_false",
+        dest="loss_registry",
+        help="build the clip / kd loss modules on every call instead of once per run",
+    )
+    parser.add_argument(
+        "--log_loss_time",
+        action="store_true",
+        help="log the loss computation time and all-gathered bytes per step at epoch end",
+    )
+    parser.add_argument(
+        "--offload_inputs",
+        action="store_true",
+        help="keep the inputs of an accumulation window in pinned host memory until their re-forward",
+    )
+    parser.add_argument(
+        "--bucketed_gather",
+        action="store_true",
+        help="all-gather every loss feature of a step in one collective per dtype",
+    )
     parser.add_argument(
         "--task_balancer",
         type=str,
@@ -954,6 +1132,23 @@ def get_args_parser():
     parser.add_argument(
         "--use_text_branch", action="store_true", default=False, help="use text encoder"
     )
+    parser.add_argument(
+        "--text_embed_cache",
+        action="store_true",
+        help="cache the text branch caption embeddings by token ids",
+    )
+    parser.add_argument(
+        "--text_embed_cache_size",
+        type=int,
+        default=65536,
+        help="caption embeddings kept on device (LRU)",
+    )
+    parser.add_argument(
+        "--text_embed_cache_dir",
+        type=str,
+        default=None,
+        help="disk tier of the caption embedding cache, shared across runs",
+    )
 
     parser.add_argument(
         "--multi_modal_distill",
@@ -993,6 +1188,19 @@ def get_args_parser():
 
     parser.add_argument("--expert_nums", type=int, default=1)
 
+    parser.add_argument(
+        "--log_worker_rss",
+        type=int,
+        default=0,
+        help="log the RSS of each train dataloader worker every N batches (0: off)",
+    )
+    parser.add_argument(
+        "--log_ipc_freq",
+        type=int,
+        default=0,
+        help="log bytes per batch sent by each train dataloader worker and its samples/s every N batches (0: off)",
+    )
+
     return parser
 
 
@@ -1010,6 +1218,7 @@ def main(args):
     print_log("{}".format(args).replace(", ", ",\n"), logger=logger)
 
     device = torch.device(args.device)
+    set_policy(PrecisionPolicy(device, args.precision))
 
     seed = args.seed + misc.get_rank()
     torch.manual_seed(seed)
@@ -1109,6 +1318,7 @@ def main(args):
         )
         open_clip_text_model.eval()
         open_clip_text_model.visual = None
+        open_clip_text_model.requires_grad_(False)
         open_clip_text_model.to(device)
 
     if args.finetune:
@@ -1542,7 +1752,7 @@ def main(args):
             cur_modal = resolution[-1]
             if cur_modal == "image":
                 image = torch.FloatTensor(1, *resolution[:-1]).to(
-                    device, dtype=torch.float16
+                    device, dtype=get_policy().feature_dtype
                 )
                 input = {"image": image}
                 return {
@@ -1552,7 +1762,7 @@ def main(args):
                 }
             elif cur_modal == "audio":
                 audio = torch.FloatTensor(1, *resolution[:-1]).to(
-                    device, dtype=torch.float16
+                    device, dtype=get_policy().feature_dtype
                 )
                 input = {"audio": audio}
                 return {
@@ -1562,10 +1772,10 @@ def main(args):
                 }
             elif cur_modal == "point":
                 point = torch.FloatTensor(1, *resolution[0]).to(
-                    device, dtype=torch.float16
+                    device, dtype=get_policy().feature_dtype
                 )
                 image = torch.FloatTensor(1, *resolution[1]).to(
-                    device, dtype=torch.float16
+                    device, dtype=get_policy().feature_dtype
                 )
                 input = {"point": point, "image": image}
                 return {
@@ -1575,10 +1785,10 @@ def main(args):
                 }
             elif cur_modal == "rgbd":
                 depth = torch.FloatTensor(1, *resolution[0]).to(
-                    device, dtype=torch.float16
+                    device, dtype=get_policy().feature_dtype
                 )
                 image = torch.FloatTensor(1, *resolution[1]).to(
-                    device, dtype=torch.float16
+                    device, dtype=get_policy().feature_dtype
                 )
                 input = {"rgbd": depth, "image": image}
                 return {
@@ -1587,7 +1797,7 @@ def main(args):
                     "anchor_list": ["rgbd", "image"],
                 }
 
-        with torch.cuda.amp.autocast():
+        with get_policy().autocast():
             macs_cnt, params_cnt = get_model_complexity_info(
                 model,
                 resolution,
@@ -1637,18 +1847,26 @@ def main(args):
     print_log("accumulate grad iterations: %d" % args.accum_iter, logger=logger)
     print_log("effective batch size: %d" % eff_batch_size, logger=logger)
 
+    grad_sync = None
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(
-            model, device_ids=[args.gpu], find_unused_parameters=True
-        )
-        
-        model_without_ddp = model.module
-
-        if args.use_text_branch:
-            open_clip_text_model = torch.nn.parallel.DistributedDataParallel(
-                open_clip_text_model, device_ids=[args.gpu], find_unused_parameters=True
+        if args.static_grad_buckets:
+            # no DDP wrapper: the gradients of the modalities a step used are
+            # averaged before it
+            grad_sync = GradReducer(
+                model,
+                misc.get_world_size(),
+                sorted(set(train_modal_list) | set(model.patch_embed.keys())),
+            )
+        else:
+            model = torch.nn.parallel.DistributedDataParallel(
+                model, device_ids=[args.gpu], find_unused_parameters=True
             )
 
+            model_without_ddp = model.module
+
+        # the frozen text tower is loaded from the same weights on every rank,
+        # it has nothing to synchronise and is not wrapped in DDP
+
         if args.task_balancer != "none":
             loss_balancer = torch.nn.parallel.DistributedDataParallel(
                 loss_balancer, device_ids=[args.gpu], find_unused_parameters=True
@@ -1666,11 +1884,21 @@ def main(args):
         no_weight_decay_list=model_without_ddp.no_weight_decay(),
     )
     
-    optimizer = torch.optim.AdamW(
-        param_groups, lr=args.lr, betas=(0.9, 0.98), eps=1.0e-6
-    )
+    if args.distributed and args.shard_optimizer:
+        # each rank keeps the AdamW states of its share of the parameters
+        optimizer = ZeroRedundancyOptimizer(
+            param_groups,
+            optimizer_class=torch.optim.AdamW,
+            lr=args.lr,
+            betas=(0.9, 0.98),
+            eps=1.0e-6,
+        )
+    else:
+        optimizer = torch.optim.AdamW(
+            param_groups, lr=args.lr, betas=(0.9, 0.98), eps=1.0e-6
+        )
     
-    loss_scaler = NativeScaler()
+    loss_scaler = NativeScaler(enabled=get_policy().use_grad_scaler, grad_sync=grad_sync)
 
     criterion = {}
     if mixup_fn is not None:
@@ -1812,6 +2040,13 @@ def main(args):
     )
     if resume_metric is not None:
         best_metric = resume_metric
+    resume_data_state = None
+    if args.output_dir and args.resume_step and not args.eval:
+        resume_data_state = misc.resume_step_checkpoint(
+            args, model_without_ddp, optimizer, loss_scaler
+        )
+        if resume_data_state is not None and hasattr(data_loaders_train, "load_state_dict"):
+            data_loaders_train.load_state_dict(resume_data_state)
 
     if args.eval:
         for modal in eval_modal_list:
@@ -1835,6 +2070,16 @@ def main(args):
                 test_audio_metrics = test_audiotasks_core(
                     data["val"]["audio"], model, open_clip_text_model, tokenizer, args
                 )
+                if args.merge_ratio_sweep:
+                    token_merge_sweep(
+                        model_without_ddp,
+                        "audio",
+                        [float(r) for r in args.merge_ratio_sweep.split(",")],
+                        lambda: test_audiotasks_core(
+                            data["val"]["audio"], model, open_clip_text_model, tokenizer, args
+                        ),
+                        logger=logger,
+                    )
                 
             elif modal == "point":
                 test_point_metrics = test_zeroshot_3d_core(
@@ -1850,6 +2095,16 @@ def main(args):
                 test_video_metrics = test_vidret_core(
                     data["val"]["video"], model, open_clip_text_model, tokenizer, args
                 )
+                if args.merge_ratio_sweep:
+                    token_merge_sweep(
+                        model_without_ddp,
+                        "video",
+                        [float(r) for r in args.merge_ratio_sweep.split(",")],
+                        lambda: test_vidret_core(
+                            data["val"]["video"], model, open_clip_text_model, tokenizer, args
+                        ),
+                        logger=logger,
+                    )
                 
 
         exit(0)
@@ -1864,6 +2119,9 @@ def main(args):
                 data_loaders_train.sampler.set_epoch(epoch)
             else:
                 data_loaders_train.set_epoch(epoch)
+        elif resume_data_state is not None and hasattr(data_loaders_train, "load_state_dict"):
+            data_loaders_train.set_epoch(epoch)
+        resume_data_state = None
 
         if args.concat:
             if args.batch_mode == "use_all":
@@ -2090,8 +2348,11 @@ def main(args):
 
 
 if __name__ == "__main__":
-    args = get_args_parser()
-    args = args.parse_args()
+    parser = get_args_parser()
+    args = parser.parse_args()
+    if args.audio_length_buckets and not args.use_flash_attn:
+        # the padding mask only reaches attention in the varlen flash path
+        parser.error("--audio_length_buckets requires --use_flash_attn")
     if args.output_dir:
         Path(args.output_dir).mkdir(parents=True, exist_ok=True)
     main(args)
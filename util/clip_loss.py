@@ -1,8 +1,12 @@
 from calendar import c
+import time
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from util import gather_plan
+
 try:
     import torch.distributed.nn
     from torch import distributed as dist
@@ -23,6 +27,41 @@ def kd_normalize(logit):
     return (logit - mean) / (1e-7 + stdv)
 
 
+# bytes all-gathered by the loss functions (as received by this rank), and
+# bytes not gathered because the input is the same on every rank
+COMM_STATS = {"gathered": 0, "skipped": 0, "collectives": 0}
+
+
+def _count_gather(tensor, world_size, skipped=False):
+    COMM_STATS["skipped" if skipped else "gathered"] += (
+        tensor.numel() * tensor.element_size() * world_size
+    )
+    if not skipped:
+        COMM_STATS["collectives"] += 1
+
+
+def reset_comm_stats():
+    COMM_STATS["gathered"] = 0
+    COMM_STATS["skipped"] = 0
+    COMM_STATS["collectives"] = 0
+
+
+def begin_gather_plan(tensors, local_loss=False, gather_with_grad=False, rank=0, world_size=1):
+    """Gather ``tensors`` with one collective per dtype and serve them to the
+    loss functions until ``end_gather_plan()``. No-op on a single rank."""
+    if world_size <= 1:
+        return None
+    plan = gather_plan.GatherPlan(local_loss, gather_with_grad, rank, world_size)
+    plan.add(*tensors).run()
+    COMM_STATS["gathered"] += plan.gathered_bytes
+    COMM_STATS["collectives"] += plan.num_collectives
+    return gather_plan.activate(plan)
+
+
+def end_gather_plan():
+    gather_plan.deactivate()
+
+
 def gather_features(
     image_features,
     text_features,
@@ -31,8 +70,36 @@ def gather_features(
     rank=0,
     world_size=1,
     use_horovod=False,
+    image_replicated=False,
+    text_replicated=False,
 ):
+    """All-gather both feature sets. A ``*_replicated`` input holds the same
+    tensor on every rank (e.g. class-name embeddings) and is returned as is:
+    gathering it would only stack ``world_size`` copies of it."""
     assert has_distributed, "torch.distributed did not import correctly, please use a PyTorch version with support."
+    if image_replicated or text_replicated or (
+        gather_plan.active_plan() is not None and not use_horovod
+    ):
+        # gathered side by side: replicated inputs are skipped, planned
+        # inputs come from the step's GatherPlan
+        all_image_features = image_features
+        all_text_features = text_features
+        if not image_replicated:
+            all_image_features = gather_features_single(
+                image_features, local_loss, gather_with_grad, rank, world_size
+            )
+        else:
+            _count_gather(image_features, world_size, skipped=True)
+        if not text_replicated:
+            all_text_features = gather_features_single(
+                text_features, local_loss, gather_with_grad, rank, world_size
+            )
+        else:
+            _count_gather(text_features, world_size, skipped=True)
+        return all_image_features, all_text_features
+
+    _count_gather(image_features, world_size)
+    _count_gather(text_features, world_size)
     if use_horovod:
         assert hvd is not None, "Please install horovod"
         if gather_with_grad:
@@ -89,6 +156,12 @@ def gather_features_single(
     rank=0,
     world_size=1,
 ):
+    plan = gather_plan.active_plan()
+    if plan is not None:
+        all_image_features = plan.get(image_features, gather_with_grad)
+        if all_image_features is not None:
+            return all_image_features
+    _count_gather(image_features, world_size)
     # We gather tensors from all gpus
     if gather_with_grad:
         all_image_features = torch.cat(
@@ -111,6 +184,70 @@ def gather_features_single(
     return all_image_features
 
 
+class BlockwiseInfoNCE(torch.autograd.Function):
+    """``F.cross_entropy(scale * q @ k.T, arange(len(q)) + offset)`` computed
+    ``block`` rows of logits at a time.
+
+    Only the per-row log-sum-exp is kept for backward, where the logits of
+    each row block are recomputed, so memory is O(len(k) * block) instead of
+    O(len(q) * len(k)). Runs in fp32 regardless of autocast. Checked
+    against the dense loss with ``python -m util.clip_loss --world_size 2``.
+    """
+
+    @staticmethod
+    def forward(ctx, q, k, scale, offset, block):
+        # what custom_fwd(cast_inputs=float32) does, for the autocast of
+        # q's device (CUDA fp16 or CPU bf16) rather than CUDA only
+        with torch.autocast(device_type=q.device.type, enabled=False):
+            return BlockwiseInfoNCE._forward(ctx, q.float(), k.float(), scale.float(), offset, block)
+
+    @staticmethod
+    def _forward(ctx, q, k, scale, offset, block):
+        lse = q.new_empty(q.shape[0])
+        loss = q.new_zeros(())
+        for start in range(0, q.shape[0], block):
+            qb = q[start : start + block]
+            logits = scale * (qb @ k.T)
+            lse[start : start + block] = torch.logsumexp(logits, dim=1)
+            pos = k[start + offset : start + offset + qb.shape[0]]
+            loss += (lse[start : start + block] - scale * (qb * pos).sum(dim=1)).sum()
+        ctx.save_for_backward(q, k, scale, lse)
+        ctx.offset = offset
+        ctx.block = block
+        return loss / q.shape[0]
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        q, k, scale, lse = ctx.saved_tensors
+        with torch.autocast(device_type=q.device.type, enabled=False):
+            return BlockwiseInfoNCE._backward(ctx, grad_output.float(), q, k, scale, lse)
+
+    @staticmethod
+    def _backward(ctx, grad_output, q, k, scale, lse):
+        grad = grad_output / q.shape[0]
+        dq = torch.empty_like(q)
+        dk = torch.zeros_like(k)
+        dscale = q.new_zeros(())
+        for start in range(0, q.shape[0], ctx.block):
+            qb = q[start : start + ctx.block]
+            rows = torch.arange(qb.shape[0], device=q.device)
+            sim = qb @ k.T
+            # d loss / d logits = (softmax - onehot) * grad
+            dlogits = torch.exp(scale * sim - lse[start : start + ctx.block, None])
+            dlogits[rows, rows + start + ctx.offset] -= 1
+            dlogits *= grad
+            dq[start : start + ctx.block] = scale * (dlogits @ k)
+            dk += scale * (dlogits.T @ qb)
+            dscale += (dlogits * sim).sum()
+        return dq, dk, dscale.reshape(scale.shape), None, None
+
+
+def blockwise_info_nce(q, k, logit_scale, offset=0, block=1024):
+    if not torch.is_tensor(logit_scale):
+        logit_scale = torch.tensor(float(logit_scale), device=q.device)
+    return BlockwiseInfoNCE.apply(q, k, logit_scale, offset, block)
+
+
 class ClipLoss(nn.Module):
     def __init__(
         self,
@@ -120,7 +257,11 @@ class ClipLoss(nn.Module):
         rank=0,
         world_size=1,
         use_horovod=False,
+        block_size=0,
     ):
+        """``block_size`` > 0 computes the loss with ``BlockwiseInfoNCE``
+        instead of materialising the global logits (not when the logits are
+        returned)."""
         super().__init__()
         self.local_loss = local_loss
         self.gather_with_grad = gather_with_grad
@@ -128,22 +269,22 @@ class ClipLoss(nn.Module):
         self.rank = rank
         self.world_size = world_size
         self.use_horovod = use_horovod
+        self.block_size = block_size
 
-        # cache state
+        # cache state, keyed by (device, num_logits)
         self.prev_num_logits = 0
         self.labels = {}
 
     def get_ground_truth(self, device, num_logits) -> torch.Tensor:
         # calculated ground-truth and cache if enabled
-        if self.prev_num_logits != num_logits or device not in self.labels:
+        labels = self.labels.get((device, num_logits))
+        if labels is None:
             labels = torch.arange(num_logits, device=device, dtype=torch.long)
             if self.world_size > 1 and self.local_loss:
                 labels = labels + num_logits * self.rank
             if self.cache_labels:
-                self.labels[device] = labels
+                self.labels[(device, num_logits)] = labels
                 self.prev_num_logits = num_logits
-        else:
-            labels = self.labels[device]
         return labels
 
     def get_logits(self, image_features, text_features, logit_scale):
@@ -172,6 +313,28 @@ class ClipLoss(nn.Module):
 
         return logits_per_image, logits_per_text
 
+    def blockwise_loss(self, image_features, text_features, logit_scale):
+        offset = 0
+        all_image_features, all_text_features = image_features, text_features
+        if self.world_size > 1:
+            all_image_features, all_text_features = gather_features(
+                image_features,
+                text_features,
+                self.local_loss,
+                self.gather_with_grad,
+                self.rank,
+                self.world_size,
+                self.use_horovod,
+            )
+            if self.local_loss:
+                offset = image_features.shape[0] * self.rank
+            else:
+                image_features, text_features = all_image_features, all_text_features
+        return (
+            blockwise_info_nce(image_features, all_text_features, logit_scale, offset, self.block_size)
+            + blockwise_info_nce(text_features, all_image_features, logit_scale, offset, self.block_size)
+        ) / 2
+
     def forward(
         self,
         image_features,
@@ -180,6 +343,10 @@ class ClipLoss(nn.Module):
         output_dict=False,
         return_logits=False,
     ):
+        if self.block_size > 0 and not return_logits:
+            total_loss = self.blockwise_loss(image_features, text_features, logit_scale)
+            return {"contrastive_loss": total_loss} if output_dict else total_loss
+
         device = image_features.device
         logits_per_image, logits_per_text = self.get_logits(
             image_features, text_features, logit_scale
@@ -350,9 +517,14 @@ class SigLipLoss(nn.Module):
     def get_ground_truth(
         self, device, dtype, num_logits, negative_only=False
     ) -> torch.Tensor:
-        labels = -torch.ones((num_logits, num_logits), device=device, dtype=dtype)
-        if not negative_only:
-            labels = 2 * torch.eye(num_logits, device=device, dtype=dtype) + labels
+        key = (device, dtype, num_logits, negative_only)
+        labels = self.labels.get(key)
+        if labels is None:
+            labels = -torch.ones((num_logits, num_logits), device=device, dtype=dtype)
+            if not negative_only:
+                labels = 2 * torch.eye(num_logits, device=device, dtype=dtype) + labels
+            if self.cache_labels:
+                self.labels[key] = labels
         return labels
 
     def get_logits(self, image_features, text_features, logit_scale, logit_bias=None):
@@ -452,6 +624,7 @@ class KD_Norm_Loss(nn.Module):
         gather_with_grad=False,
         rank=0,
         world_size=1,
+        reuse_teacher_logits=False,
     ):
         super().__init__()
         self.local_loss = local_loss
@@ -460,6 +633,62 @@ class KD_Norm_Loss(nn.Module):
         self.rank = rank
         self.world_size = world_size
         self.T = nn.Parameter(torch.tensor(1.0))
+        # teacher logits are standardised by kd_normalize, so their gradient
+        # w.r.t. the shared logit scale is zero: compute them without grad
+        # into reusable buffers, keyed by (side, shape, device)
+        self.reuse_teacher_logits = reuse_teacher_logits
+        self._workspace = {}
+
+        # teacher logits computed this step, by cache key
+        self._teacher_logits = {}
+
+    def new_step(self):
+        self._teacher_logits = {}
+
+    def _matmul_ws(self, side, key, a, b):
+        # fp32 like the scaled logits were; out= is not autocast-eligible
+        ws_key = (side, key, a.shape[0], b.shape[0], a.device)
+        out = self._workspace.get(ws_key)
+        if out is None:
+            out = a.new_empty((a.shape[0], b.shape[0]), dtype=torch.float32)
+            self._workspace[ws_key] = out
+        return torch.matmul(a.float(), b.float().T, out=out)
+
+    @torch.no_grad()
+    def get_teacher_logits(self, image_features, text_features, key=None, text_replicated=False):
+        """Teacher logits, computed once per ``key`` until ``new_step()``."""
+        if key is not None and key in self._teacher_logits:
+            return self._teacher_logits[key]
+        # logit scale left out: it cancels in kd_normalize
+        if self.world_size > 1:
+            all_image_features, all_text_features = gather_features(
+                image_features,
+                text_features,
+                self.local_loss,
+                False,
+                self.rank,
+                self.world_size,
+                False,
+                text_replicated=text_replicated,
+            )
+            if self.local_loss:
+                logits = (
+                    self._matmul_ws("image", key, image_features, all_text_features),
+                    self._matmul_ws("text", key, text_features, all_image_features),
+                )
+            else:
+                logits_per_image = self._matmul_ws(
+                    "image", key, all_image_features, all_text_features
+                )
+                logits = (logits_per_image, logits_per_image.T)
+        else:
+            logits = (
+                self._matmul_ws("image", key, image_features, text_features),
+                self._matmul_ws("text", key, text_features, image_features),
+            )
+        if key is not None:
+            self._teacher_logits[key] = logits
+        return logits
 
     def distill_loss(
         self, logits_student_in, logits_teacher_in, temperature, logit_stand=True
@@ -478,7 +707,7 @@ class KD_Norm_Loss(nn.Module):
         loss_kd *= temperature**2
         return loss_kd
 
-    def get_logits(self, image_features, text_features, logit_scale):
+    def get_logits(self, image_features, text_features, logit_scale, text_replicated=False):
         if self.world_size > 1:
             all_image_features, all_text_features = gather_features(
                 image_features,
@@ -488,6 +717,7 @@ class KD_Norm_Loss(nn.Module):
                 self.rank,
                 self.world_size,
                 False,
+                text_replicated=text_replicated,
             )
 
             if self.local_loss:
@@ -513,14 +743,33 @@ class KD_Norm_Loss(nn.Module):
         teacher_text_features,
         teacher_logit_scale,
         output_dict=False,
+        text_replicated=False,
+        teacher_key=None,
     ):
+        """``text_replicated``: both text inputs are the same on every rank and
+        are not gathered. ``teacher_key``: reuse the teacher logits computed
+        under that key this step (only with ``reuse_teacher_logits``)."""
         student_logits_per_image, student_logits_per_text = self.get_logits(
-            student_image_features, student_text_features, student_logit_scale
+            student_image_features,
+            student_text_features,
+            student_logit_scale,
+            text_replicated=text_replicated,
         )
 
-        teacher_logits_per_image, teacher_logits_per_text = self.get_logits(
-            teacher_image_features, teacher_text_features, teacher_logit_scale
-        )
+        if self.reuse_teacher_logits:
+            teacher_logits_per_image, teacher_logits_per_text = self.get_teacher_logits(
+                teacher_image_features,
+                teacher_text_features,
+                key=teacher_key,
+                text_replicated=text_replicated,
+            )
+        else:
+            teacher_logits_per_image, teacher_logits_per_text = self.get_logits(
+                teacher_image_features,
+                teacher_text_features,
+                teacher_logit_scale,
+                text_replicated=text_replicated,
+            )
 
         total_loss = (
             self.distill_loss(
@@ -534,6 +783,134 @@ class KD_Norm_Loss(nn.Module):
         return {"distill_loss": total_loss} if output_dict else total_loss
 
 
+class LossRegistry:
+    """Loss modules that live for the whole run, one per (modality, anchor),
+    so that label caches and logits workspaces are hit across steps."""
+
+    def __init__(self, args, local_loss=False, gather_with_grad=False, rank=0, world_size=1):
+        self.args = args
+        self.local_loss = local_loss
+        self.gather_with_grad = gather_with_grad
+        self.rank = rank
+        self.world_size = world_size
+        self.modules = {}
+
+    def _get(self, key, build):
+        module = self.modules.get(key)
+        if module is None:
+            module = build()
+            self.modules[key] = module
+        return module
+
+    def clip(self, modal, anchor):
+        if self.args.use_sigliploss:
+            return self._get(
+                ("siglip", modal, anchor),
+                lambda: SigLipLoss(cache_labels=True, rank=self.rank, world_size=self.world_size),
+            )
+        return self._get(
+            ("clip", modal, anchor),
+            lambda: ClipLoss(
+                local_loss=self.local_loss,
+                gather_with_grad=self.gather_with_grad,
+                cache_labels=True,
+                rank=self.rank,
+                world_size=self.world_size,
+                block_size=getattr(self.args, "clip_loss_block", 0),
+            ),
+        )
+
+    def distill_kl(self, modal):
+        return self._get(("distill_kl", modal), lambda: DistillKL(T=1.0, logit_stand=True))
+
+    def new_step(self):
+        """Drop the per-step teacher logits; call once per accumulation window."""
+        for module in self.modules.values():
+            if isinstance(module, KD_Norm_Loss):
+                module.new_step()
+
+    def kd_norm(self, modal):
+        def build():
+            kd = KD_Norm_Loss(
+                self.local_loss,
+                self.gather_with_grad,
+                self.rank,
+                self.world_size,
+                reuse_teacher_logits=True,
+            )
+            # T was a fresh 1.0 every step before and is not in the optimizer
+            kd.T.requires_grad_(False)
+            return kd
+
+        return self._get(("kd_norm", modal), build)
+
+
+_LOSS_REGISTRY = None
+
+
+def get_loss_registry(args, local_loss=False, gather_with_grad=False, rank=0, world_size=1):
+    """The run's ``LossRegistry``, built on first use."""
+    global _LOSS_REGISTRY
+    if _LOSS_REGISTRY is None:
+        _LOSS_REGISTRY = LossRegistry(args, local_loss, gather_with_grad, rank, world_size)
+    return _LOSS_REGISTRY
+
+
+class LossOverheadTimer:
+    """Time of the loss computation per optimizer step, and the bytes the loss
+    functions all-gathered (``COMM_STATS``) per step. On CUDA the loss is
+    bracketed by events, read back once in ``report``; on CPU it is
+    ``time.perf_counter``."""
+
+    def __init__(self):
+        self.total = 0.0
+        self.steps = 0
+        self.use_cuda = torch.cuda.is_available()
+        # CUDA: (start, end) per loss computation
+        self.events = []
+        self._start = None
+        reset_comm_stats()
+
+    def start(self):
+        if self.use_cuda:
+            self._start = torch.cuda.Event(enable_timing=True)
+            self._start.record()
+        else:
+            self._start = time.perf_counter()
+
+    def stop(self):
+        if self.use_cuda:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            self.events.append((self._start, end))
+        else:
+            self.total += time.perf_counter() - self._start
+        self._start = None
+
+    def step(self):
+        self.steps += 1
+
+    def report(self, logger=None, name=""):
+        from util.logger import print_log
+
+        if self.events:
+            torch.cuda.synchronize()
+            self.total += sum(s.elapsed_time(e) for s, e in self.events) / 1000
+            self.events = []
+        print_log(
+            f"[Loss] {name}: {self.total / max(self.steps, 1) * 1000:.2f} ms of loss "
+            f"computation per step over {self.steps} steps",
+            logger=logger,
+        )
+        steps = max(self.steps, 1)
+        print_log(
+            f"[Loss] {name}: {COMM_STATS['gathered'] / steps / 2**20:.2f} MB all-gathered per step, "
+            f"{COMM_STATS['skipped'] / steps / 2**20:.2f} MB skipped (rank-replicated inputs), "
+            f"{COMM_STATS['collectives'] / steps:.1f} collectives",
+            logger=logger,
+        )
+
+
 def single_uni_modal_clip_loss_gather(
     cur_modal,
     samples_proj2text_features,
@@ -544,21 +921,29 @@ def single_uni_modal_clip_loss_gather(
     rank=0,
     world_size=1,
     args=None,
+    losses=None,
 ):
     dict_nce_loss = {}
     sim_dict = {}
     
-    if args.use_sigliploss:
+    if losses is not None:
+        clip_loss = None
+    elif args.use_sigliploss:
         clip_loss = SigLipLoss(cache_labels=True,rank=rank,world_size=world_size)
     else:
-        clip_loss = ClipLoss(local_loss=local_loss,gather_with_grad=gather_with_grad,cache_labels=True,rank=rank,world_size=world_size)
+        clip_loss = ClipLoss(local_loss=local_loss,gather_with_grad=gather_with_grad,cache_labels=True,rank=rank,world_size=world_size,block_size=getattr(args, "clip_loss_block", 0))
     
     return_logits=False
     if len(samples_proj2text_features[cur_modal]) > 1:
         return_logits = True
-        kd_norm_loss = DistillKL(T=1.0, logit_stand=True)
+        if losses is not None:
+            kd_norm_loss = losses.distill_kl(cur_modal)
+        else:
+            kd_norm_loss = DistillKL(T=1.0, logit_stand=True)
 
     for anchor, _ in samples_proj2text_features[cur_modal].items():
+        if losses is not None:
+            clip_loss = losses.clip(cur_modal, anchor)
         if return_logits:
             nce_anchor2text_loss, sim_anchor2text = clip_loss(samples_proj2text_features[cur_modal][anchor],samples_text_features[cur_modal],logit_scale[anchor],return_logits=return_logits)
             sim_dict[anchor] = sim_anchor2text
@@ -599,19 +984,33 @@ def single_cross_modal_kd_loss_gather(
     gather_with_grad=False,
     rank=0,
     world_size=1,
+    losses=None,
 ):
     dict_kd_loss = {}
 
     # text_features = gather_features_single(
     #     samples_text_features[cur_modal], local_loss, gather_with_grad, rank, world_size
     # )
-    kd_norm_loss = KD_Norm_Loss(local_loss, gather_with_grad, rank, world_size)
+    if losses is not None:
+        kd_norm_loss = losses.kd_norm(cur_modal)
+    else:
+        kd_norm_loss = KD_Norm_Loss(local_loss, gather_with_grad, rank, world_size)
 
     for m_target in modal_list:
         for anchor, _ in samples_proj2text_features[cur_modal].items():
             if m_target != cur_modal:
 
-                kd_loss = kd_norm_loss(samples_proj2text_features[cur_modal][anchor],modal_labels_features[m_target],logit_scale[cur_modal],samples_text_features[cur_modal],modal_labels_features[m_target], logit_scale[cur_modal])
+                # class-name embeddings are the same on every rank: never gathered
+                kd_loss = kd_norm_loss(
+                    samples_proj2text_features[cur_modal][anchor],
+                    modal_labels_features[m_target],
+                    logit_scale[cur_modal],
+                    samples_text_features[cur_modal],
+                    modal_labels_features[m_target],
+                    logit_scale[cur_modal],
+                    text_replicated=True,
+                    teacher_key=m_target,
+                )
 
                 if anchor == cur_modal:
                     dict_kd_loss.update(
@@ -741,6 +1140,7 @@ def cross_modal_cls_gather(
                 rank,
                 world_size,
                 False,
+                text_replicated=True,
             )
 
             if local_loss:
@@ -772,6 +1172,7 @@ def cross_modal_cls_gather(
                 rank,
                 world_size,
                 False,
+                text_replicated=True,
             )
 
             if local_loss:
@@ -1287,3 +1688,71 @@ def single_kd_clip_loss_gather(
     
     
     # return dict_kd_clip_loss
+
+
+def _check_blockwise(rank, world_size, port):
+    """``BlockwiseInfoNCE`` / ``ClipLoss(block_size)`` == dense cross entropy,
+    loss and gradients of the features and the logit scale."""
+    import os
+
+    def dense_and_blockwise(q, k, scale, offset, block):
+        out = []
+        for fn in (
+            lambda: F.cross_entropy(
+                scale * q @ k.T, torch.arange(q.shape[0]) + offset
+            ),
+            lambda: blockwise_info_nce(q, k, scale, offset, block),
+        ):
+            loss = fn()
+            out.append((loss, torch.autograd.grad(loss, [q, k, scale])))
+        return out
+
+    torch.manual_seed(rank)
+    # block smaller than (and not dividing) the batch, and one block for all
+    for block in (3, 8):
+        for offset in (0, 8):
+            q = F.normalize(torch.randn(8, 16), dim=-1).requires_grad_()
+            k = F.normalize(torch.randn(16, 16), dim=-1).requires_grad_()
+            scale = torch.tensor(14.3, requires_grad=True)
+            (ref, ref_grads), (out, grads) = dense_and_blockwise(q, k, scale, offset, block)
+            assert torch.allclose(ref, out, atol=1e-5), (block, offset, ref, out)
+            for name, g_ref, g in zip(("q", "k", "scale"), ref_grads, grads):
+                assert torch.allclose(g_ref, g, atol=1e-5), (block, offset, name)
+
+    if world_size > 1:
+        os.environ["MASTER_ADDR"] = "127.0.0.1"
+        os.environ["MASTER_PORT"] = str(port)
+        dist.init_process_group("gloo", rank=rank, world_size=world_size)
+        for local_loss in (False, True):
+            for gather_with_grad in (False, True):
+                image = F.normalize(torch.randn(8, 16), dim=-1).requires_grad_()
+                text = F.normalize(torch.randn(8, 16), dim=-1).requires_grad_()
+                scale = torch.tensor(14.3, requires_grad=True)
+                results = []
+                for block_size in (0, 3):
+                    loss = ClipLoss(
+                        local_loss, gather_with_grad, rank=rank, world_size=world_size,
+                        block_size=block_size,
+                    )(image, text, scale)
+                    results.append((loss, torch.autograd.grad(loss, [image, text, scale])))
+                (ref, ref_grads), (out, grads) = results
+                assert torch.allclose(ref, out, atol=1e-5), (local_loss, gather_with_grad)
+                for name, g_ref, g in zip(("image", "text", "scale"), ref_grads, grads):
+                    assert torch.allclose(g_ref, g, atol=1e-5), (
+                        local_loss, gather_with_grad, name
+                    )
+        dist.destroy_process_group()
+    if rank == 0:
+        print(f"[BlockwiseInfoNCE] ok, world size {world_size}")
+
+
+if __name__ == "__main__":
+    # python -m util.clip_loss --world_size 2  (CPU, gloo)
+    import argparse
+    import torch.multiprocessing as mp
+
+    parser = argparse.ArgumentParser("BlockwiseInfoNCE self-check")
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--port", type=int, default=29534)
+    args = parser.parse_args()
+    mp.spawn(_check_blockwise, args=(args.world_size, args.port), nprocs=args.world_size)
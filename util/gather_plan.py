@@ -0,0 +1,190 @@
+"""Step-level feature all-gather in a single collective.
+
+The contrastive / KD losses gather every (anchor, target) feature pair on its
+own: a list-of-tensors ``all_gather`` per tensor, dozens of small
+latency-bound collectives per step. ``GatherPlan`` packs every tensor a step
+will gather into one flat buffer per dtype, gathers each buffer with one
+collective and hands out views; ``gather_features`` / ``gather_features_single``
+in ``util.clip_loss`` use them while the plan is active.
+
+Self-check on CPU with gloo::
+
+    python -m util.gather_plan --world_size 2
+"""
+import os
+import argparse
+
+import torch
+import torch.distributed as dist
+
+
+def _all_gather_flat(flat, world_size, group=None):
+    out = flat.new_empty(world_size * flat.numel())
+    if dist.get_backend(group) == "nccl":
+        dist.all_gather_into_tensor(out, flat, group=group)
+    else:
+        # gloo: no all_gather_into_tensor, gather into views of the output
+        dist.all_gather(list(out.chunk(world_size)), flat, group=group)
+    return out
+
+
+class _AllGatherFlat(torch.autograd.Function):
+    """all-gather of a 1-D buffer; backward sums the gradient of every rank's
+    copy and keeps this rank's chunk, like ``torch.distributed.nn.all_gather``."""
+
+    @staticmethod
+    def forward(ctx, flat, world_size, group):
+        ctx.world_size = world_size
+        ctx.group = group
+        return _all_gather_flat(flat, world_size, group)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.contiguous()
+        numel = grad_output.numel() // ctx.world_size
+        if dist.get_backend(ctx.group) == "nccl":
+            grad = grad_output.new_empty(numel)
+            dist.reduce_scatter_tensor(grad, grad_output, group=ctx.group)
+        else:
+            # gloo has no reduce_scatter
+            grad_output = grad_output.clone()
+            dist.all_reduce(grad_output, group=ctx.group)
+            rank = dist.get_rank(ctx.group)
+            grad = grad_output[rank * numel : (rank + 1) * numel]
+        return grad, None, None
+
+
+class GatherPlan:
+    """Gather a fixed set of tensors once and serve the results by identity.
+
+    Every rank must ``add()`` tensors of the same shapes in the same order.
+    ``get(t)`` returns what ``gather_features_single(t, ...)`` would: the
+    rank-major concatenation of ``t`` from all ranks; without
+    ``gather_with_grad`` and without ``local_loss`` this rank's chunk is ``t``
+    itself so the local gradient still flows.
+    """
+
+    def __init__(self, local_loss=False, gather_with_grad=False, rank=0, world_size=1, group=None):
+        self.local_loss = local_loss
+        self.gather_with_grad = gather_with_grad
+        self.rank = rank
+        self.world_size = world_size
+        self.group = group
+        self.tensors = []
+        self.gathered = {}
+        self.num_collectives = 0
+        self.gathered_bytes = 0
+
+    def add(self, *tensors):
+        for t in tensors:
+            if t is not None and not any(t is s for s in self.tensors):
+                assert t.ndim >= 1, "GatherPlan gathers along dim 0"
+                self.tensors.append(t)
+        return self
+
+    def run(self):
+        buckets = {}
+        for t in self.tensors:
+            buckets.setdefault(t.dtype, []).append(t)
+        for tensors in buckets.values():
+            flat = torch.cat([t.reshape(-1) for t in tensors])
+            with_grad = self.gather_with_grad and flat.requires_grad
+            if with_grad:
+                gathered = _AllGatherFlat.apply(flat, self.world_size, self.group)
+            else:
+                with torch.no_grad():
+                    gathered = _all_gather_flat(flat.detach(), self.world_size, self.group)
+            self.num_collectives += 1
+            self.gathered_bytes += gathered.numel() * gathered.element_size()
+            gathered = gathered.view(self.world_size, -1)
+            offset = 0
+            for t in tensors:
+                numel = t.numel()
+                all_t = gathered[:, offset : offset + numel].reshape(
+                    self.world_size * t.shape[0], *t.shape[1:]
+                )
+                offset += numel
+                if not with_grad and not self.local_loss:
+                    # ensure grads for local rank when all_* features don't have a gradient
+                    n = t.shape[0]
+                    all_t = torch.cat(
+                        [all_t[: self.rank * n], t, all_t[(self.rank + 1) * n :]], dim=0
+                    )
+                self.gathered[id(t)] = (t, all_t)
+        return self
+
+    def get(self, tensor, gather_with_grad=False):
+        """Gathered ``tensor``, or None when it was not planned."""
+        entry = self.gathered.get(id(tensor))
+        if entry is None or entry[0] is not tensor:
+            return None
+        if gather_with_grad and not self.gather_with_grad:
+            return None
+        return entry[1]
+
+
+_ACTIVE_PLAN = None
+
+
+def active_plan():
+    return _ACTIVE_PLAN
+
+
+def activate(plan):
+    global _ACTIVE_PLAN
+    _ACTIVE_PLAN = plan
+    return plan
+
+
+def deactivate():
+    global _ACTIVE_PLAN
+    _ACTIVE_PLAN = None
+
+
+def _check(rank, world_size, port):
+    """Planned gather == per-tensor gather, values and gradients."""
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    from util.clip_loss import gather_features_single
+
+    for local_loss in (False, True):
+        for gather_with_grad in (False, True):
+            torch.manual_seed(rank)
+            a = torch.randn(4, 8, requires_grad=True)
+            b = torch.randn(4, 3, 2, requires_grad=True)
+            c = torch.arange(4) + 10 * rank
+
+            def loss_of(gather):
+                all_a, all_b, all_c = gather(a), gather(b), gather(c)
+                # local term: keeps the loss differentiable when nothing gathered has grad
+                local = a.sum() + b.sum()
+                return (all_a.sum(1) * all_c).sum() + (all_b**2).sum() * (rank + 1) + local
+
+            ref = loss_of(
+                lambda t: gather_features_single(
+                    t, local_loss, gather_with_grad, rank, world_size
+                )
+            )
+            ref_grads = torch.autograd.grad(ref, [a, b])
+
+            plan = GatherPlan(local_loss, gather_with_grad, rank, world_size).add(a, b, c).run()
+            out = loss_of(plan.get)
+            grads = torch.autograd.grad(out, [a, b])
+            assert plan.num_collectives == 2, plan.num_collectives
+            assert torch.allclose(ref, out), (ref, out)
+            for g_ref, g in zip(ref_grads, grads):
+                assert torch.allclose(g_ref, g), (local_loss, gather_with_grad)
+    if rank == 0:
+        print(f"[GatherPlan] ok, world size {world_size}")
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    import torch.multiprocessing as mp
+
+    parser = argparse.ArgumentParser("GatherPlan self-check (gloo, CPU)")
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--port", type=int, default=29533)
+    args = parser.parse_args()
+    mp.spawn(_check, args=(args.world_size, args.port), nprocs=args.world_size)
@@ -0,0 +1,172 @@
+"""Gradient synchronisation without DistributedDataParallel.
+
+Every forward of the ViT runs one modality, so a different subset of the LoRA
+experts / modality heads is used each time. ``DistributedDataParallel`` needs
+``find_unused_parameters=True`` for that, which walks the autograd graph
+after every forward and reduces every parameter of the model.
+
+``GradReducer`` broadcasts the parameters from rank 0 once and builds one
+bucket set per modality at construction: the shared parameters, and the
+parameters whose name has the modality as a component (``patch_embed.audio``,
+``lora_A.audio``, ``logit_scale.audio``, ...). The training loop marks the
+modalities and anchors a backward ran with ``touch``; the next call averages
+only the shared buckets and the buckets of the touched modalities. The
+replayed windows of ``train_one_epoch_concat`` step the optimizer after
+every backward, so that is one reduction per backward, of the parameters
+that backward can have changed. A parameter that got no gradient on any
+rank keeps ``grad = None``, as under DDP.
+"""
+import time
+
+import torch
+import torch.distributed as dist
+
+from util.logger import print_log
+
+
+def _buckets(params, bucket_cap_mb):
+    buckets, bucket, size = [], [], 0
+    for p in params:
+        bucket.append(p)
+        size += p.numel() * 4
+        if size >= bucket_cap_mb * 2**20:
+            buckets.append(bucket)
+            bucket, size = [], 0
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+class GradReducer:
+    def __init__(self, module, world_size, modalities, bucket_cap_mb=25, group=None):
+        self.module = module
+        self.world_size = world_size
+        self.group = group
+        self.params = []
+        owned = {m: [] for m in modalities}
+        shared = []
+        for name, p in module.named_parameters():
+            if not p.requires_grad:
+                continue
+            self.params.append(p)
+            modal = next((m for m in name.split(".") if m in owned), None)
+            (owned[modal] if modal is not None else shared).append(p)
+        # "shared" is reduced on every call, a modality's buckets when touched
+        self.buckets = {"shared": _buckets(shared, bucket_cap_mb)}
+        for modal, params in owned.items():
+            self.buckets[modal] = _buckets(params, bucket_cap_mb)
+        self.touched = set()
+        # CUDA: (start, end) events per call, read back in report()
+        self.events = []
+        self.comm_time = 0.0
+        self.reduced_bytes = 0
+        self.steps = 0
+        self.broadcast()
+
+    @torch.no_grad()
+    def broadcast(self):
+        """Rank 0's parameters and buffers to every rank, like DDP at construction."""
+        for t in list(self.module.parameters()) + list(self.module.buffers()):
+            dist.broadcast(t.data, 0, group=self.group)
+
+    def touch(self, *modalities):
+        """Modalities (and anchors) whose parameters the next backward uses."""
+        self.touched.update(m for m in modalities if m in self.buckets)
+
+    @torch.no_grad()
+    def __call__(self):
+        use_cuda = torch.cuda.is_available()
+        if use_cuda:
+            start_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        else:
+            start = time.time()
+        # all ranks replay the modalities of a window in the same order, so
+        # they reduce the same buckets
+        buckets = list(self.buckets["shared"])
+        for modal in sorted(self.touched):
+            buckets += self.buckets[modal]
+        self.touched = set()
+
+        pending = []
+        for bucket in buckets:
+            device = bucket[0].device
+            grads = [
+                p.grad.reshape(-1).float()
+                if p.grad is not None
+                else torch.zeros(p.numel(), device=device)
+                for p in bucket
+            ]
+            # one "has a gradient" flag per parameter rides along
+            flags = torch.tensor(
+                [float(p.grad is not None) for p in bucket], device=device
+            )
+            flat = torch.cat(grads + [flags])
+            self.reduced_bytes += flat.numel() * 4
+            pending.append((bucket, flat, dist.all_reduce(flat, group=self.group, async_op=True)))
+        for _, _, handle in pending:
+            handle.wait()
+        # the flags of all buckets, read back at once
+        used = (
+            torch.cat([flat[-len(bucket) :] for bucket, flat, _ in pending]).tolist()
+            if pending
+            else []
+        )
+        i = 0
+        for bucket, flat, _ in pending:
+            offset = 0
+            for p in bucket:
+                grad = flat[offset : offset + p.numel()].view_as(p)
+                offset += p.numel()
+                i += 1
+                if used[i - 1] == 0:
+                    continue
+                grad.div_(self.world_size)
+                if p.grad is None:
+                    p.grad = grad.to(p.dtype).clone()
+                else:
+                    p.grad.copy_(grad)
+        # buffers (e.g. batch norm statistics) follow rank 0
+        for b in self.module.buffers():
+            dist.broadcast(b.data, 0, group=self.group)
+        if use_cuda:
+            end_event = torch.cuda.Event(enable_timing=True)
+            end_event.record()
+            self.events.append((start_event, end_event))
+        else:
+            self.comm_time += time.time() - start
+        self.steps += 1
+
+    def report(self, optimizer=None, logger=None):
+        if self.events:
+            torch.cuda.synchronize()
+            self.comm_time += sum(s.elapsed_time(e) for s, e in self.events) / 1000
+            self.events = []
+        steps = max(self.steps, 1)
+        grad_mb = sum(p.numel() for p in self.params) * 4 / 2**20
+        msg = (
+            f"[GradSync] {len(self.params)} trainable tensors ({grad_mb:.1f} MB), "
+            + ", ".join(f"{k} {len(v)}" for k, v in self.buckets.items())
+            + f" buckets; {self.reduced_bytes / steps / 2**20:.1f} MB and "
+            f"{self.comm_time / steps * 1000:.1f} ms gradient all-reduce per step"
+        )
+        if optimizer is not None:
+            state_mb = optimizer_state_bytes(optimizer) / 2**20
+            msg += f", optimizer state {state_mb:.1f} MB on this rank"
+        if torch.cuda.is_available():
+            msg += f", peak memory {torch.cuda.max_memory_allocated() / 2**20:.0f} MB"
+        print_log(msg, logger=logger)
+        self.comm_time = 0.0
+        self.reduced_bytes = 0
+        self.steps = 0
+
+
+def optimizer_state_bytes(optimizer):
+    # ZeroRedundancyOptimizer keeps this rank's shard in optim
+    optimizer = getattr(optimizer, "optim", optimizer)
+    return sum(
+        v.numel() * v.element_size()
+        for state in optimizer.state.values()
+        for v in state.values()
+        if torch.is_tensor(v)
+    )
@@ -11,6 +11,7 @@
 
 import builtins
 import datetime
+import math
 import os
 import time
 from collections import defaultdict, deque
@@ -60,7 +61,7 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device="cuda")
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=comm_device())
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -100,21 +101,43 @@ class SmoothedValue(object):
 
 
 class MetricLogger(object):
-    def __init__(self, delimiter="\t",logger=None):
+    def __init__(self, delimiter="\t",logger=None, deferred=False):
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
         self.logger=logger
+        # deferred: tensor values stay on device and are read back in one
+        # transfer when the meters are printed or synchronised
+        self.deferred = deferred
+        self.pending = []
+        # *_loss meters that read back a non-finite value at the last flush
+        self.nonfinite = []
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
             if v is None:
                 continue
             if isinstance(v, torch.Tensor):
+                if self.deferred:
+                    self.pending.append((k, v.detach().float().reshape(())))
+                    continue
                 v = v.item()
             assert isinstance(v, (float, int))
             self.meters[k].update(v)
 
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        names = [k for k, _ in self.pending]
+        values = torch.stack([v for _, v in self.pending]).tolist()
+        self.pending = []
+        for k, v in zip(names, values):
+            self.meters[k].update(v)
+            if k.endswith("_loss") and not math.isfinite(v):
+                self.nonfinite.append(k)
+
     def __getattr__(self, attr):
+        if self.__dict__.get("pending"):
+            self.flush()
         if attr in self.meters:
             return self.meters[attr]
         if attr in self.__dict__:
@@ -124,14 +147,28 @@ class MetricLogger(object):
         )
 
     def __str__(self):
+        self.flush()
         loss_str = []
         for name, meter in self.meters.items():
             loss_str.append("{}: {}".format(name, str(meter)))
         return self.delimiter.join(loss_str)
 
     def synchronize_between_processes(self):
-        for meter in self.meters.values():
-            meter.synchronize_between_processes()
+        """(count, total) of every meter in a single all_reduce."""
+        self.flush()
+        if not is_dist_avail_and_initialized() or len(self.meters) == 0:
+            return
+        names = sorted(self.meters)
+        t = torch.tensor(
+            [[self.meters[k].count, self.meters[k].total] for k in names],
+            dtype=torch.float64,
+            device=comm_device(),
+        )
+        dist.barrier()
+        dist.all_reduce(t)
+        for k, (count, total) in zip(names, t.tolist()):
+            self.meters[k].count = int(count)
+            self.meters[k].total = total
 
     def add_meter(self, name, meter):
         self.meters[name] = meter
@@ -194,8 +231,8 @@ class MetricLogger(object):
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print_log(
-            "{} Total time: {} ({:.4f} s / it)".format(
-                header, total_time_str, total_time / len(iterable)
+            "{} Total time: {} ({:.4f} s / it, {:.2f} it / s)".format(
+                header, total_time_str, total_time / len(iterable), len(iterable) / total_time
             ),logger=self.logger
         )
 
@@ -237,6 +274,14 @@ def get_rank():
     return dist.get_rank()
 
 
+def comm_device():
+    """Device of the tensors handed to collectives: the current GPU under
+    nccl, the CPU otherwise (gloo, CPU-only evaluation)."""
+    if is_dist_avail_and_initialized() and dist.get_backend() == "nccl":
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
 def is_main_process():
     return get_rank() == 0
 
@@ -274,8 +319,11 @@ def init_distributed_mode(args):
 
     args.distributed = True
 
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = "nccl"
+    if torch.cuda.is_available():
+        torch.cuda.set_device(args.gpu)
+        args.dist_backend = "nccl"
+    else:
+        args.dist_backend = "gloo"
     print(
         "| distributed init (rank {}): {}, gpu {}".format(
             args.rank, args.dist_url, args.gpu
@@ -295,8 +343,12 @@ def init_distributed_mode(args):
 class NativeScalerWithGradNormCount:
     state_dict_key = "amp_scaler"
 
-    def __init__(self):
-        self._scaler = torch.cuda.amp.GradScaler()
+    def __init__(self, enabled=True, grad_sync=None):
+        # disabled for bf16 / fp32, which need no loss scaling
+        self._scaler = torch.cuda.amp.GradScaler(enabled=enabled)
+        # averages the gradients across ranks before the step when the model
+        # is not wrapped in DDP (util.grad_sync.GradReducer)
+        self.grad_sync = grad_sync
 
     def __call__(
         self,
@@ -310,6 +362,8 @@ class NativeScalerWithGradNormCount:
     ):
         self._scaler.scale(loss).backward(retain_graph=retain_graph, create_graph=create_graph)
         if update_grad:
+            if self.grad_sync is not None:
+                self.grad_sync()
             if clip_grad is not None:
                 assert parameters is not None
                 self._scaler.unscale_(
@@ -351,6 +405,16 @@ def get_grad_norm_(parameters, norm_type: float = 2.0) -> torch.Tensor:
     return total_norm
 
 
+def optimizer_state_dict(optimizer):
+    """``optimizer.state_dict()``; a sharded optimizer (``ZeroRedundancyOptimizer``)
+    is first consolidated on rank 0, which every rank has to take part in."""
+    if hasattr(optimizer, "consolidate_state_dict"):
+        optimizer.consolidate_state_dict(to=0)
+        if not is_main_process():
+            return {}
+    return optimizer.state_dict()
+
+
 def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler):
     output_dir = Path(args.output_dir)
     epoch_name = str(epoch)
@@ -359,7 +423,7 @@ def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler):
         for checkpoint_path in checkpoint_paths:
             to_save = {
                 "model": model_without_ddp.state_dict(),
-                "optimizer": optimizer.state_dict(),
+                "optimizer": optimizer_state_dict(optimizer),
                 "epoch": epoch,
                 "scaler": loss_scaler.state_dict(),
                 "args": args,
@@ -382,7 +446,7 @@ def save_checkpoint(args, epoch, model, model_without_ddp, optimizer, loss_scale
         for checkpoint_path in checkpoint_paths:
             to_save = {
                 "model": model_without_ddp.state_dict(),
-                "optimizer": optimizer.state_dict(),
+                "optimizer": optimizer_state_dict(optimizer),
                 "epoch": epoch,
                 "scaler": loss_scaler.state_dict(),
                 "args": args,
@@ -403,6 +467,48 @@ def save_checkpoint(args, epoch, model, model_without_ddp, optimizer, loss_scale
     
 
 
+def save_step_checkpoint(
+    args, epoch, model_without_ddp, optimizer, loss_scaler, data_state, logger=None
+):
+    """Mid-epoch checkpoint with the data loader position, see ``resume_step_checkpoint``."""
+    checkpoint_path = Path(args.output_dir) / "step_ckpt.pth"
+    to_save = {
+        "model": model_without_ddp.state_dict(),
+        "optimizer": optimizer_state_dict(optimizer),
+        "epoch": epoch,
+        "scaler": loss_scaler.state_dict(),
+        "args": args,
+        "data_state": data_state,
+    }
+    save_on_master(to_save, checkpoint_path)
+    print_log(
+        f"Saving step checkpoint at epoch {epoch}, step {sum(data_state['consumed'])}: "
+        f"{checkpoint_path}",
+        logger,
+    )
+
+
+def resume_step_checkpoint(args, model_without_ddp, optimizer, loss_scaler):
+    """With ``--resume_step``: load ``step_ckpt.pth`` if it is newer than the
+    epoch checkpoint that was resumed, and return its data loader state (or None)."""
+    ckpt_path = os.path.join(args.output_dir, "step_ckpt.pth")
+    if not os.path.exists(ckpt_path):
+        return None
+    checkpoint = torch.load(ckpt_path, map_location="cpu")
+    if checkpoint["epoch"] < args.start_epoch:
+        print(f"[RESUME INFO] step checkpoint of epoch {checkpoint['epoch']} is older, skipped")
+        return None
+    model_without_ddp.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    loss_scaler.load_state_dict(checkpoint["scaler"])
+    args.start_epoch = checkpoint["epoch"]
+    print(
+        f"[RESUME INFO] resume epoch {checkpoint['epoch']} at step "
+        f"{sum(checkpoint['data_state']['consumed'])} from {ckpt_path}"
+    )
+    return checkpoint["data_state"]
+
+
 def load_model(args, model_without_ddp, optimizer, loss_scaler):
     if args.resume:
         if args.resume.startswith("https"):
@@ -428,7 +534,7 @@ def load_model(args, model_without_ddp, optimizer, loss_scaler):
 def all_reduce_mean(x):
     world_size = get_world_size()
     if world_size > 1:
-        x_reduce = torch.tensor(x).cuda()
+        x_reduce = torch.tensor(x, device=comm_device())
         dist.all_reduce(x_reduce)
         x_reduce /= world_size
         return x_reduce.item()
@@ -622,4 +728,111 @@ def concat_all_gather(tensor):
     torch.distributed.all_gather(tensors_gather, tensor, async_op=False)
 
     output = torch.cat(tensors_gather, dim=0)
-    return output
\ No newline at end of file
+    return output
+
+def _input_tensor_keys(input, prefix=()):
+    keys = []
+    for key, value in input.items():
+        if torch.is_tensor(value):
+            keys.append(prefix + (key,))
+        elif isinstance(value, dict):
+            keys.extend(_input_tensor_keys(value, prefix + (key,)))
+    return keys
+
+
+def _get_key(input, keys):
+    for key in keys:
+        input = input[key]
+    return input
+
+
+def _set_key(input, keys, value):
+    for key in keys[:-1]:
+        input = input[key]
+    input[keys[-1]] = value
+
+
+class HostInputCache:
+    """Pinned host copies of the model inputs of an accumulation window.
+
+    ``put(input)`` copies the CUDA tensors of ``input`` into pinned host
+    buffers on a side stream, so the device copies can be freed while the
+    window's no-grad passes run, and returns a handle. ``get(handle, next)``
+    brings the input back on the device and starts copying ``next`` so its
+    transfer overlaps the re-forward of ``handle``. The pinned buffers of
+    slot ``k`` are reused by the ``k``-th input of every window.
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device)
+        self.slots = []
+        self.inputs = []
+        self.pending = {}
+        self.window_bytes = 0
+        self.max_window_bytes = 0
+
+    def put(self, input):
+        handle = len(self.inputs)
+        if handle == len(self.slots):
+            self.slots.append({})
+        slot = self.slots[handle]
+        moved = []
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            for keys in _input_tensor_keys(input):
+                t = _get_key(input, keys)
+                if t.device.type != "cuda":
+                    continue
+                buf = slot.get(keys)
+                if buf is None or buf.shape != t.shape or buf.dtype != t.dtype:
+                    buf = torch.empty(t.shape, dtype=t.dtype, pin_memory=True)
+                    slot[keys] = buf
+                buf.copy_(t, non_blocking=True)
+                # the device copy is freed once the side stream is done with it
+                t.record_stream(self.stream)
+                _set_key(input, keys, buf)
+                moved.append(keys)
+                self.window_bytes += t.numel() * t.element_size()
+        self.inputs.append((input, moved))
+        return handle
+
+    def _prefetch(self, handle):
+        if handle is None or handle in self.pending:
+            return
+        input, moved = self.inputs[handle]
+        with torch.cuda.stream(self.stream):
+            for keys in moved:
+                _set_key(
+                    input, keys, _get_key(input, keys).to(self.device, non_blocking=True)
+                )
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.pending[handle] = event
+
+    def get(self, handle, next=None):
+        self._prefetch(handle)
+        current = torch.cuda.current_stream(self.device)
+        current.wait_event(self.pending.pop(handle))
+        input, moved = self.inputs[handle]
+        for keys in moved:
+            _get_key(input, keys).record_stream(current)
+        self.inputs[handle] = None
+        self._prefetch(next)
+        return input
+
+    def reset(self):
+        """Start a new window; the pinned buffers are kept."""
+        self.max_window_bytes = max(self.max_window_bytes, self.window_bytes)
+        self.window_bytes = 0
+        self.inputs = []
+        self.pending = {}
+
+    def report(self, logger=None):
+        pinned = sum(b.numel() * b.element_size() for s in self.slots for b in s.values())
+        print_log(
+            f"[InputOffload] up to {self.max_window_bytes / 2**20:.1f} MB of inputs per "
+            f"window kept on host ({pinned / 2**20:.1f} MB pinned), peak device memory "
+            f"{torch.cuda.max_memory_allocated(self.device) / 2**20:.1f} MB",
+            logger=logger,
+        )
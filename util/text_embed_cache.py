@@ -0,0 +1,212 @@
+"""Caption-embedding cache for the frozen open_clip text branch.
+
+With ``--use_text_branch`` every step encodes the batch captions with the
+frozen text tower, but the captions come from a small template x label
+vocabulary. ``TextEmbeddingCache`` keys each caption by a hash of its token
+ids and serves repeats from
+
+    device tier   LRU of embeddings on the training device
+    disk tier     float16 rows in ``<dir>/<fingerprint>/embeds.bin`` (memmap)
+                  with their keys in ``keys.npy``
+
+so only captions never seen before reach the text tower. The directory is
+named by a fingerprint of the text model weights: another model (or other
+weights) never reads stale embeddings. Only rank 0 appends to the disk tier;
+it flushes the keys every ``flush_every`` new rows, after an fsync of the
+rows, and on open truncates ``embeds.bin`` to the rows ``keys.npy`` covers.
+"""
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from util.logger import print_log
+
+
+def model_fingerprint(model):
+    h = hashlib.sha1()
+    with torch.no_grad():
+        for name, value in model.state_dict().items():
+            h.update(name.encode("utf-8"))
+            h.update(str(tuple(value.shape)).encode("utf-8"))
+            if value.is_floating_point():
+                h.update(np.float64(value.double().sum().item()).tobytes())
+    return h.hexdigest()[:16]
+
+
+def token_keys(tokens):
+    """One 64-bit key per row of token ids."""
+    rows = tokens.cpu().numpy().astype(np.int64)
+    return [
+        int.from_bytes(hashlib.blake2b(row.tobytes(), digest_size=8).digest(), "little")
+        for row in rows
+    ]
+
+
+class TextEmbeddingCache:
+    def __init__(
+        self,
+        encode_fn,
+        fingerprint,
+        device,
+        capacity=65536,
+        cache_dir=None,
+        writable=True,
+        flush_every=1024,
+    ):
+        self.encode_fn = encode_fn
+        self.fingerprint = fingerprint
+        self.device = device
+        self.capacity = capacity
+        self.writable = writable
+        self.flush_every = flush_every
+        self.lru = OrderedDict()
+        self.dtype = None
+        self.dim = None
+        # modal -> [device hits, disk hits, misses]
+        self.stats = {}
+
+        self.dir = None
+        self.disk_rows = {}
+        self._disk = None
+        self._disk_len = 0
+        if cache_dir is not None:
+            self.dir = os.path.join(cache_dir, fingerprint)
+            keys_path = os.path.join(self.dir, "keys.npy")
+            embeds_path = os.path.join(self.dir, "embeds.bin")
+            dim_path = os.path.join(self.dir, "dim.npy")
+            if os.path.exists(keys_path):
+                keys = np.load(keys_path)
+                self.dim = int(np.load(dim_path))
+                # keys are flushed after their rows are synced, never before
+                size = os.path.getsize(embeds_path) if os.path.exists(embeds_path) else 0
+                n_rows = min(len(keys), size // (self.dim * 2))
+                self.disk_rows = {int(k): i for i, k in enumerate(keys[:n_rows])}
+                if writable:
+                    # drop rows appended after the last flush, they have no key
+                    with open(embeds_path, "r+b") as f:
+                        f.truncate(n_rows * self.dim * 2)
+            elif writable:
+                # a run died before its first flush: rows without any keys
+                if os.path.exists(embeds_path):
+                    with open(embeds_path, "r+b") as f:
+                        f.truncate(0)
+                if os.path.exists(dim_path):
+                    os.remove(dim_path)
+            self._new_keys = []
+
+    def _disk_get(self, row):
+        if self._disk is None or row >= self._disk_len:
+            # (re)map: rows appended since the last map are not visible yet
+            path = os.path.join(self.dir, "embeds.bin")
+            self._disk = np.memmap(path, dtype=np.float16, mode="r").reshape(-1, self.dim)
+            self._disk_len = self._disk.shape[0]
+        return torch.from_numpy(np.array(self._disk[row]))
+
+    def _disk_put(self, keys, embeds):
+        if self.dir is None or not self.writable:
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        if self.dim is None:
+            self.dim = embeds.shape[1]
+            np.save(os.path.join(self.dir, "dim.npy"), np.array(self.dim))
+        with open(os.path.join(self.dir, "embeds.bin"), "ab") as f:
+            # the file, not a counter, says where the new rows start
+            row = f.seek(0, os.SEEK_END) // (self.dim * 2)
+            f.write(embeds.detach().to("cpu", torch.float16).numpy().tobytes())
+        for i, k in enumerate(keys):
+            self.disk_rows[k] = row + i
+            self._new_keys.append(k)
+        if len(self._new_keys) >= self.flush_every:
+            self.flush()
+
+    def _lru_put(self, key, embed):
+        self.lru[key] = embed
+        if len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
+
+    @torch.no_grad()
+    def encode(self, tokens, modal=None):
+        """Normalised embeddings of the token rows ``tokens`` [B, L]."""
+        stats = self.stats.setdefault(modal, [0, 0, 0])
+        keys = token_keys(tokens)
+        out = [None] * len(keys)
+        missing = OrderedDict()
+        for i, k in enumerate(keys):
+            embed = self.lru.get(k)
+            if embed is not None:
+                self.lru.move_to_end(k)
+                out[i] = embed
+                stats[0] += 1
+            elif k in self.disk_rows:
+                embed = self._disk_get(self.disk_rows[k]).to(self.device, non_blocking=True)
+                if self.dtype is not None:
+                    embed = embed.to(self.dtype)
+                self._lru_put(k, embed)
+                out[i] = embed
+                stats[1] += 1
+            else:
+                missing.setdefault(k, []).append(i)
+                stats[2] += 1
+        if missing:
+            first = [rows[0] for rows in missing.values()]
+            embeds = self.encode_fn(tokens[first])
+            self.dtype = embeds.dtype
+            for (k, rows), embed in zip(missing.items(), embeds):
+                self._lru_put(k, embed)
+                for i in rows:
+                    out[i] = embed
+            self._disk_put(list(missing.keys()), embeds)
+        if self.dtype is not None:
+            out = [e.to(self.dtype) for e in out]
+        return torch.stack(out)
+
+    def flush(self):
+        """Persist the keys of the rows appended to the disk tier.
+
+        The rows are fsynced first, so ``keys.npy`` never names a row that
+        is not on disk."""
+        if self.dir is None or not self.writable or not self._new_keys:
+            return
+        with open(os.path.join(self.dir, "embeds.bin"), "rb") as f:
+            os.fsync(f.fileno())
+        # keys.npy is indexed by row
+        keys = np.array(sorted(self.disk_rows, key=self.disk_rows.get), dtype=np.uint64)
+        tmp = os.path.join(self.dir, f"keys.tmp{os.getpid()}.npy")
+        with open(tmp, "wb") as f:
+            np.save(f, keys)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.dir, "keys.npy"))
+        self._new_keys = []
+
+    def report(self, logger=None):
+        for modal, (dev, disk, miss) in self.stats.items():
+            total = max(dev + disk + miss, 1)
+            print_log(
+                f"[TextCache] {modal}: hit rate {100 * (dev + disk) / total:.1f}% "
+                f"(device {dev}, disk {disk}, text tower {miss}), "
+                f"{len(self.lru)} embeddings on device, {len(self.disk_rows)} on disk",
+                logger=logger,
+            )
+        self.stats = {}
+
+
+_TEXT_CACHE = None
+
+
+def get_text_embed_cache(args, text_model, device, rank=0):
+    """The run's ``TextEmbeddingCache`` for ``text_model``, built on first use."""
+    global _TEXT_CACHE
+    if _TEXT_CACHE is None:
+        _TEXT_CACHE = TextEmbeddingCache(
+            lambda tokens: text_model.encode_text(tokens, normalize=True),
+            model_fingerprint(text_model),
+            device,
+            capacity=args.text_embed_cache_size,
+            cache_dir=args.text_embed_cache_dir,
+            writable=rank == 0,
+        )
+    return _TEXT_CACHE